@@ -0,0 +1,106 @@
+from sqlalchemy import select, delete, func, literal_column
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, Order, OrderItem
+from cache import cart_cache, broker
+from dotenv import load_dotenv
+from datetime import timedelta
+import argparse
+import asyncio
+import logging
+import time
+import os
+
+
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+CART_IDLE_SECONDS = int(os.getenv('CART_IDLE_SECONDS', 30 * 86400))
+CART_SWEEP_INTERVAL = float(os.getenv('CART_SWEEP_INTERVAL', 3600))
+CART_SWEEP_BATCH_SIZE = int(os.getenv('CART_SWEEP_BATCH_SIZE', 1000))
+
+
+
+async def delete_idle_carts(db: AsyncSession, idle_seconds: int = CART_IDLE_SECONDS, batch_size: int = CART_SWEEP_BATCH_SIZE):
+	# Carts being mutated or checked out hold their row lock and are skipped. Deleting a cart
+	# cascades to its lines, whose delete trigger releases any stock they still hold; the
+	# user gets a fresh cart the next time they touch one.
+	idle = (
+		select(Order.order_id)
+		.filter(
+			Order.order_status == literal_column("'pending'"),
+			Order.order_updated_at < func.localtimestamp() - timedelta(seconds=idle_seconds)
+			)
+		.order_by(Order.order_updated_at)
+		.limit(batch_size)
+		.with_for_update(skip_locked=True)
+		.cte('idle')
+		)
+	lines = select(func.count()).filter(OrderItem.order_id.in_(select(idle.c.order_id))).scalar_subquery()
+	deleted = (
+		delete(Order)
+		.where(Order.order_id.in_(select(idle.c.order_id)))
+		.returning(Order.user_id)
+		.cte('deleted')
+		)
+	result = await db.execute(select(deleted.c.user_id, lines))
+	rows = result.all()
+	await db.commit()
+	for user_id, _ in rows:
+		cart_cache.invalidate(user_id)
+	return len(rows), rows[0][1] if rows else 0
+
+
+
+async def sweep_idle_carts(db: AsyncSession, idle_seconds: int = CART_IDLE_SECONDS, batch_size: int = CART_SWEEP_BATCH_SIZE):
+	carts, lines, batches = 0, 0, 0
+	start = time.perf_counter()
+	batch_carts = batch_size
+	while batch_carts == batch_size:
+		batch_carts, batch_lines = await delete_idle_carts(db, idle_seconds, batch_size)
+		carts += batch_carts
+		lines += batch_lines
+		batches += 1
+	seconds = time.perf_counter() - start
+	return {
+	'carts_deleted': carts,
+	'lines_deleted': lines,
+	'batches': batches,
+	'seconds': round(seconds, 3),
+	'carts_per_second': round(carts / seconds, 1) if seconds else 0.0,
+	}
+
+
+
+async def run_cart_sweeper(session_factory=AsyncSessionLocal, interval: float = CART_SWEEP_INTERVAL, idle_seconds: int = CART_IDLE_SECONDS, batch_size: int = CART_SWEEP_BATCH_SIZE):
+	while True:
+		await asyncio.sleep(interval)
+		try:
+			async with session_factory() as db:
+				stats = await sweep_idle_carts(db, idle_seconds, batch_size)
+			if stats['carts_deleted']:
+				logger.info(f"Deleted {stats['carts_deleted']} idle carts ({stats['lines_deleted']} lines) in {stats['batches']} batches, {stats['seconds']}s, {stats['carts_per_second']} carts/s")
+		except Exception as e:
+			logger.exception(f'Idle cart sweep failed: {str(e)}')
+
+
+
+async def main(idle_seconds: int, batch_size: int):
+	# The API workers have to hear about the swept carts, so the broker runs until it has sent them.
+	tasks = broker.start()
+	async with AsyncSessionLocal() as db:
+		stats = await sweep_idle_carts(db, idle_seconds, batch_size)
+	await asyncio.wait_for(broker.flush(), timeout=10)
+	for task in tasks:
+		task.cancel()
+	print(stats)
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Delete pending carts idle for longer than the given age.')
+	parser.add_argument('--idle-seconds', type=int, default=CART_IDLE_SECONDS)
+	parser.add_argument('--batch-size', type=int, default=CART_SWEEP_BATCH_SIZE)
+	args = parser.parse_args()
+	asyncio.run(main(args.idle_seconds, args.batch_size))
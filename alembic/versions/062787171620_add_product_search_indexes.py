@@ -0,0 +1,37 @@
+"""Add product search indexes
+
+Revision ID: 062787171620
+Revises: c265a98805c5
+Create Date: 2026-10-18 17:43:06.945062
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '062787171620'
+down_revision: Union[str, None] = 'c265a98805c5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_products_color_size_price', 'products', ['product_color', 'product_size', 'product_price', 'product_id'])
+    op.create_index('ix_products_price_id', 'products', ['product_price', 'product_id'])
+    op.create_index(
+        'ix_products_in_stock_price_id',
+        'products',
+        ['product_price', 'product_id'],
+        postgresql_where=sa.text('product_stock_quantity > 0'),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_products_in_stock_price_id', table_name='products')
+    op.drop_index('ix_products_price_id', table_name='products')
+    op.drop_index('ix_products_color_size_price', table_name='products')
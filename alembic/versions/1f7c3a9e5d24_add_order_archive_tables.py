@@ -0,0 +1,54 @@
+"""Add order archive tables
+
+Revision ID: 1f7c3a9e5d24
+Revises: 6e4b1d9c3a70
+Create Date: 2026-10-18 19:16:08.693612
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '1f7c3a9e5d24'
+down_revision: Union[str, None] = '6e4b1d9c3a70'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'archived_orders',
+        sa.Column('order_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('order_amount', sa.Float(), nullable=True),
+        sa.Column('order_status', sa.String(), nullable=True),
+        sa.Column('order_time_info', sa.DateTime(), nullable=True),
+        sa.Column('order_updated_at', sa.DateTime(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('order_id'),
+    )
+    op.create_index('ix_archived_orders_user_status_time', 'archived_orders', ['user_id', 'order_status', 'order_time_info', 'order_id'], unique=False)
+    op.create_table(
+        'archived_order_items',
+        sa.Column('order_items_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('order_items_price_now', sa.Float(), nullable=True),
+        sa.Column('product_quantity', sa.Integer(), nullable=True),
+        sa.Column('order_id', sa.Integer(), nullable=True),
+        sa.Column('product_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['order_id'], ['archived_orders.order_id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['product_id'], ['products.product_id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('order_items_id'),
+    )
+    op.create_index(op.f('ix_archived_order_items_order_id'), 'archived_order_items', ['order_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_archived_order_items_order_id'), table_name='archived_order_items')
+    op.drop_table('archived_order_items')
+    op.drop_index('ix_archived_orders_user_status_time', table_name='archived_orders')
+    op.drop_table('archived_orders')
@@ -0,0 +1,37 @@
+"""Add cart activity time
+
+Revision ID: 3d9f6b2a8e15
+Revises: 8c3e5a7f1d92
+Create Date: 2026-10-18 18:49:26.348925
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3d9f6b2a8e15'
+down_revision: Union[str, None] = '8c3e5a7f1d92'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('orders', sa.Column('order_updated_at', sa.DateTime(), nullable=True))
+    op.execute("UPDATE orders SET order_updated_at = coalesce(order_time_info, localtimestamp)")
+    op.create_index(
+        'ix_orders_pending_updated_at',
+        'orders',
+        ['order_updated_at'],
+        unique=False,
+        postgresql_where=sa.text("order_status = 'pending'"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_orders_pending_updated_at', table_name='orders')
+    op.drop_column('orders', 'order_updated_at')
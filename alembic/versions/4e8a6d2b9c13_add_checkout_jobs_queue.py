@@ -0,0 +1,51 @@
+"""Add checkout jobs queue
+
+Revision ID: 4e8a6d2b9c13
+Revises: 9b4f2c7e1a06
+Create Date: 2026-10-18 18:21:36.252662
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4e8a6d2b9c13'
+down_revision: Union[str, None] = '9b4f2c7e1a06'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'checkout_jobs',
+        sa.Column('job_id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('token', sa.String(), nullable=False),
+        sa.Column('job_status', sa.String(), nullable=False),
+        sa.Column('job_error', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['order_id'], ['orders.order_id'], ondelete='SET NULL'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('job_id'),
+    )
+    op.create_index(op.f('ix_checkout_jobs_token'), 'checkout_jobs', ['token'], unique=True)
+    op.create_index(
+        'ix_checkout_jobs_queued',
+        'checkout_jobs',
+        ['job_id'],
+        unique=False,
+        postgresql_where=sa.text("job_status = 'queued'"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_checkout_jobs_queued', table_name='checkout_jobs', postgresql_where=sa.text("job_status = 'queued'"))
+    op.drop_index(op.f('ix_checkout_jobs_token'), table_name='checkout_jobs')
+    op.drop_table('checkout_jobs')
@@ -0,0 +1,46 @@
+"""Add product stock shards
+
+Revision ID: 5a2c8e1f7b36
+Revises: 3d9f6b2a8e15
+Create Date: 2026-10-18 18:55:31.440794
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5a2c8e1f7b36'
+down_revision: Union[str, None] = '3d9f6b2a8e15'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('products', sa.Column('product_stock_shards', sa.Integer(), server_default='0', nullable=False))
+    op.create_index(
+        'ix_products_sharded',
+        'products',
+        ['product_id'],
+        unique=False,
+        postgresql_where=sa.text('product_stock_shards > 0'),
+    )
+    op.create_table(
+        'product_stock_shards',
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('shard_id', sa.Integer(), nullable=False),
+        sa.Column('shard_quantity', sa.Integer(), nullable=False),
+        sa.CheckConstraint('shard_quantity >= 0', name='ck_product_stock_shards_quantity'),
+        sa.ForeignKeyConstraint(['product_id'], ['products.product_id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('product_id', 'shard_id'),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('product_stock_shards')
+    op.drop_index('ix_products_sharded', table_name='products')
+    op.drop_column('products', 'product_stock_shards')
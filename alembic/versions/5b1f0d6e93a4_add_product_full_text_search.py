@@ -0,0 +1,40 @@
+"""Add product full text search
+
+Revision ID: 5b1f0d6e93a4
+Revises: 062787171620
+Create Date: 2026-10-18 17:44:36.763147
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b1f0d6e93a4'
+down_revision: Union[str, None] = '062787171620'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+PRODUCT_SEARCH_VECTOR = (
+    "setweight(to_tsvector('english'::regconfig, coalesce(product_name, '')), 'A') || "
+    "setweight(to_tsvector('english'::regconfig, coalesce(product_description, '')), 'B')"
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        'products',
+        sa.Column('product_search', postgresql.TSVECTOR(), sa.Computed(PRODUCT_SEARCH_VECTOR, persisted=True)),
+    )
+    op.create_index('ix_products_search', 'products', ['product_search'], postgresql_using='gin')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_products_search', table_name='products')
+    op.drop_column('products', 'product_search')
@@ -0,0 +1,58 @@
+"""Add daily sales rollups
+
+Revision ID: 6e4b1d9c3a70
+Revises: 5a2c8e1f7b36
+Create Date: 2026-10-18 19:13:34.536606
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '6e4b1d9c3a70'
+down_revision: Union[str, None] = '5a2c8e1f7b36'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Orders completed before this revision are left unmarked, so the first rollup runs pick them up.
+    op.add_column('orders', sa.Column('order_rolled_up', sa.Boolean(), server_default='false', nullable=False))
+    op.create_index(
+        'ix_orders_unrolled',
+        'orders',
+        ['order_id'],
+        unique=False,
+        postgresql_where=sa.text("order_status = 'completed' AND order_rolled_up IS false"),
+    )
+    op.create_table(
+        'daily_product_sales',
+        sa.Column('sales_date', sa.Date(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('revenue', sa.Float(), nullable=False),
+        sa.Column('units', sa.Integer(), nullable=False),
+        sa.Column('order_count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('sales_date', 'product_id'),
+    )
+    op.create_index('ix_daily_product_sales_product_date', 'daily_product_sales', ['product_id', 'sales_date'], unique=False)
+    op.create_table(
+        'daily_sales',
+        sa.Column('sales_date', sa.Date(), nullable=False),
+        sa.Column('revenue', sa.Float(), nullable=False),
+        sa.Column('units', sa.Integer(), nullable=False),
+        sa.Column('order_count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('sales_date'),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('daily_sales')
+    op.drop_index('ix_daily_product_sales_product_date', table_name='daily_product_sales')
+    op.drop_table('daily_product_sales')
+    op.drop_index('ix_orders_unrolled', table_name='orders')
+    op.drop_column('orders', 'order_rolled_up')
@@ -0,0 +1,33 @@
+"""Add order history index
+
+Revision ID: 6f1a3b8d2e47
+Revises: 2c7d9e4f8a51
+Create Date: 2026-10-18 18:33:04.978902
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '6f1a3b8d2e47'
+down_revision: Union[str, None] = '2c7d9e4f8a51'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index(
+        'ix_orders_user_status_time',
+        'orders',
+        ['user_id', 'order_status', 'order_time_info', 'order_id'],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_orders_user_status_time', table_name='orders')
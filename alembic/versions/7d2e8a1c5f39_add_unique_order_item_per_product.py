@@ -0,0 +1,48 @@
+"""Add unique order item per product
+
+Revision ID: 7d2e8a1c5f39
+Revises: a3c9e4f27b18
+Create Date: 2026-10-18 18:05:11.000011
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7d2e8a1c5f39'
+down_revision: Union[str, None] = 'a3c9e4f27b18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Merge duplicate lines left by the old read-then-insert add-to-cart into the oldest line.
+    op.execute(
+        """
+        WITH duplicates AS (
+            SELECT order_id, product_id, min(order_items_id) AS keep_id, sum(product_quantity) AS quantity
+            FROM order_items
+            GROUP BY order_id, product_id
+            HAVING count(*) > 1
+        ), removed AS (
+            DELETE FROM order_items
+            USING duplicates
+            WHERE order_items.order_id = duplicates.order_id
+                AND order_items.product_id = duplicates.product_id
+                AND order_items.order_items_id <> duplicates.keep_id
+        )
+        UPDATE order_items SET product_quantity = duplicates.quantity
+        FROM duplicates
+        WHERE order_items.order_items_id = duplicates.keep_id
+        """
+    )
+    op.create_unique_constraint('uq_order_items_order_product', 'order_items', ['order_id', 'product_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('uq_order_items_order_product', 'order_items', type_='unique')
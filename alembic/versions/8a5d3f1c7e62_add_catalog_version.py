@@ -0,0 +1,67 @@
+"""Add catalog version counter
+
+Revision ID: 8a5d3f1c7e62
+Revises: 1f7c3a9e5d24
+Create Date: 2026-10-18 21:04:37.215904
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8a5d3f1c7e62'
+down_revision: Union[str, None] = '1f7c3a9e5d24'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Frozen copy of database.CATALOG_VERSION_DDL.
+CATALOG_VERSION_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION catalog_version_bump() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE catalog_version SET version = version + 1;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE TRIGGER products_catalog_version AFTER INSERT OR DELETE ON products
+    FOR EACH STATEMENT EXECUTE FUNCTION catalog_version_bump()
+    """,
+    """
+    CREATE CONSTRAINT TRIGGER products_catalog_version_update
+    AFTER UPDATE OF product_name, product_price, product_description, product_stock_quantity, product_size, product_color ON products
+    DEFERRABLE INITIALLY DEFERRED FOR EACH ROW
+    WHEN (
+        (OLD.product_name, OLD.product_price, OLD.product_description, OLD.product_stock_quantity, OLD.product_size, OLD.product_color)
+        IS DISTINCT FROM
+        (NEW.product_name, NEW.product_price, NEW.product_description, NEW.product_stock_quantity, NEW.product_size, NEW.product_color)
+    )
+    EXECUTE FUNCTION catalog_version_bump()
+    """,
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'catalog_version',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.execute('INSERT INTO catalog_version (id, version) VALUES (1, 0)')
+    for statement in CATALOG_VERSION_DDL:
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute('DROP TRIGGER IF EXISTS products_catalog_version_update ON products')
+    op.execute('DROP TRIGGER IF EXISTS products_catalog_version ON products')
+    op.execute('DROP FUNCTION IF EXISTS catalog_version_bump()')
+    op.drop_table('catalog_version')
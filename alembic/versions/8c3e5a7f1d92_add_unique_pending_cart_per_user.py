@@ -0,0 +1,50 @@
+"""Add unique pending cart per user
+
+Revision ID: 8c3e5a7f1d92
+Revises: 6f1a3b8d2e47
+Create Date: 2026-10-18 18:39:07.442588
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c3e5a7f1d92'
+down_revision: Union[str, None] = '6f1a3b8d2e47'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Keep each user's newest pending cart; older duplicates are kept as abandoned orders.
+    op.execute(
+        """
+        UPDATE orders SET order_status = 'abandoned'
+        FROM (
+            SELECT user_id, max(order_id) AS keep_id
+            FROM orders
+            WHERE order_status = 'pending'
+            GROUP BY user_id
+            HAVING count(*) > 1
+        ) AS duplicates
+        WHERE orders.user_id = duplicates.user_id
+            AND orders.order_status = 'pending'
+            AND orders.order_id <> duplicates.keep_id
+        """
+    )
+    op.create_index(
+        'uq_orders_user_pending',
+        'orders',
+        ['user_id'],
+        unique=True,
+        postgresql_where=sa.text("order_status = 'pending'"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('uq_orders_user_pending', table_name='orders')
@@ -0,0 +1,67 @@
+"""Add cart stock holds
+
+Revision ID: 9b4f2c7e1a06
+Revises: 7d2e8a1c5f39
+Create Date: 2026-10-18 18:17:00.302916
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b4f2c7e1a06'
+down_revision: Union[str, None] = '7d2e8a1c5f39'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Frozen copy of database.ORDER_ITEM_HOLDS_DDL.
+ORDER_ITEM_HOLDS_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION order_items_release_holds() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE products SET product_reserved_quantity = products.product_reserved_quantity - released.quantity
+        FROM (
+            SELECT product_id, sum(product_quantity) AS quantity
+            FROM old_rows
+            WHERE reserved_until IS NOT NULL
+            GROUP BY product_id
+        ) AS released
+        WHERE products.product_id = released.product_id;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE TRIGGER order_items_release_holds AFTER DELETE ON order_items
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION order_items_release_holds()
+    """,
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Existing cart lines start without a hold, so nothing is reserved yet.
+    op.add_column('products', sa.Column('product_reserved_quantity', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('order_items', sa.Column('reserved_until', sa.DateTime(), nullable=True))
+    op.create_index(
+        'ix_order_items_reserved_until',
+        'order_items',
+        ['reserved_until'],
+        unique=False,
+        postgresql_where=sa.text('reserved_until IS NOT NULL'),
+    )
+    for statement in ORDER_ITEM_HOLDS_DDL:
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute('DROP TRIGGER IF EXISTS order_items_release_holds ON order_items')
+    op.execute('DROP FUNCTION IF EXISTS order_items_release_holds()')
+    op.drop_index('ix_order_items_reserved_until', table_name='order_items', postgresql_where=sa.text('reserved_until IS NOT NULL'))
+    op.drop_column('order_items', 'reserved_until')
+    op.drop_column('products', 'product_reserved_quantity')
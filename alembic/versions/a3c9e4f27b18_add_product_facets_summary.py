@@ -0,0 +1,114 @@
+"""Add product facets summary
+
+Revision ID: a3c9e4f27b18
+Revises: 5b1f0d6e93a4
+Create Date: 2026-10-18 18:02:08.900645
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3c9e4f27b18'
+down_revision: Union[str, None] = '5b1f0d6e93a4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Frozen copy of database.PRODUCT_FACETS_DDL with a bucket width of 10.
+PRODUCT_FACETS_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION product_facet_keys(color varchar, size integer, price double precision)
+    RETURNS TABLE (facet varchar, value varchar) LANGUAGE sql IMMUTABLE AS $$
+        SELECT keys.facet_name, keys.facet_value
+        FROM (VALUES
+            ('color'::varchar, color),
+            ('size'::varchar, size::varchar),
+            ('price'::varchar, (floor(price / 10) * 10)::varchar)
+        ) AS keys (facet_name, facet_value)
+        WHERE keys.facet_value IS NOT NULL
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION product_facets_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO product_facets (facet, value, product_count)
+            SELECT keys.facet, keys.value, count(*)
+            FROM new_rows, product_facet_keys(new_rows.product_color, new_rows.product_size, new_rows.product_price) AS keys
+            GROUP BY keys.facet, keys.value
+            ON CONFLICT (facet, value) DO UPDATE SET product_count = product_facets.product_count + excluded.product_count;
+        ELSIF TG_OP = 'DELETE' THEN
+            UPDATE product_facets SET product_count = product_facets.product_count - changes.removed
+            FROM (
+                SELECT keys.facet, keys.value, count(*) AS removed
+                FROM old_rows, product_facet_keys(old_rows.product_color, old_rows.product_size, old_rows.product_price) AS keys
+                GROUP BY keys.facet, keys.value
+            ) AS changes
+            WHERE product_facets.facet = changes.facet AND product_facets.value = changes.value;
+        ELSE
+            INSERT INTO product_facets (facet, value, product_count)
+            SELECT keys.facet, keys.value, sum(changed.delta)
+            FROM (
+                SELECT product_color, product_size, product_price, 1 AS delta FROM new_rows
+                UNION ALL
+                SELECT product_color, product_size, product_price, -1 AS delta FROM old_rows
+            ) AS changed, product_facet_keys(changed.product_color, changed.product_size, changed.product_price) AS keys
+            GROUP BY keys.facet, keys.value
+            HAVING sum(changed.delta) <> 0
+            ON CONFLICT (facet, value) DO UPDATE SET product_count = product_facets.product_count + excluded.product_count;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE TRIGGER products_facets_insert AFTER INSERT ON products
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION product_facets_apply()
+
+    """,
+    """
+    CREATE TRIGGER products_facets_update AFTER UPDATE ON products
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION product_facets_apply()
+
+    """,
+    """
+    CREATE TRIGGER products_facets_delete AFTER DELETE ON products
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION product_facets_apply()
+
+    """,
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'product_facets',
+        sa.Column('facet', sa.String(), nullable=False),
+        sa.Column('value', sa.String(), nullable=False),
+        sa.Column('product_count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('facet', 'value'),
+    )
+    for statement in PRODUCT_FACETS_DDL:
+        op.execute(statement)
+    op.execute(
+        """
+        INSERT INTO product_facets (facet, value, product_count)
+        SELECT keys.facet, keys.value, count(*)
+        FROM products, product_facet_keys(products.product_color, products.product_size, products.product_price) AS keys
+        GROUP BY keys.facet, keys.value
+        """
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute('DROP TRIGGER IF EXISTS products_facets_delete ON products')
+    op.execute('DROP TRIGGER IF EXISTS products_facets_update ON products')
+    op.execute('DROP TRIGGER IF EXISTS products_facets_insert ON products')
+    op.execute('DROP FUNCTION IF EXISTS product_facets_apply()')
+    op.execute('DROP FUNCTION IF EXISTS product_facet_keys(varchar, integer, double precision)')
+    op.drop_table('product_facets')
@@ -0,0 +1,66 @@
+"""Row-level facet update trigger
+
+Revision ID: b7e2d5a9c4f8
+Revises: 8a5d3f1c7e62
+Create Date: 2026-10-18 21:26:51.480317
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7e2d5a9c4f8'
+down_revision: Union[str, None] = '8a5d3f1c7e62'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Frozen copy of the update parts of database.PRODUCT_FACETS_DDL. product_facets_apply keeps its
+# UPDATE branch, which is simply no longer reached.
+PRODUCT_FACETS_UPDATE_DDL = [
+    """
+    CREATE OR REPLACE FUNCTION product_facets_update() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO product_facets (facet, value, product_count)
+        SELECT keys.facet, keys.value, sum(changed.delta)
+        FROM (VALUES
+            (NEW.product_color, NEW.product_size, NEW.product_price, 1),
+            (OLD.product_color, OLD.product_size, OLD.product_price, -1)
+        ) AS changed (product_color, product_size, product_price, delta),
+        product_facet_keys(changed.product_color, changed.product_size, changed.product_price) AS keys
+        GROUP BY keys.facet, keys.value
+        HAVING sum(changed.delta) <> 0
+        ON CONFLICT (facet, value) DO UPDATE SET product_count = product_facets.product_count + excluded.product_count;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE TRIGGER products_facets_update AFTER UPDATE OF product_color, product_size, product_price ON products
+    FOR EACH ROW
+    WHEN ((OLD.product_color, OLD.product_size, OLD.product_price) IS DISTINCT FROM (NEW.product_color, NEW.product_size, NEW.product_price))
+    EXECUTE FUNCTION product_facets_update()
+    """,
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute('DROP TRIGGER IF EXISTS products_facets_update ON products')
+    for statement in PRODUCT_FACETS_UPDATE_DDL:
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute('DROP TRIGGER IF EXISTS products_facets_update ON products')
+    op.execute('DROP FUNCTION IF EXISTS product_facets_update()')
+    op.execute(
+        """
+        CREATE TRIGGER products_facets_update AFTER UPDATE ON products
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION product_facets_apply()
+        """
+    )
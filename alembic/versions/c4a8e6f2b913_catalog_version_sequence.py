@@ -0,0 +1,68 @@
+"""Replace catalog version counter with a sequence
+
+Revision ID: c4a8e6f2b913
+Revises: b7e2d5a9c4f8
+Create Date: 2026-10-18 22:41:09.553170
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4a8e6f2b913'
+down_revision: Union[str, None] = 'b7e2d5a9c4f8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute('DROP TRIGGER IF EXISTS products_catalog_version_update ON products')
+    op.execute('DROP TRIGGER IF EXISTS products_catalog_version ON products')
+    op.execute('DROP FUNCTION IF EXISTS catalog_version_bump()')
+    op.drop_table('catalog_version')
+    op.execute(sa.schema.CreateSequence(sa.Sequence('catalog_version')))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute(sa.schema.DropSequence(sa.Sequence('catalog_version')))
+    op.create_table(
+        'catalog_version',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.execute('INSERT INTO catalog_version (id, version) VALUES (1, 0)')
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION catalog_version_bump() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE catalog_version SET version = version + 1;
+            RETURN NULL;
+        END
+        $$
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER products_catalog_version AFTER INSERT OR DELETE ON products
+        FOR EACH STATEMENT EXECUTE FUNCTION catalog_version_bump()
+        """
+    )
+    op.execute(
+        """
+        CREATE CONSTRAINT TRIGGER products_catalog_version_update
+        AFTER UPDATE OF product_name, product_price, product_description, product_stock_quantity, product_size, product_color ON products
+        DEFERRABLE INITIALLY DEFERRED FOR EACH ROW
+        WHEN (
+            (OLD.product_name, OLD.product_price, OLD.product_description, OLD.product_stock_quantity, OLD.product_size, OLD.product_color)
+            IS DISTINCT FROM
+            (NEW.product_name, NEW.product_price, NEW.product_description, NEW.product_stock_quantity, NEW.product_size, NEW.product_color)
+        )
+        EXECUTE FUNCTION catalog_version_bump()
+        """
+    )
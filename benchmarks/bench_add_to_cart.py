@@ -0,0 +1,61 @@
+"""Load test POST /orders/cart/add and report latency percentiles and statements per call.
+
+Runs the app in-process against BENCH_DATABASE_URL (falls back to TEST_DATABASE_URL);
+the tables there are recreated, so point it at a scratch database.
+
+	python benchmarks/bench_add_to_cart.py --users 200 --requests 5000 --concurrency 20
+"""
+import argparse
+import asyncio
+
+from common import bench_engine, recreate_tables, drop_tables, use_engine, create_users, run_load, report, StatementCounter
+from httpx import AsyncClient, ASGITransport
+from sqlalchemy import insert
+from database import Product
+from main import app
+
+
+
+async def main(users: int, requests: int, concurrency: int, products: int):
+	engine = bench_engine(pool_size=concurrency)
+	await recreate_tables(engine)
+	async with engine.begin() as conn:
+		await conn.execute(insert(Product), [{
+		'product_name': f'Product {i}',
+		'product_price': 9.99,
+		'product_size': 1,
+		'product_color': 'black',
+		'product_stock_quantity': 10 ** 9,
+		'product_description': 'Benchmark product',
+		} for i in range(products)])
+	headers = await create_users(engine, users)
+	use_engine(app, engine)
+	counter = StatementCounter(engine)
+	async with AsyncClient(transport=ASGITransport(app=app), base_url='http://bench', timeout=None) as client:
+		async def send(index: int):
+			response = await client.post(
+				'/orders/cart/add',
+				headers=headers[index % users],
+				json={'product_id': 1 + index % products, 'product_quantity': 1}
+				)
+			return response.status_code
+
+		await run_load(send, min(requests, 100), concurrency)
+		counter.count = 0
+		latencies, statuses, elapsed = await run_load(send, requests, concurrency)
+	report('add to cart', latencies, statuses, elapsed)
+	print(f'statements per call (including the get_current_user lookup): {counter.count / requests:.2f}')
+	app.dependency_overrides.clear()
+	await drop_tables(engine)
+	await engine.dispose()
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--users', type=int, default=200)
+	parser.add_argument('--requests', type=int, default=5000)
+	parser.add_argument('--concurrency', type=int, default=20)
+	parser.add_argument('--products', type=int, default=50)
+	args = parser.parse_args()
+	asyncio.run(main(args.users, args.requests, args.concurrency, args.products))
@@ -0,0 +1,89 @@
+"""Compare a burst of synchronous checkouts with the queued checkout mode.
+
+Every user starts with a three-line cart. The sync run posts /orders/checkout; the async run
+posts /orders/checkout/async while a worker pool drains the queue, and reports both the API
+latency and the time until every job has finished. Tables in BENCH_DATABASE_URL (falls back
+to TEST_DATABASE_URL) are recreated for each run.
+
+	python benchmarks/bench_async_checkout.py --users 1000 --concurrency 50 --workers 2
+"""
+import argparse
+import asyncio
+import time
+
+from common import bench_engine, recreate_tables, drop_tables, use_engine, create_users, run_load, report
+from httpx import AsyncClient, ASGITransport
+from sqlalchemy import insert, select, update, func
+from database import Product, Order, OrderItem, CheckoutJob
+from checkout import run_checkout_worker
+from main import app
+
+
+
+async def prepare(engine, users: int):
+	await recreate_tables(engine)
+	async with engine.begin() as conn:
+		await conn.execute(insert(Product), [{
+		'product_name': f'Product {i}',
+		'product_price': 5.0,
+		'product_size': 1,
+		'product_color': 'black',
+		'product_stock_quantity': 10 ** 9,
+		'product_description': 'Benchmark product',
+		} for i in range(3)])
+	headers = await create_users(engine, users, balance=10 ** 6)
+	async with engine.begin() as conn:
+		order_ids = (await conn.execute(select(Order.order_id))).scalars().all()
+		await conn.execute(insert(OrderItem), [
+			{'order_id': order_id, 'product_id': product_id, 'product_quantity': 1, 'order_items_price_now': 5.0}
+			for order_id in order_ids for product_id in (1, 2, 3)
+			])
+		await conn.execute(update(Order).values(order_amount=15.0))
+	return headers
+
+
+
+async def run(mode: str, users: int, concurrency: int, workers: int, batch_size: int):
+	engine = bench_engine(pool_size=concurrency + workers)
+	headers = await prepare(engine, users)
+	session_factory = use_engine(app, engine)
+	path = '/orders/checkout' if mode == 'sync' else '/orders/checkout/async'
+	pool = [asyncio.create_task(run_checkout_worker(session_factory, batch_size, 0.05)) for _ in range(workers if mode == 'async' else 0)]
+	async with AsyncClient(transport=ASGITransport(app=app), base_url='http://bench', timeout=None) as client:
+		async def send(index: int):
+			response = await client.post(path, headers=headers[index])
+			return response.status_code
+
+		start = time.perf_counter()
+		latencies, statuses, elapsed = await run_load(send, users, concurrency)
+		report(f'{mode} checkout API', latencies, statuses, elapsed)
+		if pool:
+			async with session_factory() as db:
+				while (await db.execute(select(func.count()).filter(CheckoutJob.job_status == 'queued'))).scalar_one():
+					await db.rollback()
+					await asyncio.sleep(0.05)
+				completed = (await db.execute(select(func.count()).filter(CheckoutJob.job_status == 'completed'))).scalar_one()
+			print(f'async checkout: {completed} jobs completed {time.perf_counter() - start:.2f}s after the burst started')
+	for task in pool:
+		task.cancel()
+	app.dependency_overrides.clear()
+	await drop_tables(engine)
+	await engine.dispose()
+
+
+
+async def main(args):
+	for mode in ('sync', 'async') if args.mode == 'both' else (args.mode,):
+		await run(mode, args.users, args.concurrency, args.workers, args.batch_size)
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--mode', choices=['sync', 'async', 'both'], default='both')
+	parser.add_argument('--users', type=int, default=1000)
+	parser.add_argument('--concurrency', type=int, default=50)
+	parser.add_argument('--workers', type=int, default=2)
+	parser.add_argument('--batch-size', type=int, default=20)
+	args = parser.parse_args()
+	asyncio.run(main(args))
@@ -0,0 +1,113 @@
+"""Compare ranked full-text search against ILIKE scans on a large products table.
+
+Runs against BENCH_DATABASE_URL (falls back to TEST_DATABASE_URL); the products
+tables there are recreated, so point it at a scratch database.
+
+	python benchmarks/bench_full_text_search.py --rows 1000000
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from dotenv import load_dotenv
+from sqlalchemy import select, func, or_, text, literal_column
+from sqlalchemy.ext.asyncio import create_async_engine
+from database import Base, Product, PRODUCT_SEARCH_CONFIG
+
+
+
+load_dotenv()
+BENCH_DATABASE_URL = os.getenv('BENCH_DATABASE_URL', os.getenv('TEST_DATABASE_URL')).replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+SEED_PRODUCTS = text("""
+	INSERT INTO products (product_name, product_price, product_description, product_stock_quantity, product_size, product_color)
+	SELECT
+		(ARRAY['classic', 'slim', 'vintage', 'sport', 'winter', 'summer', 'travel'])[1 + i % 7] || ' ' ||
+		(ARRAY['jacket', 'shirt', 'sneakers', 'backpack', 'scarf', 'hoodie', 'jeans', 'boots', 'cap', 'dress', 'gloves', 'belt', 'socks'])[1 + (i * 7) % 13],
+		round((random() * 500)::numeric, 2),
+		'Model ' || substr(md5(i::text), 1, 8) || ' made of ' ||
+		(ARRAY['cotton', 'wool', 'leather', 'denim', 'linen', 'silk', 'nylon', 'fleece', 'cashmere', 'suede', 'canvas'])[1 + (i * 3) % 11] ||
+		' for everyday wear',
+		(random() * 100)::int,
+		1 + i % 12,
+		(ARRAY['red', 'blue', 'green', 'black', 'white', 'grey'])[1 + i % 6]
+	FROM generate_series(1, :rows) AS i
+""")
+
+
+
+def ilike_query(term: str, limit: int):
+	pattern = f'%{term}%'
+	return (
+		select(Product.product_id)
+		.filter(or_(Product.product_name.ilike(pattern), Product.product_description.ilike(pattern)))
+		.order_by(Product.product_id)
+		.limit(limit)
+		)
+
+
+def full_text_query(term: str, limit: int):
+	ts_query = func.websearch_to_tsquery(literal_column(f"'{PRODUCT_SEARCH_CONFIG}'::regconfig"), term)
+	return (
+		select(Product.product_id)
+		.filter(Product.product_search.op('@@')(ts_query))
+		.order_by(func.ts_rank_cd(Product.product_search, ts_query).desc(), Product.product_id)
+		.limit(limit)
+		)
+
+
+
+async def timed(conn, query, repeats: int):
+	await conn.execute(query)
+	timings = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		await conn.execute(query)
+		timings.append((time.perf_counter() - start) * 1000)
+	return statistics.median(timings)
+
+
+
+async def main(rows: int, repeats: int, limit: int):
+	engine = create_async_engine(BENCH_DATABASE_URL, echo=False)
+	async with engine.begin() as conn:
+		await conn.run_sync(Base.metadata.drop_all)
+		await conn.run_sync(Base.metadata.create_all)
+		start = time.perf_counter()
+		await conn.execute(SEED_PRODUCTS, {'rows': rows})
+		print(f'seeded {rows} products in {time.perf_counter() - start:.1f}s')
+	async with engine.connect() as conn:
+		await conn.execution_options(isolation_level='AUTOCOMMIT')
+		# Flushes the GIN pending list built up by the bulk insert, as autovacuum would.
+		await conn.execute(text('VACUUM ANALYZE products'))
+		sample = (await conn.execute(select(Product.product_description).limit(1))).scalar_one()
+		terms = {
+		'common word (1/13 of rows)': 'sneakers',
+		'two words': 'wool scarf',
+		'rare token (1 row)': sample.split()[1],
+		'no match': 'spaceship',
+		}
+		print(f'{"query":<28}{"ILIKE ms":>12}{"full text ms":>16}')
+		for label, term in terms.items():
+			ilike_term = term.split()[0]
+			ilike_ms = await timed(conn, ilike_query(ilike_term, limit), repeats)
+			full_text_ms = await timed(conn, full_text_query(term, limit), repeats)
+			print(f'{label:<28}{ilike_ms:>12.1f}{full_text_ms:>16.1f}')
+	async with engine.begin() as conn:
+		await conn.run_sync(Base.metadata.drop_all)
+	await engine.dispose()
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--rows', type=int, default=1_000_000)
+	parser.add_argument('--repeats', type=int, default=5)
+	parser.add_argument('--limit', type=int, default=20)
+	args = parser.parse_args()
+	asyncio.run(main(args.rows, args.repeats, args.limit))
@@ -0,0 +1,77 @@
+"""Compare checkout throughput on a single hot product with and without sharded stock.
+
+Every user starts with a one-line cart of the same product and all of them check out at
+once. Tables in BENCH_DATABASE_URL (falls back to TEST_DATABASE_URL) are recreated for
+each run.
+
+	python benchmarks/bench_hot_product.py --users 2000 --concurrency 50 --shards 16
+"""
+import argparse
+import asyncio
+
+from common import bench_engine, recreate_tables, drop_tables, use_engine, create_users, run_load, report
+from httpx import AsyncClient, ASGITransport
+from sqlalchemy import insert, select, update
+from database import Product, Order, OrderItem
+from stock_shards import set_stock_shards
+from main import app
+
+
+
+async def prepare(engine, users: int, shards: int):
+	await recreate_tables(engine)
+	async with engine.begin() as conn:
+		await conn.execute(insert(Product), [{
+		'product_name': 'Hot product',
+		'product_price': 5.0,
+		'product_size': 1,
+		'product_color': 'black',
+		'product_stock_quantity': 10 ** 9,
+		'product_description': 'Benchmark product',
+		}])
+	headers = await create_users(engine, users, balance=10 ** 6)
+	async with engine.begin() as conn:
+		order_ids = (await conn.execute(select(Order.order_id))).scalars().all()
+		await conn.execute(insert(OrderItem), [
+			{'order_id': order_id, 'product_id': 1, 'product_quantity': 1, 'order_items_price_now': 5.0}
+			for order_id in order_ids
+			])
+		await conn.execute(update(Order).values(order_amount=5.0))
+	return headers
+
+
+
+async def run(shards: int, users: int, concurrency: int):
+	engine = bench_engine(pool_size=concurrency)
+	headers = await prepare(engine, users, shards)
+	session_factory = use_engine(app, engine)
+	if shards:
+		async with session_factory() as db:
+			await set_stock_shards(db, 1, shards)
+			await db.commit()
+	async with AsyncClient(transport=ASGITransport(app=app), base_url='http://bench', timeout=None) as client:
+		async def send(index: int):
+			response = await client.post('/orders/checkout', headers=headers[index])
+			return response.status_code
+
+		latencies, statuses, elapsed = await run_load(send, users, concurrency)
+		report(f'checkout, {shards} shards' if shards else 'checkout, unsharded', latencies, statuses, elapsed)
+	app.dependency_overrides.clear()
+	await drop_tables(engine)
+	await engine.dispose()
+
+
+
+async def main(args):
+	await run(0, args.users, args.concurrency)
+	await run(args.shards, args.users, args.concurrency)
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--users', type=int, default=2000)
+	parser.add_argument('--concurrency', type=int, default=50)
+	parser.add_argument('--shards', type=int, default=16)
+	args = parser.parse_args()
+	asyncio.run(main(args))
@@ -0,0 +1,99 @@
+"""Measure catalog latency while a storm of logins hashes passwords.
+
+A probe requests GET /products/all back to back while the logins run, once with bcrypt
+called inline on the event loop (the old behaviour) and once on the password hashing pool.
+Tables in BENCH_DATABASE_URL (falls back to TEST_DATABASE_URL) are recreated for each run.
+
+	python benchmarks/bench_login_storm.py --logins 200 --concurrency 20
+"""
+import argparse
+import asyncio
+import time
+
+from common import bench_engine, recreate_tables, drop_tables, use_engine, run_load, report
+from httpx import AsyncClient, ASGITransport
+from sqlalchemy import insert
+from database import User, Product
+from cache import catalog_cache
+from main import app
+import security
+
+
+PASSWORD = 'storm-password'
+
+
+
+class InlineHasher:
+	async def run(self, function, *args):
+		return function(*args)
+
+
+
+async def prepare(engine, users: int):
+	await recreate_tables(engine)
+	hashed_password = security.pwd_context.hash(PASSWORD)
+	async with engine.begin() as conn:
+		await conn.execute(insert(User), [
+			{'email': f'storm{i}@example.com', 'hashed_password': hashed_password, 'role': 'user', 'balance': 0, 'bonus_points': 0}
+			for i in range(users)
+			])
+		await conn.execute(insert(Product), [{
+		'product_name': f'Product {i}',
+		'product_price': 5.0,
+		'product_size': 1,
+		'product_color': 'black',
+		'product_stock_quantity': 10,
+		'product_description': 'Benchmark product',
+		} for i in range(20)])
+
+
+
+async def run(mode: str, logins: int, concurrency: int):
+	engine = bench_engine(pool_size=concurrency + 1)
+	await prepare(engine, logins)
+	use_engine(app, engine)
+	catalog_cache.clear()
+	security.password_hasher = InlineHasher() if mode == 'inline' else security.PasswordHasher()
+	async with AsyncClient(transport=ASGITransport(app=app), base_url='http://bench', timeout=None) as client:
+		probes = []
+		storm_done = asyncio.Event()
+
+		async def probe():
+			while not storm_done.is_set():
+				start = time.perf_counter()
+				response = await client.get('/products/all', params={'limit': 20})
+				assert response.status_code == 200
+				probes.append((time.perf_counter() - start) * 1000)
+				await asyncio.sleep(0.01)
+
+		async def send(index: int):
+			response = await client.post('/users/login', data={'username': f'storm{index}@example.com', 'password': PASSWORD})
+			return response.status_code
+
+		probe_task = asyncio.create_task(probe())
+		latencies, statuses, elapsed = await run_load(send, logins, concurrency)
+		storm_done.set()
+		await probe_task
+		report(f'{mode} logins', latencies, statuses, elapsed)
+		report(f'{mode} catalog probe', probes, {200: len(probes)}, elapsed)
+		if mode == 'pool':
+			print(f'pool stats: {security.password_hasher.stats()}')
+	app.dependency_overrides.clear()
+	await drop_tables(engine)
+	await engine.dispose()
+
+
+
+async def main(args):
+	for mode in ('inline', 'pool') if args.mode == 'both' else (args.mode,):
+		await run(mode, args.logins, args.concurrency)
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--mode', choices=['inline', 'pool', 'both'], default='both')
+	parser.add_argument('--logins', type=int, default=200)
+	parser.add_argument('--concurrency', type=int, default=20)
+	args = parser.parse_args()
+	asyncio.run(main(args))
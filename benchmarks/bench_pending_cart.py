@@ -0,0 +1,98 @@
+"""Compare pending-cart lookups on a large orders table under different indexes.
+
+Runs against BENCH_DATABASE_URL (falls back to TEST_DATABASE_URL); the tables there
+are recreated, so point it at a scratch database.
+
+	python benchmarks/bench_pending_cart.py --orders 1000000 --users 100000
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from common import bench_engine, recreate_tables, drop_tables, percentile
+from sqlalchemy import text, func, select
+from checkout import pending_cart
+from database import Order
+
+
+SEED_USERS = text("""
+	INSERT INTO users (email, hashed_password, role, balance, bonus_points)
+	SELECT 'bench' || i || '@example.com', '-', 'user', 0, 0
+	FROM generate_series(1, :users) AS i
+""")
+
+# Every user gets one pending cart; the rest of the rows are completed orders spread evenly.
+SEED_ORDERS = text("""
+	INSERT INTO orders (user_id, order_status, order_amount, order_time_info)
+	SELECT
+		1 + i % :users,
+		CASE WHEN i <= :users THEN 'pending' ELSE 'completed' END,
+		round((random() * 500)::numeric, 2),
+		now() - (i || ' seconds')::interval
+	FROM generate_series(1, :orders) AS i
+""")
+
+INDEXES = {
+	'uq_orders_user_pending': "CREATE UNIQUE INDEX uq_orders_user_pending ON orders (user_id) WHERE order_status = 'pending'",
+	'ix_orders_user_status_time': 'CREATE INDEX ix_orders_user_status_time ON orders (user_id, order_status, order_time_info, order_id)',
+	}
+
+SETUPS = {
+	'no index': [],
+	'history index only': ['ix_orders_user_status_time'],
+	'partial unique index': ['uq_orders_user_pending'],
+	}
+
+
+
+async def timed_lookups(conn, user_ids: list[int]):
+	timings = []
+	for user_id in user_ids:
+		start = time.perf_counter()
+		result = await conn.execute(pending_cart(user_id, Order.order_id))
+		result.scalar_one()
+		timings.append((time.perf_counter() - start) * 1000)
+	return timings
+
+
+
+async def main(orders: int, users: int, lookups: int):
+	engine = bench_engine(pool_size=1)
+	await recreate_tables(engine)
+	async with engine.begin() as conn:
+		start = time.perf_counter()
+		await conn.execute(SEED_USERS, {'users': users})
+		await conn.execute(SEED_ORDERS, {'users': users, 'orders': orders})
+		print(f'seeded {users} users and {orders} orders in {time.perf_counter() - start:.1f}s')
+	user_ids = [random.randint(1, users) for _ in range(lookups)]
+	print(f'{"setup":<24}{"p50 ms":>10}{"p99 ms":>10}{"index size":>14}')
+	async with engine.connect() as conn:
+		await conn.execution_options(isolation_level='AUTOCOMMIT')
+		for label, indexes in SETUPS.items():
+			for name in INDEXES:
+				await conn.execute(text(f'DROP INDEX IF EXISTS {name}'))
+			for name in indexes:
+				await conn.execute(text(INDEXES[name]))
+			await conn.execute(text('VACUUM ANALYZE orders'))
+			size = 0
+			for name in indexes:
+				size += (await conn.execute(select(func.pg_relation_size(name)))).scalar_one()
+			# The unindexed setup scans the whole table per lookup, so it gets fewer of them.
+			sample = user_ids if indexes else user_ids[:max(1, lookups // 100)]
+			await timed_lookups(conn, sample[:10])
+			timings = await timed_lookups(conn, sample)
+			print(f'{label:<24}{statistics.median(timings):>10.3f}{percentile(timings, 0.99):>10.3f}{size / 2**20:>11.1f} MB')
+	await drop_tables(engine)
+	await engine.dispose()
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--orders', type=int, default=1_000_000)
+	parser.add_argument('--users', type=int, default=100_000)
+	parser.add_argument('--lookups', type=int, default=2000)
+	args = parser.parse_args()
+	asyncio.run(main(args.orders, args.users, args.lookups))
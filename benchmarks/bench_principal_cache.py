@@ -0,0 +1,58 @@
+"""Compare authenticated reads with and without the principal cache.
+
+Every user requests GET /users/me and GET /orders/get repeatedly; the uncached run expires
+cache entries immediately so get_current_user queries users on each request. Tables in
+BENCH_DATABASE_URL (falls back to TEST_DATABASE_URL) are recreated for each run.
+
+	python benchmarks/bench_principal_cache.py --users 500 --requests 4000 --concurrency 50
+"""
+import argparse
+import asyncio
+
+from common import bench_engine, recreate_tables, drop_tables, use_engine, create_users, run_load, report, StatementCounter
+from httpx import AsyncClient, ASGITransport
+from cache import principal_cache, cart_cache
+from main import app
+
+
+PATHS = ('/users/me', '/orders/get')
+
+
+
+async def run(cached: bool, users: int, requests: int, concurrency: int):
+	engine = bench_engine(pool_size=concurrency)
+	await recreate_tables(engine)
+	headers = await create_users(engine, users)
+	use_engine(app, engine)
+	principal_cache.clear()
+	cart_cache.clear()
+	principal_cache.store.ttl = 30 if cached else 0
+	counter = StatementCounter(engine)
+	async with AsyncClient(transport=ASGITransport(app=app), base_url='http://bench', timeout=None) as client:
+		async def send(index: int):
+			response = await client.get(PATHS[index % 2], headers=headers[index // 2 % users])
+			return response.status_code
+
+		latencies, statuses, elapsed = await run_load(send, requests, concurrency)
+		report('principal cache' if cached else 'no principal cache', latencies, statuses, elapsed)
+		stats = principal_cache.stats()
+		print(f"  {counter.count / requests:.2f} statements/request, hit ratio {stats['hit_ratio']:.3f}, {stats['size']} entries, {stats['memory_bytes'] / 1024:.0f} KiB")
+	app.dependency_overrides.clear()
+	await drop_tables(engine)
+	await engine.dispose()
+
+
+
+async def main(args):
+	for cached in (False, True):
+		await run(cached, args.users, args.requests, args.concurrency)
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--users', type=int, default=500)
+	parser.add_argument('--requests', type=int, default=4000)
+	parser.add_argument('--concurrency', type=int, default=50)
+	args = parser.parse_args()
+	asyncio.run(main(args))
@@ -0,0 +1,81 @@
+"""Measure bulk product import throughput through POST /products/admin/import.
+
+Runs the app in-process against BENCH_DATABASE_URL (falls back to TEST_DATABASE_URL);
+the tables there are recreated, so point it at a scratch database.
+
+	python benchmarks/bench_product_import.py --rows 200000 --format csv
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from dotenv import load_dotenv
+from httpx import AsyncClient, ASGITransport
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from database import Base, User, get_db
+from security import get_current_admin_user
+from main import app
+
+
+
+load_dotenv()
+BENCH_DATABASE_URL = os.getenv('BENCH_DATABASE_URL', os.getenv('TEST_DATABASE_URL')).replace("postgresql://", "postgresql+asyncpg://", 1)
+COLUMNS = ['product_name', 'product_price', 'product_size', 'product_color', 'product_stock_quantity', 'product_description']
+
+
+
+def build_body(rows: int, format: str):
+	if format == 'csv':
+		lines = [','.join(COLUMNS)]
+		lines += [f'Product {i},{i % 500 + 0.99},{i % 12},Color {i % 6},{i % 100},"Description of product {i}"' for i in range(rows)]
+	else:
+		lines = [json.dumps({
+		'product_name': f'Product {i}',
+		'product_price': i % 500 + 0.99,
+		'product_size': i % 12,
+		'product_color': f'Color {i % 6}',
+		'product_stock_quantity': i % 100,
+		'product_description': f'Description of product {i}',
+		}) for i in range(rows)]
+	return ('\n'.join(lines) + '\n').encode()
+
+
+
+async def main(rows: int, format: str):
+	engine = create_async_engine(BENCH_DATABASE_URL, echo=False)
+	async with engine.begin() as conn:
+		await conn.run_sync(Base.metadata.drop_all)
+		await conn.run_sync(Base.metadata.create_all)
+	session_factory = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+	async def override_get_db():
+		async with session_factory() as db:
+			yield db
+
+	app.dependency_overrides[get_db] = override_get_db
+	app.dependency_overrides[get_current_admin_user] = lambda: User(id=0, email='bench@example.com', role='admin')
+	body = build_body(rows, format)
+	content_type = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+	async with AsyncClient(transport=ASGITransport(app=app), base_url='http://bench', timeout=None) as client:
+		start = time.perf_counter()
+		response = await client.post('/products/admin/import', content=body, headers={'Content-Type': content_type})
+		elapsed = time.perf_counter() - start
+	report = response.json()
+	print(f"{format}: imported {report['imported']} rows ({report['failed']} failed) in {elapsed:.2f}s -> {report['imported'] / elapsed:,.0f} rows/s")
+	app.dependency_overrides.clear()
+	async with engine.begin() as conn:
+		await conn.run_sync(Base.metadata.drop_all)
+	await engine.dispose()
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--rows', type=int, default=200_000)
+	parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+	args = parser.parse_args()
+	asyncio.run(main(args.rows, args.format))
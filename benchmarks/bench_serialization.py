@@ -0,0 +1,79 @@
+"""Compare FastAPI's default response path with the orjson row path for list endpoints.
+
+The default path validates ORM objects into list[ProductResponse], runs jsonable_encoder
+and json.dumps (what get_all_products did before); the row path validates plain column
+rows through a precompiled TypeAdapter and encodes them with orjson. No database needed.
+
+	python benchmarks/bench_serialization.py --rows 10000 100000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+from database import Product, ProductResponse
+from serialization import product_rows, validate_rows, rows_response
+
+
+
+def build_rows(count: int):
+	return [{
+	'product_id': i,
+	'product_name': f'Product {i}',
+	'product_price': i % 500 + 0.99,
+	'product_size': i % 12,
+	'product_color': f'Color {i % 6}',
+	'product_stock_quantity': i % 100,
+	'product_description': f'Description of product {i}',
+	} for i in range(1, count + 1)]
+
+
+
+async def default_path(field, products):
+	content = await serialize_response(field=field, response_content=products)
+	return JSONResponse(content).body
+
+
+
+def row_path(rows):
+	return rows_response(validate_rows(product_rows, rows)).body
+
+
+
+async def best_of(repeats: int, run):
+	timings = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		await run()
+		timings.append(time.perf_counter() - start)
+	return min(timings)
+
+
+
+async def main(sizes: list[int], repeats: int):
+	field = create_model_field('Response', list[ProductResponse], mode='serialization')
+	print(f'{"rows":>8}{"default rows/s":>18}{"orjson rows/s":>18}{"speedup":>10}')
+	for size in sizes:
+		rows = build_rows(size)
+		products = [Product(**row) for row in rows]
+		async def run_default():
+			await default_path(field, products)
+		async def run_rows():
+			row_path(rows)
+		default_seconds = await best_of(repeats, run_default)
+		rows_seconds = await best_of(repeats, run_rows)
+		print(f'{size:>8}{size / default_seconds:>18,.0f}{size / rows_seconds:>18,.0f}{default_seconds / rows_seconds:>9.1f}x')
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000])
+	parser.add_argument('--repeats', type=int, default=5)
+	args = parser.parse_args()
+	asyncio.run(main(args.rows, args.repeats))
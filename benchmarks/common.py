@@ -0,0 +1,111 @@
+"""Shared helpers for the in-process load benchmarks."""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from dotenv import load_dotenv
+from sqlalchemy import insert, event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from database import Base, User, Order, get_db
+from security import create_access_token
+
+
+
+load_dotenv()
+BENCH_DATABASE_URL = os.getenv('BENCH_DATABASE_URL', os.getenv('TEST_DATABASE_URL')).replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+
+def bench_engine(pool_size: int = 20):
+	return create_async_engine(BENCH_DATABASE_URL, echo=False, pool_size=pool_size, max_overflow=0)
+
+
+
+async def recreate_tables(engine):
+	async with engine.begin() as conn:
+		await conn.run_sync(Base.metadata.drop_all)
+		await conn.run_sync(Base.metadata.create_all)
+
+
+
+async def drop_tables(engine):
+	async with engine.begin() as conn:
+		await conn.run_sync(Base.metadata.drop_all)
+
+
+
+def use_engine(app, engine):
+	session_factory = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+	async def override_get_db():
+		async with session_factory() as db:
+			yield db
+
+	app.dependency_overrides[get_db] = override_get_db
+	return session_factory
+
+
+
+class StatementCounter:
+	def __init__(self, engine):
+		self.count = 0
+		event.listen(engine.sync_engine, 'before_cursor_execute', self._count)
+
+
+	def _count(self, *args):
+		self.count += 1
+
+
+
+async def create_users(engine, count: int, balance: float = 0):
+	# Users are inserted directly with a placeholder hash: the benchmarks only need tokens.
+	async with engine.begin() as conn:
+		result = await conn.execute(
+			insert(User).returning(User.id, User.email),
+			[{'email': f'bench{i}@example.com', 'hashed_password': '-', 'role': 'user', 'balance': balance, 'bonus_points': 0} for i in range(count)]
+			)
+		users = result.all()
+		await conn.execute(insert(Order), [{'user_id': user_id, 'order_status': 'pending', 'order_amount': 0} for user_id, _ in users])
+	return [
+		{'Authorization': f"Bearer {await create_access_token({'sub': email})}"}
+		for _, email in users
+		]
+
+
+
+async def run_load(send, total: int, concurrency: int):
+	latencies = []
+	statuses = {}
+	queue = asyncio.Queue()
+	for index in range(total):
+		queue.put_nowait(index)
+
+	async def worker():
+		while not queue.empty():
+			index = queue.get_nowait()
+			start = time.perf_counter()
+			status_code = await send(index)
+			latencies.append((time.perf_counter() - start) * 1000)
+			statuses[status_code] = statuses.get(status_code, 0) + 1
+
+	start = time.perf_counter()
+	await asyncio.gather(*(worker() for _ in range(concurrency)))
+	return latencies, statuses, time.perf_counter() - start
+
+
+
+def percentile(values: list[float], fraction: float):
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+
+def report(label: str, latencies: list[float], statuses: dict, elapsed: float):
+	print(
+		f'{label}: {len(latencies)} requests in {elapsed:.2f}s ({len(latencies) / elapsed:,.0f} req/s), '
+		f'p50 {statistics.median(latencies):.1f} ms, p95 {percentile(latencies, 0.95):.1f} ms, '
+		f'p99 {percentile(latencies, 0.99):.1f} ms, statuses {statuses}'
+		)
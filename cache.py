@@ -0,0 +1,440 @@
+from collections import OrderedDict, defaultdict
+from abc import ABC, abstractmethod
+from dotenv import load_dotenv
+import asyncpg
+import asyncio
+import logging
+import secrets
+import orjson
+import time
+import sys
+import os
+
+
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+CATALOG_CACHE_TTL = float(os.getenv('CATALOG_CACHE_TTL', 60))
+CATALOG_CACHE_MAX_SIZE = int(os.getenv('CATALOG_CACHE_MAX_SIZE', 1024))
+CART_CACHE_TTL = float(os.getenv('CART_CACHE_TTL', 300))
+CART_CACHE_MAX_SIZE = int(os.getenv('CART_CACHE_MAX_SIZE', 10000))
+CART_CACHE_BACKEND = os.getenv('CART_CACHE_BACKEND', 'local')
+PRINCIPAL_CACHE_TTL = float(os.getenv('PRINCIPAL_CACHE_TTL', 30))
+PRINCIPAL_CACHE_MAX_SIZE = int(os.getenv('PRINCIPAL_CACHE_MAX_SIZE', 10000))
+CACHE_BROKER = os.getenv('CACHE_BROKER', 'local')
+CACHE_BROKER_RECONNECT_DELAY = float(os.getenv('CACHE_BROKER_RECONNECT_DELAY', 1))
+
+
+
+class LRUCache:
+	def __init__(self, max_size: int, ttl: float):
+		self.max_size = max_size
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		# Counter for owners whose reads must notice a delete that happened meanwhile; on a
+		# cache server this would be a key bumped with INCR.
+		self.generation = 0
+		self._entries = OrderedDict()
+
+
+	def get(self, key):
+		entry = self._entries.get(key)
+		if entry is None or entry[0] < time.monotonic():
+			if entry is not None:
+				del self._entries[key]
+			self.misses += 1
+			return None
+		self._entries.move_to_end(key)
+		self.hits += 1
+		return entry[1]
+
+
+	def peek(self, key):
+		entry = self._entries.get(key)
+		return entry[1] if entry is not None else None
+
+
+	def add(self, key, value):
+		entry = self._entries.get(key)
+		if entry is not None and entry[0] >= time.monotonic():
+			return False
+		self.set(key, value)
+		return True
+
+
+	def set(self, key, value):
+		self._entries[key] = (time.monotonic() + self.ttl, value)
+		self._entries.move_to_end(key)
+		while len(self._entries) > self.max_size:
+			self._entries.popitem(last=False)
+
+
+	def delete(self, key):
+		self._entries.pop(key, None)
+
+
+	def keys(self):
+		return list(self._entries.keys())
+
+
+	def clear(self):
+		self._entries.clear()
+		self.hits = 0
+		self.misses = 0
+
+
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {
+		'hits': self.hits,
+		'misses': self.misses,
+		'hit_ratio': self.hits / lookups if lookups else 0.0,
+		'size': len(self._entries),
+		'max_size': self.max_size,
+		}
+
+
+
+class InvalidationBackend(ABC):
+	# What the caches publish their invalidations through: one channel of a broker, already
+	# bound, so a cache only ever sees its own messages.
+	@abstractmethod
+	def publish(self, message: dict):
+		pass
+
+
+	@abstractmethod
+	def subscribe(self, handler):
+		pass
+
+
+
+class LocalBroker:
+	# Delivers each message to every subscriber in this process, including the publisher's own.
+	# It never reaches another process, so with more than one worker process the caches go stale
+	# until their TTL; use PostgresBroker (CACHE_BROKER=postgres) there.
+	def __init__(self):
+		self._subscribers = defaultdict(list)
+
+
+	def publish(self, channel: str, message: dict):
+		for handler in self._subscribers[channel]:
+			handler(message)
+
+
+	def subscribe(self, channel: str, handler):
+		self._subscribers[channel].append(handler)
+
+
+	def start(self):
+		return []
+
+
+	async def flush(self):
+		pass
+
+
+
+class PostgresBroker(LocalBroker):
+	# Carries messages between worker processes over Postgres LISTEN/NOTIFY. A message reaches
+	# this process's subscribers right away and the other processes once the background task
+	# started by start() has sent it; each process skips the notifications it sent itself.
+	# Notifications sent while a process is reconnecting are lost to it, so for that window
+	# its cache entries are only bounded by their TTL.
+	def __init__(self, dsn: str):
+		super().__init__()
+		self.dsn = dsn
+		self.sender = secrets.token_hex(8)
+		self.listening = asyncio.Event()
+		self._outbox = asyncio.Queue()
+
+
+	def publish(self, channel: str, message: dict):
+		super().publish(channel, message)
+		self._outbox.put_nowait((f'cache_{channel}', orjson.dumps({'sender': self.sender, 'message': message}).decode()))
+
+
+	def start(self):
+		return [asyncio.create_task(self.run())]
+
+
+	async def flush(self):
+		await self._outbox.join()
+
+
+	async def run(self, reconnect_delay: float = CACHE_BROKER_RECONNECT_DELAY):
+		while True:
+			try:
+				connection = await asyncpg.connect(self.dsn)
+				try:
+					for channel in list(self._subscribers):
+						await connection.add_listener(f'cache_{channel}', self._receive)
+					self.listening.set()
+					while True:
+						notification = await self._outbox.get()
+						try:
+							await connection.execute('SELECT pg_notify($1, $2)', *notification)
+						except Exception:
+							self._outbox.put_nowait(notification)
+							raise
+						finally:
+							self._outbox.task_done()
+				finally:
+					self.listening.clear()
+					await connection.close()
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				logger.exception(f'Cache broker connection failed: {str(e)}')
+			await asyncio.sleep(reconnect_delay)
+
+
+	def _receive(self, connection, pid: int, channel: str, payload: str):
+		notification = orjson.loads(payload)
+		if notification['sender'] != self.sender:
+			super().publish(channel.removeprefix('cache_'), notification['message'])
+
+
+
+def build_broker(kind: str = CACHE_BROKER):
+	if kind == 'postgres':
+		return PostgresBroker(os.getenv('DATABASE_URL'))
+	return LocalBroker()
+
+
+
+class BrokerInvalidationBackend(InvalidationBackend):
+	def __init__(self, broker: LocalBroker, channel: str):
+		self.broker = broker
+		self.channel = channel
+
+
+	def publish(self, message: dict):
+		self.broker.publish(self.channel, message)
+
+
+	def subscribe(self, handler):
+		self.broker.subscribe(self.channel, handler)
+
+
+
+class CatalogCache:
+	def __init__(self, backend: InvalidationBackend, max_size: int = CATALOG_CACHE_MAX_SIZE, ttl: float = CATALOG_CACHE_TTL):
+		self.entries = LRUCache(max_size, ttl)
+		self.backend = backend
+		# Bumped by every invalidation; fills that started before one are dropped.
+		self.version = 0
+		# (expiry, value) copy of the catalog_version sequence for the ETags. Every invalidation
+		# drops it and the next conditional GET reads it again; the TTL bounds it like the entries
+		# if an invalidation is lost.
+		self.shared_version = None
+		backend.subscribe(self._apply_invalidation)
+
+
+	def get_product(self, product_id: int):
+		return self.entries.get(('product', product_id))
+
+
+	def set_product(self, product_id: int, product: dict, version: int):
+		# version is read before the query; a read that raced an invalidation is not cached,
+		# as it may hold the rows from before the change.
+		if version == self.version:
+			self.entries.set(('product', product_id), product)
+
+
+	def get_page(self, limit: int, after):
+		return self.entries.get(('page', limit, after))
+
+
+	def set_page(self, limit: int, after, products: list[dict], version: int):
+		if version == self.version:
+			self.entries.set(('page', limit, after), products)
+
+
+	def get_shared_version(self):
+		if self.shared_version is None or self.shared_version[0] < time.monotonic():
+			return None
+		return self.shared_version[1]
+
+
+	def set_shared_version(self, shared_version: int, version: int):
+		if version == self.version:
+			self.shared_version = (time.monotonic() + self.entries.ttl, shared_version)
+
+
+	def invalidate_product(self, product_id: int):
+		self.backend.publish({'product_id': product_id})
+
+
+	def invalidate_all(self):
+		self.backend.publish({'product_id': None})
+
+
+	def clear(self):
+		self.entries.clear()
+		self.shared_version = None
+
+
+	def stats(self):
+		return self.entries.stats()
+
+
+	def _apply_invalidation(self, message: dict):
+		product_id = message['product_id']
+		self.version += 1
+		self.shared_version = None
+		for key in self.entries.keys():
+			if product_id is None or self._covers(key, product_id):
+				self.entries.delete(key)
+
+
+	def _covers(self, key, product_id: int):
+		if key[0] == 'product':
+			return key[1] == product_id
+		_, limit, after = key
+		products = self.entries.peek(key)
+		if products is None or product_id <= (after or 0):
+			return False
+		# A short page is the tail of the catalog, so any new id past its cursor lands on it.
+		return len(products) < limit or product_id <= products[-1]['product_id']
+
+
+
+class CartCache:
+	# Per-user snapshots of the pending cart. Mutations write their result through after they
+	# commit, while a read only fills an empty slot and only if no invalidation landed since it
+	# started, so neither a write-through nor a bare invalidate can be undone by an older read.
+	# With a backend, each worker keeps its own LRU and writes tell the other workers to drop
+	# their copy; without one, the store itself is shared by all workers.
+	def __init__(self, store: LRUCache, backend: InvalidationBackend = None):
+		self.store = store
+		self.backend = backend
+		if backend is not None:
+			backend.subscribe(self._apply_invalidation)
+
+
+	def get(self, user_id: int):
+		return self.store.get(user_id)
+
+
+	@property
+	def generation(self):
+		return self.store.generation
+
+
+	def fill(self, user_id: int, cart: dict, generation: int):
+		if generation != self.store.generation:
+			return
+		self.store.add(user_id, cart)
+
+
+	def set(self, user_id: int, cart: dict):
+		self.invalidate(user_id)
+		self.store.set(user_id, cart)
+
+
+	def invalidate(self, user_id: int):
+		if self.backend is not None:
+			self.backend.publish({'user_id': user_id})
+		else:
+			self.store.generation += 1
+			self.store.delete(user_id)
+
+
+	def invalidate_all(self):
+		if self.backend is not None:
+			self.backend.publish({'user_id': None})
+		else:
+			self._drop_all()
+
+
+	def clear(self):
+		self.store.clear()
+
+
+	def stats(self):
+		return self.store.stats()
+
+
+	def _apply_invalidation(self, message: dict):
+		if message['user_id'] is None:
+			self._drop_all()
+		else:
+			self.store.generation += 1
+			self.store.delete(message['user_id'])
+
+
+	def _drop_all(self):
+		self.store.generation += 1
+		for key in self.store.keys():
+			self.store.delete(key)
+
+
+
+class PrincipalCache:
+	# Snapshots of authenticated users keyed by token subject, so get_current_user can skip its
+	# lookup. Changes to a user are published by user id, which each worker maps back to the
+	# subject it cached. A lookup that raced any invalidation does not fill, so a snapshot read
+	# before a change committed cannot outlive it.
+	def __init__(self, store: LRUCache, backend: InvalidationBackend):
+		self.store = store
+		self.backend = backend
+		self.subjects = {}
+		self.generation = 0
+		backend.subscribe(self._apply_invalidation)
+
+
+	def get(self, subject: str):
+		return self.store.get(subject)
+
+
+	def fill(self, subject: str, user: dict, generation: int):
+		if generation != self.generation:
+			return
+		if len(self.subjects) >= 2 * self.store.max_size:
+			self.subjects = {self.store.peek(key)['id']: key for key in self.store.keys()}
+		self.subjects[user['id']] = subject
+		self.store.add(subject, user)
+
+
+	def invalidate(self, user_id: int):
+		self.backend.publish({'user_id': user_id})
+
+
+	def clear(self):
+		self.store.clear()
+		self.subjects.clear()
+
+
+	def stats(self):
+		memory = sys.getsizeof(self.subjects)
+		for key in self.store.keys():
+			user = self.store.peek(key)
+			memory += sys.getsizeof(key) + sys.getsizeof(user) + sum(sys.getsizeof(value) for value in user.values())
+		return {**self.store.stats(), 'memory_bytes': memory}
+
+
+	def _apply_invalidation(self, message: dict):
+		self.generation += 1
+		subject = self.subjects.pop(message['user_id'], None)
+		if subject is not None:
+			self.store.delete(subject)
+
+
+
+def build_cart_cache(kind: str = CART_CACHE_BACKEND):
+	if kind == 'shared':
+		# Stand-in for a key-value server all workers talk to; as an in-process store it is only
+		# shared by the workers of one process.
+		return CartCache(LRUCache(CART_CACHE_MAX_SIZE, CART_CACHE_TTL))
+	return CartCache(LRUCache(CART_CACHE_MAX_SIZE, CART_CACHE_TTL), BrokerInvalidationBackend(broker, 'carts'))
+
+
+
+broker = build_broker()
+catalog_cache = CatalogCache(BrokerInvalidationBackend(broker, 'catalog'))
+cart_cache = build_cart_cache()
+principal_cache = PrincipalCache(LRUCache(PRINCIPAL_CACHE_MAX_SIZE, PRINCIPAL_CACHE_TTL), BrokerInvalidationBackend(broker, 'principals'))
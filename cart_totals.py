@@ -0,0 +1,86 @@
+from sqlalchemy import select, update, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, Order, OrderItem
+from cache import cart_cache
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+
+
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+ORDER_AMOUNT_CHECK_INTERVAL = float(os.getenv('ORDER_AMOUNT_CHECK_INTERVAL', 3600))
+ORDER_AMOUNT_CHECK_BATCH_SIZE = int(os.getenv('ORDER_AMOUNT_CHECK_BATCH_SIZE', 1000))
+ORDER_AMOUNT_TOLERANCE = 1e-6
+
+
+
+def lines_total():
+	return func.coalesce(func.sum(OrderItem.order_items_price_now * OrderItem.product_quantity), 0.0)
+
+
+
+async def repair_order_amounts(db: AsyncSession, after_order_id: int = 0, batch_size: int = ORDER_AMOUNT_CHECK_BATCH_SIZE):
+	# Cart totals are maintained by deltas, so they are only ever off if something bypassed the
+	# handlers. Only pending carts are checked: a completed order's amount is what was charged.
+	batch = (
+		select(Order.order_id, Order.order_amount)
+		.filter(Order.order_status == 'pending', Order.order_id > after_order_id)
+		.order_by(Order.order_id)
+		.limit(batch_size)
+		.subquery('batch')
+		)
+	result = await db.execute(
+		select(batch.c.order_id, batch.c.order_amount, lines_total())
+		.outerjoin(OrderItem, OrderItem.order_id == batch.c.order_id)
+		.group_by(batch.c.order_id, batch.c.order_amount)
+		.order_by(batch.c.order_id)
+		)
+	rows = result.all()
+	drifted = [order_id for order_id, amount, total in rows if abs((amount or 0) - total) > ORDER_AMOUNT_TOLERANCE]
+	repaired, user_ids = [], []
+	if drifted:
+		# Carts locked by an in-flight mutation are skipped; their totals are recomputed from a
+		# snapshot taken after the lock, so a concurrent delta can never be overwritten.
+		result = await db.execute(select(Order.order_id).filter(Order.order_id.in_(drifted), Order.order_status == 'pending').with_for_update(skip_locked=True))
+		repaired = result.scalars().all()
+		if repaired:
+			result = await db.execute(
+				update(Order)
+				.where(Order.order_id.in_(repaired))
+				.values(order_amount=select(lines_total()).filter(OrderItem.order_id == Order.order_id).scalar_subquery())
+				.returning(Order.user_id)
+				.execution_options(synchronize_session=False)
+				)
+			user_ids = result.scalars().all()
+	await db.commit()
+	for user_id in user_ids:
+		cart_cache.invalidate(user_id)
+	return len(rows), len(repaired), rows[-1].order_id if rows else None
+
+
+
+async def check_order_amounts(db: AsyncSession, batch_size: int = ORDER_AMOUNT_CHECK_BATCH_SIZE):
+	checked, repaired, after_order_id = 0, 0, 0
+	while after_order_id is not None:
+		batch_checked, batch_repaired, after_order_id = await repair_order_amounts(db, after_order_id, batch_size)
+		checked += batch_checked
+		repaired += batch_repaired
+	return {'checked': checked, 'repaired': repaired}
+
+
+
+async def run_order_amount_checker(session_factory=AsyncSessionLocal, interval: float = ORDER_AMOUNT_CHECK_INTERVAL, batch_size: int = ORDER_AMOUNT_CHECK_BATCH_SIZE):
+	while True:
+		await asyncio.sleep(interval)
+		try:
+			async with session_factory() as db:
+				stats = await check_order_amounts(db, batch_size)
+			if stats['repaired']:
+				logger.warning(f"Repaired {stats['repaired']} of {stats['checked']} cart totals")
+		except Exception as e:
+			logger.exception(f'Cart total check failed: {str(e)}')
@@ -0,0 +1,226 @@
+from fastapi import HTTPException
+from sqlalchemy import select, update, func, values, column, literal_column, Integer
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, User, Product, Order, OrderItem, OrderResponse, OrderItemResponse, CheckoutJob
+from exceptions import ProductNotFoundException, InsufficientStockException, CartIsEmptyException, InsufficientFundsException, EmptyCartException
+from reservations import available_quantity
+from stock_shards import take_sharded_stock
+from cache import catalog_cache, cart_cache, principal_cache
+from http_cache import bump_catalog_version
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+
+
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+CHECKOUT_WORKERS = int(os.getenv('CHECKOUT_WORKERS', 2))
+CHECKOUT_BATCH_SIZE = int(os.getenv('CHECKOUT_BATCH_SIZE', 20))
+CHECKOUT_POLL_INTERVAL = float(os.getenv('CHECKOUT_POLL_INTERVAL', 0.2))
+
+order_columns = [getattr(Order, name) for name in OrderResponse.model_fields if name != 'order_for_order_items']
+order_item_columns = [getattr(OrderItem, name) for name in OrderItemResponse.model_fields]
+
+
+
+def pending_cart(user_id: int, *columns):
+	# Served by uq_orders_user_pending, which also guarantees at most one row. The status is
+	# inlined rather than bound: a generic prepared plan cannot match a parameter against the
+	# index predicate and falls back to scanning orders.
+	return select(*(columns or order_columns)).filter(Order.user_id == user_id, Order.order_status == literal_column("'pending'"))
+
+
+
+async def create_pending_cart(db: AsyncSession, user_id: int):
+	# Carts are created on first use and deleted again by the idle-cart sweeper. Returns False
+	# if the user already had one, e.g. because a concurrent request created it first.
+	statement = insert(Order).values(user_id=user_id, order_status='pending')
+	result = await db.execute(statement.on_conflict_do_nothing(index_elements=['user_id'], index_where=Order.order_status == literal_column("'pending'")))
+	return result.rowcount == 1
+
+
+
+def empty_cart(user_id: int):
+	# What GET /orders/get reports before the first add creates the user's cart.
+	return {'order_id': None, 'order_amount': 0, 'order_status': 'pending', 'order_time_info': None, 'user_id': user_id, 'order_for_order_items': []}
+
+
+
+async def cart_response(db: AsyncSession, cart: dict):
+	result = await db.execute(select(*order_item_columns).filter(OrderItem.order_id == cart['order_id']).order_by(OrderItem.order_items_id))
+	return {**cart, 'order_for_order_items': [dict(item) for item in result.mappings()]}
+
+
+
+async def perform_checkout(db: AsyncSession, user_id: int):
+	# Leaves committing (or rolling back) to the caller, so the queue workers can record a
+	# failed job in the same transaction as its rolled-back checkout.
+	# Locks are taken cart first, then its lines, then products in product_id order, then stock
+	# shards, then the user. Cart mutations and the hold sweeper follow the same line-then-product
+	# order, so none of them can deadlock against a checkout, and the sweeper skips lines that
+	# are being checked out.
+	result = await db.execute(pending_cart(user_id).with_for_update())
+	cart = result.mappings().one_or_none()
+	if not cart:
+		raise CartIsEmptyException()
+	result = await db.execute(
+		select(OrderItem.product_id, OrderItem.product_quantity, OrderItem.reserved_until.is_not(None))
+		.filter(OrderItem.order_id == cart['order_id'])
+		.with_for_update()
+		)
+	quantities, held = {}, {}
+	for product_id, quantity, is_held in result:
+		quantities[product_id] = quantity
+		held[product_id] = quantity if is_held else 0
+	if not quantities:
+		raise CartIsEmptyException()
+
+	result = await db.execute(
+		select(Product.product_id, Product.product_stock_quantity, available_quantity())
+		.filter(Product.product_id.in_(quantities), Product.product_stock_shards == 0)
+		.order_by(Product.product_id)
+		.with_for_update()
+		)
+	stock = {product_id: (stock_quantity, available) for product_id, stock_quantity, available in result}
+	sharded = []
+	if len(stock) < len(quantities):
+		# Sharded products are not locked here; their stock is taken from the shards below.
+		result = await db.execute(
+			select(Product.product_id)
+			.filter(Product.product_id.in_(set(quantities) - set(stock)), Product.product_stock_shards > 0)
+			.order_by(Product.product_id)
+			)
+		sharded = result.scalars().all()
+	for product_id, quantity in quantities.items():
+		if product_id in sharded:
+			continue
+		if product_id not in stock:
+			raise ProductNotFoundException()
+		stock_quantity, available = stock[product_id]
+		if quantity > stock_quantity or quantity - held[product_id] > available:
+			raise HTTPException(status_code=400, detail=f'Error, product {product_id} has only {available + held[product_id]} units on our stock at the moment')
+
+	# Held quantity is already counted in the reserved total, so it is converted rather than re-checked.
+	if stock:
+		lines = values(column('product_id', Integer), column('quantity', Integer), column('held', Integer), name='line').data(
+			[(product_id, quantities[product_id], held[product_id]) for product_id in stock]
+			)
+		result = await db.execute(
+			update(Product)
+			.where(
+				Product.product_id == lines.c.product_id,
+				Product.product_stock_quantity >= lines.c.quantity,
+				available_quantity() >= lines.c.quantity - lines.c.held
+				)
+			.values(
+				product_stock_quantity=Product.product_stock_quantity - lines.c.quantity,
+				product_reserved_quantity=Product.product_reserved_quantity - lines.c.held
+				)
+			.returning(Product.product_id)
+			.execution_options(synchronize_session='fetch')
+			)
+		if len(result.all()) < len(stock):
+			raise InsufficientStockException()
+	for product_id in sharded:
+		if not await take_sharded_stock(db, product_id, quantities[product_id]):
+			raise InsufficientStockException()
+	await db.execute(
+		update(OrderItem)
+		.filter(OrderItem.order_id == cart['order_id'], OrderItem.reserved_until.is_not(None))
+		.values(reserved_until=None)
+		.execution_options(synchronize_session=False)
+		)
+	result = await db.execute(
+		update(User)
+		.filter(User.id == user_id, User.balance >= cart['order_amount'])
+		.values(balance=User.balance - cart['order_amount'], bonus_points=User.bonus_points + cart['order_amount'] / 90)
+		.returning(User.id)
+		)
+	if result.scalar_one_or_none() is None:
+		raise InsufficientFundsException()
+	result = await db.execute(
+		update(Order)
+		.filter(Order.order_id == cart['order_id'])
+		.values(order_status='completed', order_updated_at=func.localtimestamp())
+		.returning(*order_columns)
+		.execution_options(synchronize_session=False)
+		)
+	return await cart_response(db, dict(result.mappings().one()))
+
+
+
+async def invalidate_checkout(db: AsyncSession, response: dict):
+	# The stock shown in the catalog moved, so its ETags have to change too.
+	await bump_catalog_version(db)
+	cart_cache.invalidate(response['user_id'])
+	principal_cache.invalidate(response['user_id'])
+	for item in response['order_for_order_items']:
+		catalog_cache.invalidate_product(item['product_id'])
+
+
+
+async def process_job(db: AsyncSession):
+	# Claims the oldest queued job with SKIP LOCKED, so parallel workers split the queue
+	# between them. The checkout runs in a savepoint, so a failed one is rolled back while the
+	# job's outcome is still recorded. Returns False if the queue is empty.
+	result = await db.execute(
+		select(CheckoutJob.job_id, CheckoutJob.user_id)
+		.filter(CheckoutJob.job_status == 'queued')
+		.order_by(CheckoutJob.job_id)
+		.limit(1)
+		.with_for_update(skip_locked=True)
+		)
+	job = result.one_or_none()
+	if job is None:
+		await db.commit()
+		return False
+	job_id, user_id = job
+	outcome = {'job_status': 'completed', 'finished_at': func.localtimestamp()}
+	response = None
+	try:
+		async with db.begin_nested():
+			response = await perform_checkout(db, user_id)
+		outcome['order_id'] = response['order_id']
+	except HTTPException as e:
+		outcome.update(job_status='failed', job_error=e.detail)
+	except Exception as e:
+		outcome.update(job_status='failed', job_error=f'DB Error: {str(e)}')
+	await db.execute(update(CheckoutJob).filter(CheckoutJob.job_id == job_id).values(**outcome))
+	await db.commit()
+	if response is not None:
+		await invalidate_checkout(db, response)
+	return True
+
+
+
+async def process_batch(db: AsyncSession, batch_size: int = CHECKOUT_BATCH_SIZE):
+	# Every job commits on its own: row locks outlive a savepoint, so a batch transaction would
+	# keep each checkout's locks until the last job and break the lock order perform_checkout
+	# relies on. If a worker dies mid-job, that job is simply still queued.
+	processed = 0
+	while processed < batch_size and await process_job(db):
+		processed += 1
+	return processed
+
+
+
+async def run_checkout_worker(session_factory=AsyncSessionLocal, batch_size: int = CHECKOUT_BATCH_SIZE, poll_interval: float = CHECKOUT_POLL_INTERVAL):
+	while True:
+		try:
+			async with session_factory() as db:
+				processed = await process_batch(db, batch_size)
+		except Exception as e:
+			logger.exception(f'Checkout batch failed: {str(e)}')
+			processed = 0
+		if processed < batch_size:
+			await asyncio.sleep(poll_interval)
+
+
+
+def start_checkout_workers(count: int = CHECKOUT_WORKERS):
+	return [asyncio.create_task(run_checkout_worker()) for _ in range(count)]
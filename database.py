@@ -1,15 +1,22 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Float, DateTime
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy import Column, Integer, String, Sequence, ForeignKey, Float, DateTime, Date, Boolean, Index, and_, Computed, DDL, event, UniqueConstraint, CheckConstraint
+from sqlalchemy.dialects.postgresql import TSVECTOR, JSONB
+from sqlalchemy.orm import declarative_base, relationship, deferred
 from sqlalchemy.sql import func
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from pydantic import EmailStr, constr, BaseModel
+from pydantic import EmailStr, constr, conint, BaseModel, ConfigDict
 from dotenv import load_dotenv
 from typing import Optional
-from datetime import datetime
+from datetime import datetime, date
 import os 
 
 
 load_dotenv()
+PRODUCT_SEARCH_CONFIG = 'english'
+PRODUCT_SEARCH_VECTOR = (
+	f"setweight(to_tsvector('{PRODUCT_SEARCH_CONFIG}'::regconfig, coalesce(product_name, '')), 'A') || "
+	f"setweight(to_tsvector('{PRODUCT_SEARCH_CONFIG}'::regconfig, coalesce(product_description, '')), 'B')"
+	)
+PRICE_FACET_BUCKET = 10
 DATABASE_URL = os.getenv('DATABASE_URL').replace("postgresql://", "postgresql+asyncpg://", 1)
 TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL').replace("postgresql://", "postgresql+asyncpg://", 1)
 engine = create_async_engine(DATABASE_URL, echo=True)
@@ -26,7 +33,7 @@ class User(Base):
 	hashed_password = Column(String)
 	balance = Column(Float, default=0)
 	bonus_points = Column(Float, default=0)
-	orders = relationship("Order", back_populates="owner")
+	orders = relationship("Order", back_populates="owner", passive_deletes=True)
 
 
 
@@ -36,6 +43,8 @@ class Order(Base):
 	order_amount = Column(Float, default=0)
 	order_status = Column(String)
 	order_time_info = Column(DateTime, default= func.now())
+	order_updated_at = Column(DateTime, default=func.localtimestamp())
+	order_rolled_up = Column(Boolean, nullable=False, default=False, server_default='false')
 
 	user_id = Column(Integer, ForeignKey('users.id', ondelete="CASCADE"))
 
@@ -43,6 +52,13 @@ class Order(Base):
 
 	order_for_order_items = relationship('OrderItem', back_populates='order_items_from_orders')
 
+	__table_args__ = (
+		Index('ix_orders_user_status_time', 'user_id', 'order_status', 'order_time_info', 'order_id'),
+		Index('uq_orders_user_pending', 'user_id', unique=True, postgresql_where=order_status == 'pending'),
+		Index('ix_orders_pending_updated_at', 'order_updated_at', postgresql_where=order_status == 'pending'),
+		Index('ix_orders_unrolled', 'order_id', postgresql_where=and_(order_status == 'completed', order_rolled_up.is_(False))),
+		)
+
 
 
 class Product(Base):
@@ -52,10 +68,118 @@ class Product(Base):
 	product_price = Column(Float)
 	product_description = Column(String)
 	product_stock_quantity = Column(Integer)
+	product_reserved_quantity = Column(Integer, nullable=False, default=0, server_default='0')
+	product_stock_shards = Column(Integer, nullable=False, default=0, server_default='0')
 	product_size = Column(Integer)
 	product_color = Column(String)
-
-	product_for_order = relationship("OrderItem", back_populates='order_items_from_products')
+	product_search = deferred(Column(TSVECTOR, Computed(PRODUCT_SEARCH_VECTOR, persisted=True)))
+
+	product_for_order = relationship("OrderItem", back_populates='order_items_from_products', passive_deletes=True)
+
+	__table_args__ = (
+		Index('ix_products_color_size_price', 'product_color', 'product_size', 'product_price', 'product_id'),
+		Index('ix_products_price_id', 'product_price', 'product_id'),
+		Index('ix_products_in_stock_price_id', 'product_price', 'product_id', postgresql_where=product_stock_quantity > 0),
+		Index('ix_products_search', 'product_search', postgresql_using='gin'),
+		Index('ix_products_sharded', 'product_id', postgresql_where=product_stock_shards > 0),
+		)
+
+
+
+class ProductFacet(Base):
+	__tablename__='product_facets'
+	facet = Column(String, primary_key=True)
+	value = Column(String, primary_key=True)
+	product_count = Column(Integer, nullable=False, default=0)
+
+
+
+# product_facets is kept in step with products by triggers. Each INSERT or DELETE (including
+# COPY) applies one aggregated delta per facet value from a statement-level trigger. Updates
+# use a row-level trigger limited to the three facet columns, because a trigger with transition
+# tables cannot have a column list and would otherwise fire on every stock or hold change.
+PRODUCT_FACETS_DDL = [
+	f"""
+	CREATE OR REPLACE FUNCTION product_facet_keys(color varchar, size integer, price double precision)
+	RETURNS TABLE (facet varchar, value varchar) LANGUAGE sql IMMUTABLE AS $$
+		SELECT keys.facet_name, keys.facet_value
+		FROM (VALUES
+			('color'::varchar, color),
+			('size'::varchar, size::varchar),
+			('price'::varchar, (floor(price / {PRICE_FACET_BUCKET}) * {PRICE_FACET_BUCKET})::varchar)
+		) AS keys (facet_name, facet_value)
+		WHERE keys.facet_value IS NOT NULL
+	$$
+	""",
+	"""
+	CREATE OR REPLACE FUNCTION product_facets_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+	BEGIN
+		IF TG_OP = 'INSERT' THEN
+			INSERT INTO product_facets (facet, value, product_count)
+			SELECT keys.facet, keys.value, count(*)
+			FROM new_rows, product_facet_keys(new_rows.product_color, new_rows.product_size, new_rows.product_price) AS keys
+			GROUP BY keys.facet, keys.value
+			ON CONFLICT (facet, value) DO UPDATE SET product_count = product_facets.product_count + excluded.product_count;
+		ELSIF TG_OP = 'DELETE' THEN
+			UPDATE product_facets SET product_count = product_facets.product_count - changes.removed
+			FROM (
+				SELECT keys.facet, keys.value, count(*) AS removed
+				FROM old_rows, product_facet_keys(old_rows.product_color, old_rows.product_size, old_rows.product_price) AS keys
+				GROUP BY keys.facet, keys.value
+			) AS changes
+			WHERE product_facets.facet = changes.facet AND product_facets.value = changes.value;
+		END IF;
+		RETURN NULL;
+	END
+	$$
+	""",
+	"""
+	CREATE OR REPLACE FUNCTION product_facets_update() RETURNS trigger LANGUAGE plpgsql AS $$
+	BEGIN
+		INSERT INTO product_facets (facet, value, product_count)
+		SELECT keys.facet, keys.value, sum(changed.delta)
+		FROM (VALUES
+			(NEW.product_color, NEW.product_size, NEW.product_price, 1),
+			(OLD.product_color, OLD.product_size, OLD.product_price, -1)
+		) AS changed (product_color, product_size, product_price, delta),
+		product_facet_keys(changed.product_color, changed.product_size, changed.product_price) AS keys
+		GROUP BY keys.facet, keys.value
+		HAVING sum(changed.delta) <> 0
+		ON CONFLICT (facet, value) DO UPDATE SET product_count = product_facets.product_count + excluded.product_count;
+		RETURN NULL;
+	END
+	$$
+	""",
+	"""
+	CREATE TRIGGER products_facets_insert AFTER INSERT ON products
+	REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION product_facets_apply()
+	""",
+	"""
+	CREATE TRIGGER products_facets_update AFTER UPDATE OF product_color, product_size, product_price ON products
+	FOR EACH ROW
+	WHEN ((OLD.product_color, OLD.product_size, OLD.product_price) IS DISTINCT FROM (NEW.product_color, NEW.product_size, NEW.product_price))
+	EXECUTE FUNCTION product_facets_update()
+	""",
+	"""
+	CREATE TRIGGER products_facets_delete AFTER DELETE ON products
+	REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION product_facets_apply()
+	""",
+	]
+
+for statement in PRODUCT_FACETS_DDL:
+	event.listen(Product.__table__, 'after_create', DDL(statement))
+event.listen(Product.__table__, 'after_drop', DDL('DROP FUNCTION IF EXISTS product_facets_apply()'))
+event.listen(Product.__table__, 'after_drop', DDL('DROP FUNCTION IF EXISTS product_facets_update()'))
+event.listen(Product.__table__, 'after_drop', DDL('DROP FUNCTION IF EXISTS product_facet_keys(varchar, integer, double precision)'))
+
+
+
+
+# Counts changes to what the catalog endpoints show; their ETags are built from it, so every
+# worker process hands out the same tag for the same catalog. It is advanced with nextval after
+# each change commits, which takes no lock, so checkouts do not queue on it, and a tag can never
+# be seen before the content it stands for.
+catalog_version = Sequence('catalog_version', metadata=Base.metadata)
 
 
 
@@ -65,6 +189,7 @@ class OrderItem(Base):
 	order_items_id = Column(Integer, primary_key=True, unique=True, index=True, autoincrement=True)
 	order_items_price_now = Column(Float)
 	product_quantity = Column(Integer)
+	reserved_until = Column(DateTime, nullable=True)
 
 	order_id = Column(Integer, ForeignKey('orders.order_id', ondelete="CASCADE"))
 	product_id = Column(Integer, ForeignKey('products.product_id', ondelete="CASCADE"))
@@ -74,6 +199,154 @@ class OrderItem(Base):
 
 	order_items_from_products = relationship('Product', back_populates='product_for_order')
 
+	__table_args__ = (
+		UniqueConstraint('order_id', 'product_id', name='uq_order_items_order_product'),
+		Index('ix_order_items_reserved_until', 'reserved_until', postgresql_where=reserved_until.is_not(None)),
+		)
+
+
+
+class ArchivedOrder(Base):
+	# Completed orders moved out of orders by order_archive.py, with the same columns and ids,
+	# so the cart and checkout paths only ever touch recent rows.
+	__tablename__='archived_orders'
+	order_id = Column(Integer, primary_key=True, autoincrement=False)
+	order_amount = Column(Float)
+	order_status = Column(String)
+	order_time_info = Column(DateTime)
+	order_updated_at = Column(DateTime)
+
+	user_id = Column(Integer, ForeignKey('users.id', ondelete="CASCADE"))
+
+	order_for_order_items = relationship('ArchivedOrderItem', back_populates='order_items_from_orders')
+
+	__table_args__ = (
+		Index('ix_archived_orders_user_status_time', 'user_id', 'order_status', 'order_time_info', 'order_id'),
+		)
+
+
+
+class ArchivedOrderItem(Base):
+	__tablename__='archived_order_items'
+	order_items_id = Column(Integer, primary_key=True, autoincrement=False)
+	order_items_price_now = Column(Float)
+	product_quantity = Column(Integer)
+
+	order_id = Column(Integer, ForeignKey('archived_orders.order_id', ondelete="CASCADE"), index=True)
+	product_id = Column(Integer, ForeignKey('products.product_id', ondelete="CASCADE"))
+
+	order_items_from_orders = relationship('ArchivedOrder', back_populates='order_for_order_items')
+
+
+
+# A held cart line counts its whole quantity in products.product_reserved_quantity until the
+# hold is converted at checkout or released by the sweeper. Deleting a held line (directly or
+# through a cascade from orders, users or products) gives its quantity back here.
+ORDER_ITEM_HOLDS_DDL = [
+	"""
+	CREATE OR REPLACE FUNCTION order_items_release_holds() RETURNS trigger LANGUAGE plpgsql AS $$
+	BEGIN
+		UPDATE products SET product_reserved_quantity = products.product_reserved_quantity - released.quantity
+		FROM (
+			SELECT product_id, sum(product_quantity) AS quantity
+			FROM old_rows
+			WHERE reserved_until IS NOT NULL
+			GROUP BY product_id
+		) AS released
+		WHERE products.product_id = released.product_id;
+		RETURN NULL;
+	END
+	$$
+	""",
+	"""
+	CREATE TRIGGER order_items_release_holds AFTER DELETE ON order_items
+	REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION order_items_release_holds()
+	""",
+	]
+
+for statement in ORDER_ITEM_HOLDS_DDL:
+	event.listen(OrderItem.__table__, 'after_create', DDL(statement))
+event.listen(OrderItem.__table__, 'after_drop', DDL('DROP FUNCTION IF EXISTS order_items_release_holds()'))
+
+
+
+
+
+
+
+class CheckoutJob(Base):
+	__tablename__='checkout_jobs'
+	job_id = Column(Integer, primary_key=True, autoincrement=True)
+	token = Column(String, unique=True, index=True, nullable=False)
+	job_status = Column(String, nullable=False, default='queued')
+	job_error = Column(String, nullable=True)
+	created_at = Column(DateTime, default=func.now())
+	finished_at = Column(DateTime, nullable=True)
+
+	user_id = Column(Integer, ForeignKey('users.id', ondelete="CASCADE"), nullable=False)
+	order_id = Column(Integer, ForeignKey('orders.order_id', ondelete="SET NULL"), nullable=True)
+
+	__table_args__ = (
+		Index('ix_checkout_jobs_queued', 'job_id', postgresql_where=job_status == 'queued'),
+		)
+
+
+
+
+
+
+
+class IdempotencyKey(Base):
+	__tablename__='idempotency_keys'
+	user_id = Column(Integer, ForeignKey('users.id', ondelete="CASCADE"), primary_key=True)
+	idempotency_key = Column(String, primary_key=True)
+	request_hash = Column(String, nullable=False)
+	status_code = Column(Integer, nullable=True)
+	response_body = Column(JSONB, nullable=True)
+	expires_at = Column(DateTime, nullable=False, index=True)
+
+
+
+class ProductStockShard(Base):
+	# Stock of a product in sharded mode, split over several rows so concurrent checkouts
+	# of the same product lock different rows.
+	__tablename__='product_stock_shards'
+	product_id = Column(Integer, ForeignKey('products.product_id', ondelete="CASCADE"), primary_key=True)
+	shard_id = Column(Integer, primary_key=True)
+	shard_quantity = Column(Integer, nullable=False, default=0)
+
+	__table_args__ = (
+		CheckConstraint('shard_quantity >= 0', name='ck_product_stock_shards_quantity'),
+		)
+
+
+
+class DailyProductSales(Base):
+	# Sales rollups, filled from completed orders by sales_rollups.py. There is no foreign key
+	# to products, and deleting a product rolls up its completed orders before their lines
+	# go, so the sales of a deleted product stay in the reports.
+	__tablename__='daily_product_sales'
+	sales_date = Column(Date, primary_key=True)
+	product_id = Column(Integer, primary_key=True)
+	revenue = Column(Float, nullable=False, default=0)
+	units = Column(Integer, nullable=False, default=0)
+	order_count = Column(Integer, nullable=False, default=0)
+
+	__table_args__ = (
+		Index('ix_daily_product_sales_product_date', 'product_id', 'sales_date'),
+		)
+
+
+
+class DailySales(Base):
+	# Store-wide totals per day; order_count cannot be summed from the per-product rows, as one
+	# order can contain several products.
+	__tablename__='daily_sales'
+	sales_date = Column(Date, primary_key=True)
+	revenue = Column(Float, nullable=False, default=0)
+	units = Column(Integer, nullable=False, default=0)
+	order_count = Column(Integer, nullable=False, default=0)
+
 
 
 
@@ -117,8 +390,58 @@ class ProductResponse(BaseModel):
 	product_color: str 
 	product_stock_quantity: int 
 	product_description: str 
-	class ConfigDict:
-		from_attributes = True
+	model_config = ConfigDict(from_attributes=True)
+
+
+
+class ProductImportError(BaseModel):
+	row: int
+	errors: list[str]
+
+
+class ProductImportResponse(BaseModel):
+	imported: int
+	failed: int
+	errors: list[ProductImportError] = []
+
+
+
+class ProductAvailability(BaseModel):
+	product_id: int
+	available_quantity: int
+
+
+class StockShardsUpdate(BaseModel):
+	shards: conint(ge=0, le=64)
+
+
+class StockShardsResponse(BaseModel):
+	product_id: int
+	product_stock_shards: int
+	available_quantity: int
+
+
+
+class FacetCount(BaseModel):
+	value: str
+	count: int
+
+
+class SizeFacetCount(BaseModel):
+	value: int
+	count: int
+
+
+class PriceBucketCount(BaseModel):
+	min_price: float
+	max_price: float
+	count: int
+
+
+class ProductFacetsResponse(BaseModel):
+	colors: list[FacetCount] = []
+	sizes: list[SizeFacetCount] = []
+	price_buckets: list[PriceBucketCount] = []
 
 
 
@@ -131,6 +454,18 @@ class ProductUpdate(BaseModel):
 	product_description: Optional[str] = None 
 
 
+class ProductBulkUpdateItem(ProductUpdate):
+	product_id: int
+
+
+class ProductBulkUpdateResponse(BaseModel):
+	updated: int
+	missing: int
+	failed: int
+	missing_ids: list[int] = []
+	failed_ids: list[int] = []
+
+
 class OrderItemAdd(BaseModel):
 	product_id: int 
 	product_quantity: int 
@@ -143,32 +478,59 @@ class OrderItemResponse(BaseModel):
 	product_id: int 
 	order_items_price_now: float
 	product_quantity: int 
-	class ConfigDict:
-		from_attributes = True
+	model_config = ConfigDict(from_attributes=True)
 
 
 class OrderResponse(BaseModel):
-	order_id: int
+	# order_id and order_time_info are None only for a cart that has not been created yet.
+	order_id: Optional[int]
 	order_amount: float
 	order_status: str
-	order_time_info: datetime
+	order_time_info: Optional[datetime]
 	user_id: int
 	order_for_order_items: list[OrderItemResponse] = []
-	class ConfigDict:
-		orm_mode = True
+	model_config = ConfigDict(from_attributes=True)
 
 class OrderUpdate(BaseModel):
 	quantity: int 
 
 
+class SalesDayResponse(BaseModel):
+	sales_date: date
+	revenue: float
+	units: int
+	order_count: int
+
+
+class ProductSalesResponse(BaseModel):
+	product_id: int
+	revenue: float
+	units: int
+	order_count: int
+
+
+class CheckoutJobResponse(BaseModel):
+	token: str
+	job_status: str
+	job_error: Optional[str] = None
+	order_id: Optional[int] = None
+	created_at: datetime
+	finished_at: Optional[datetime] = None
+	model_config = ConfigDict(from_attributes=True)
+
+
+class CartBatchItem(BaseModel):
+	product_id: int
+	quantity: int
+
+
 class UserResponse(BaseModel):
 	id: int
 	email: EmailStr
 	role: str 
 	balance: float 
 	bonus_points: float
-	class ConfigDict:
-		from_attributes = True
+	model_config = ConfigDict(from_attributes=True)
 
 
 class AdminUpdateBalance(BaseModel):
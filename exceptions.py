@@ -75,9 +75,37 @@ class CartIsEmptyException(CustomHTTPException):
 		super().__init__(status_code=status.HTTP_401_UNAUTHORIZED, detail=detail)
 
 
+class NotModifiedException(CustomHTTPException):
+	def __init__(self, headers: dict):
+		super().__init__(status_code=status.HTTP_304_NOT_MODIFIED, detail='Not modified', headers=headers)
 
 
+class InvalidCursorException(CustomHTTPException):
+	def __init__(self, detail: str = 'Invalid pagination cursor'):
+		super().__init__(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
+
+
+class InvalidImportException(CustomHTTPException):
+	def __init__(self, detail: str = 'Invalid import body'):
+		super().__init__(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
+
+
+class CheckoutJobNotFoundException(CustomHTTPException):
+	def __init__(self, detail: str = 'Checkout request not found'):
+		super().__init__(status_code=status.HTTP_404_NOT_FOUND, detail=detail)
+
+
+class IdempotentReplayException(CustomHTTPException):
+	def __init__(self, status_code: int, content):
+		super().__init__(status_code=status_code, detail='Replayed response', headers={'Idempotent-Replayed': 'true'})
+		self.content = content
 
 
+class IdempotencyKeyMismatchException(CustomHTTPException):
+	def __init__(self, detail: str = 'Idempotency-Key was already used for a different request'):
+		super().__init__(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=detail)
 
 
+class PasswordHashingBusyException(CustomHTTPException):
+	def __init__(self, detail: str = 'Too many sign-in requests at the moment, please retry shortly'):
+		super().__init__(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=detail, headers={'Retry-After': '1'})
@@ -0,0 +1,75 @@
+from fastapi import Request, Response, Depends
+from dotenv import load_dotenv
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import catalog_version, get_db
+from cache import catalog_cache
+from exceptions import NotModifiedException
+import hashlib
+import orjson
+import os
+
+
+
+load_dotenv()
+
+
+DEFAULT_CACHE_CONTROL = {
+	'products_all': 'public, max-age=0, must-revalidate',
+	'products_search': 'public, max-age=0, must-revalidate',
+	'products_facets': 'public, max-age=0, must-revalidate',
+	'product_info': 'private, no-cache',
+	}
+CACHE_CONTROL = {route: os.getenv(f'CACHE_CONTROL_{route.upper()}', value) for route, value in DEFAULT_CACHE_CONTROL.items()}
+
+
+
+def etag_matches(if_none_match: str, etag: str):
+	if not if_none_match:
+		return False
+	if if_none_match.strip() == '*':
+		return True
+	# If-None-Match uses the weak comparison, so a W/ prefix added by a proxy still matches.
+	return etag in (tag.strip().removeprefix('W/') for tag in if_none_match.split(','))
+
+
+
+async def bump_catalog_version(db: AsyncSession):
+	# Called after a change to the catalog commits and before its invalidations are published,
+	# so the processes that drop their copy of the version read the new one.
+	await db.execute(select(catalog_version.next_value()))
+
+
+
+class ConditionalGet:
+	def __init__(self, headers: dict):
+		self.headers = headers
+
+
+	def response(self, content, headers: dict = None):
+		return Response(content=orjson.dumps(content), media_type='application/json', headers={**(headers or {}), **self.headers})
+
+
+
+class CatalogConditionalGet:
+	# The ETag is the shared catalog version plus a digest of the URL, so it is compared, and a
+	# 304 sent, before the endpoint queries or serializes anything. The version comes from one
+	# sequence in Postgres, so every worker process derives the same tag for the same catalog.
+	def __init__(self, route: str):
+		self.cache_control = CACHE_CONTROL[route]
+
+
+	async def __call__(self, request: Request, db: AsyncSession = Depends(get_db)):
+		shared_version = catalog_cache.get_shared_version()
+		if shared_version is None:
+			version = catalog_cache.version
+			shared_version = await db.scalar(text('SELECT last_value FROM catalog_version'))
+			catalog_cache.set_shared_version(shared_version, version)
+		digest = hashlib.blake2b(f'{request.url.path}\n{request.url.query}'.encode(), digest_size=8).hexdigest()
+		headers = {
+		'ETag': f'"{shared_version}-{digest}"',
+		'Cache-Control': self.cache_control,
+		}
+		if etag_matches(request.headers.get('if-none-match'), headers['ETag']):
+			raise NotModifiedException(headers)
+		return ConditionalGet(headers)
@@ -0,0 +1,120 @@
+from fastapi import Depends, Header, Request
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select, update, delete, func, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, IdempotencyKey, User, get_db
+from security import get_current_user
+from exceptions import IdempotentReplayException, IdempotencyKeyMismatchException
+from dotenv import load_dotenv
+from datetime import timedelta
+from typing import Optional
+import hashlib
+import asyncio
+import logging
+import os
+
+
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_KEY_TTL_SECONDS', 86400))
+IDEMPOTENCY_PRUNE_INTERVAL = float(os.getenv('IDEMPOTENCY_PRUNE_INTERVAL', 300))
+IDEMPOTENCY_PRUNE_BATCH_SIZE = int(os.getenv('IDEMPOTENCY_PRUNE_BATCH_SIZE', 1000))
+
+
+
+class IdempotentRequest:
+	def __init__(self, db: AsyncSession, user_id: int, key: str):
+		self.db = db
+		self.user_id = user_id
+		self.key = key
+
+
+	async def save(self, response, status_code: int = 200):
+		# Must run before the handler commits, so the stored response and the work it
+		# describes become visible together.
+		await self.db.execute(
+			update(IdempotencyKey)
+			.filter(IdempotencyKey.user_id == self.user_id, IdempotencyKey.idempotency_key == self.key)
+			.values(status_code=status_code, response_body=jsonable_encoder(response))
+			.execution_options(synchronize_session=False)
+			)
+
+
+
+async def idempotent_request(
+	request: Request,
+	idempotency_key: Optional[str] = Header(None, max_length=255),
+	current_user: User = Depends(get_current_user),
+	db: AsyncSession = Depends(get_db)
+	):
+	# Claims the key inside the handler's transaction. A concurrent request with the same key
+	# waits on the claim until the first one commits (and then replays its response) or rolls
+	# back (and then runs the handler itself). Failed requests are never stored.
+	if idempotency_key is None:
+		return None
+	request_hash = hashlib.blake2b(request.method.encode() + request.url.path.encode() + b'\n' + await request.body(), digest_size=16).hexdigest()
+	claim = insert(IdempotencyKey).values(
+		user_id=current_user.id,
+		idempotency_key=idempotency_key,
+		request_hash=request_hash,
+		expires_at=func.localtimestamp() + timedelta(seconds=IDEMPOTENCY_KEY_TTL_SECONDS)
+		)
+	result = await db.execute(
+		claim.on_conflict_do_update(
+			index_elements=['user_id', 'idempotency_key'],
+			set_={
+			'request_hash': claim.excluded.request_hash,
+			'status_code': None,
+			'response_body': None,
+			'expires_at': claim.excluded.expires_at,
+			},
+			where=IdempotencyKey.expires_at < func.localtimestamp()
+			).returning(IdempotencyKey.user_id)
+		)
+	if result.scalar_one_or_none() is not None:
+		return IdempotentRequest(db, current_user.id, idempotency_key)
+
+	result = await db.execute(select(IdempotencyKey.request_hash, IdempotencyKey.status_code, IdempotencyKey.response_body).filter(
+		IdempotencyKey.user_id == current_user.id,
+		IdempotencyKey.idempotency_key == idempotency_key
+		))
+	stored = result.one()
+	if stored.request_hash != request_hash:
+		raise IdempotencyKeyMismatchException()
+	raise IdempotentReplayException(stored.status_code, stored.response_body)
+
+
+
+async def prune_expired_keys(db: AsyncSession, batch_size: int = IDEMPOTENCY_PRUNE_BATCH_SIZE):
+	expired = (
+		select(IdempotencyKey.user_id, IdempotencyKey.idempotency_key)
+		.filter(IdempotencyKey.expires_at < func.localtimestamp())
+		.limit(batch_size)
+		.with_for_update(skip_locked=True)
+		)
+	result = await db.execute(
+		delete(IdempotencyKey)
+		.where(tuple_(IdempotencyKey.user_id, IdempotencyKey.idempotency_key).in_(expired))
+		.execution_options(synchronize_session=False)
+		)
+	await db.commit()
+	return result.rowcount
+
+
+
+async def sweep_expired_keys(session_factory=AsyncSessionLocal, interval: float = IDEMPOTENCY_PRUNE_INTERVAL, batch_size: int = IDEMPOTENCY_PRUNE_BATCH_SIZE):
+	while True:
+		try:
+			async with session_factory() as db:
+				pruned = batch_size
+				while pruned == batch_size:
+					pruned = await prune_expired_keys(db, batch_size)
+					if pruned:
+						logger.info(f'Pruned {pruned} expired idempotency keys')
+		except Exception as e:
+			logger.exception(f'Idempotency key prune failed: {str(e)}')
+		await asyncio.sleep(interval)
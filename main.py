@@ -1,12 +1,23 @@
 from fastapi import FastAPI, HTTPException, Depends, Request, status
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from database import User, CreateUser,UpdateEmail, UpdatePassword, UpdateBalance, get_db, Base, ProductResponse, ProductCreate, Product, ProductUpdate, OrderItemAdd, OrderItemResponse, Order, OrderItem, OrderResponse, OrderUpdate, MessageResponse,  UserResponse, AdminUpdateBalance
 from security import get_password_hash, get_current_user, create_access_token, verify_password, get_current_admin_user
 from typing import Union
-from exceptions import ProductNotFoundException, CartIsEmptyException, InsufficientStockException, IncorrectPasswordRepedException, IncorrectPasswordException,  CartNotFoundException, OrderItemNotFoundException, QuantityNegativeException, InsufficientFundsException, EmptyCartException, UserAlreadyExistsException, InvalidCredentialsException, UserNotFoundException, NegativeDepositException
+from exceptions import ProductNotFoundException, CartIsEmptyException, InsufficientStockException, IncorrectPasswordRepedException, IncorrectPasswordException,  CartNotFoundException, OrderItemNotFoundException, QuantityNegativeException, InsufficientFundsException, EmptyCartException, UserAlreadyExistsException, InvalidCredentialsException, UserNotFoundException, NegativeDepositException, InvalidCursorException, InvalidImportException, NotModifiedException, CheckoutJobNotFoundException, IdempotentReplayException, IdempotencyKeyMismatchException, PasswordHashingBusyException
 from routers import users, admin, products, orders
+from reservations import sweep_expired_holds
+from checkout import start_checkout_workers
+from idempotency import sweep_expired_keys
+from cart_totals import run_order_amount_checker
+from abandoned_carts import run_cart_sweeper
+from stock_shards import run_stock_rebalancer
+from sales_rollups import run_sales_rollup
+from order_archive import run_order_archiver
+from cache import broker
 from logging_config import setup_logging
+from contextlib import asynccontextmanager
+import asyncio
 import logging 
 
 
@@ -17,7 +28,27 @@ logger = logging.getLogger(__name__)
 
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+	background_tasks = [
+		asyncio.create_task(sweep_expired_holds()),
+		asyncio.create_task(sweep_expired_keys()),
+		asyncio.create_task(run_order_amount_checker()),
+		asyncio.create_task(run_cart_sweeper()),
+		asyncio.create_task(run_stock_rebalancer()),
+		asyncio.create_task(run_sales_rollup()),
+		asyncio.create_task(run_order_archiver()),
+		*start_checkout_workers(),
+		*broker.start(),
+		]
+	yield
+	for task in background_tasks:
+		task.cancel()
+
+
+
 app = FastAPI(
+	lifespan=lifespan,
 	titel='E-commerce API',
 	description='API for managing users, products, and orders in an e-commerce platform',
 	version='0.1.0',
@@ -172,13 +203,52 @@ async def user_not_found_exception_handler(request: Request, exc: UserNotFoundEx
 		)
 
 
+@app.exception_handler(NotModifiedException)
+async def not_modified_exception_handler(request: Request, exc: NotModifiedException):
+	return Response(status_code=exc.status_code, headers=exc.headers)
 
 
+@app.exception_handler(InvalidCursorException)
+async def invalid_cursor_exception_handler(request: Request, exc: InvalidCursorException):
+	return JSONResponse(
+		status_code=exc.status_code,
+		content={'message': exc.detail},
+		)
 
 
+@app.exception_handler(InvalidImportException)
+async def invalid_import_exception_handler(request: Request, exc: InvalidImportException):
+	return JSONResponse(
+		status_code=exc.status_code,
+		content={'message': exc.detail},
+		)
 
 
+@app.exception_handler(CheckoutJobNotFoundException)
+async def checkout_job_not_found_exception_handler(request: Request, exc: CheckoutJobNotFoundException):
+	return JSONResponse(
+		status_code=exc.status_code,
+		content={'message': exc.detail},
+		)
+
 
+@app.exception_handler(IdempotentReplayException)
+async def idempotent_replay_exception_handler(request: Request, exc: IdempotentReplayException):
+	return JSONResponse(status_code=exc.status_code, content=exc.content, headers=exc.headers)
 
 
+@app.exception_handler(IdempotencyKeyMismatchException)
+async def idempotency_key_mismatch_exception_handler(request: Request, exc: IdempotencyKeyMismatchException):
+	return JSONResponse(
+		status_code=exc.status_code,
+		content={'message': exc.detail},
+		)
+
 
+@app.exception_handler(PasswordHashingBusyException)
+async def password_hashing_busy_exception_handler(request: Request, exc: PasswordHashingBusyException):
+	return JSONResponse(
+		status_code=exc.status_code,
+		content={'message': exc.detail},
+		headers=exc.headers,
+		)
@@ -0,0 +1,106 @@
+from sqlalchemy import select, delete, func, literal_column
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, Order, OrderItem, ArchivedOrder, ArchivedOrderItem
+from dotenv import load_dotenv
+from datetime import timedelta
+import argparse
+import asyncio
+import logging
+import time
+import os
+
+
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+ORDER_ARCHIVE_AFTER_DAYS = int(os.getenv('ORDER_ARCHIVE_AFTER_DAYS', 90))
+ORDER_ARCHIVE_INTERVAL = float(os.getenv('ORDER_ARCHIVE_INTERVAL', 3600))
+ORDER_ARCHIVE_BATCH_SIZE = int(os.getenv('ORDER_ARCHIVE_BATCH_SIZE', 1000))
+
+archived_order_columns = [column.name for column in ArchivedOrder.__table__.columns]
+archived_order_item_columns = [column.name for column in ArchivedOrderItem.__table__.columns]
+
+
+
+async def archive_orders_batch(db: AsyncSession, after_days: int = ORDER_ARCHIVE_AFTER_DAYS, batch_size: int = ORDER_ARCHIVE_BATCH_SIZE):
+	# Only completed orders already counted in the sales rollups are moved, aged from their
+	# completion (checkout stamps order_updated_at) rather than from when the cart was opened.
+	# Copying and deleting happen in one transaction, so an order is always in exactly one of
+	# the tables; deleting it cascades to its lines.
+	result = await db.execute(
+		select(Order.order_id)
+		.filter(
+			Order.order_status == literal_column("'completed'"),
+			Order.order_rolled_up.is_(True),
+			Order.order_updated_at < func.localtimestamp() - timedelta(days=after_days)
+			)
+		.order_by(Order.order_id)
+		.limit(batch_size)
+		.with_for_update(skip_locked=True)
+		)
+	order_ids = result.scalars().all()
+	lines = 0
+	if order_ids:
+		await db.execute(ArchivedOrder.__table__.insert().from_select(
+			archived_order_columns,
+			select(*(Order.__table__.c[name] for name in archived_order_columns)).filter(Order.order_id.in_(order_ids))
+			))
+		result = await db.execute(ArchivedOrderItem.__table__.insert().from_select(
+			archived_order_item_columns,
+			select(*(OrderItem.__table__.c[name] for name in archived_order_item_columns)).filter(OrderItem.order_id.in_(order_ids))
+			))
+		lines = result.rowcount
+		await db.execute(delete(Order).where(Order.order_id.in_(order_ids)).execution_options(synchronize_session=False))
+	await db.commit()
+	return len(order_ids), lines
+
+
+
+async def archive_orders(db: AsyncSession, after_days: int = ORDER_ARCHIVE_AFTER_DAYS, batch_size: int = ORDER_ARCHIVE_BATCH_SIZE):
+	orders, lines, batches = 0, 0, 0
+	start = time.perf_counter()
+	batch_orders = batch_size
+	while batch_orders == batch_size:
+		batch_orders, batch_lines = await archive_orders_batch(db, after_days, batch_size)
+		orders += batch_orders
+		lines += batch_lines
+		batches += 1
+	seconds = time.perf_counter() - start
+	return {
+	'orders_archived': orders,
+	'lines_archived': lines,
+	'batches': batches,
+	'seconds': round(seconds, 3),
+	'orders_per_second': round(orders / seconds, 1) if seconds else 0.0,
+	}
+
+
+
+async def run_order_archiver(session_factory=AsyncSessionLocal, interval: float = ORDER_ARCHIVE_INTERVAL, after_days: int = ORDER_ARCHIVE_AFTER_DAYS, batch_size: int = ORDER_ARCHIVE_BATCH_SIZE):
+	while True:
+		await asyncio.sleep(interval)
+		try:
+			async with session_factory() as db:
+				stats = await archive_orders(db, after_days, batch_size)
+			if stats['orders_archived']:
+				logger.info(f"Archived {stats['orders_archived']} orders ({stats['lines_archived']} lines) in {stats['batches']} batches, {stats['seconds']}s, {stats['orders_per_second']} orders/s")
+		except Exception as e:
+			logger.exception(f'Order archiving failed: {str(e)}')
+
+
+
+async def main(after_days: int, batch_size: int):
+	async with AsyncSessionLocal() as db:
+		stats = await archive_orders(db, after_days, batch_size)
+	print(stats)
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Move orders completed longer ago than the given age to the archive tables.')
+	parser.add_argument('--after-days', type=int, default=ORDER_ARCHIVE_AFTER_DAYS)
+	parser.add_argument('--batch-size', type=int, default=ORDER_ARCHIVE_BATCH_SIZE)
+	args = parser.parse_args()
+	asyncio.run(main(args.after_days, args.batch_size))
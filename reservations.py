@@ -0,0 +1,98 @@
+from sqlalchemy import select, update, func, values, column, or_, case, Integer
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, Product, ProductStockShard, OrderItem
+from dotenv import load_dotenv
+from datetime import timedelta
+import asyncio
+import logging
+import os
+
+
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+RESERVATION_TTL_SECONDS = int(os.getenv('RESERVATION_TTL_SECONDS', 900))
+RESERVATION_SWEEP_INTERVAL = float(os.getenv('RESERVATION_SWEEP_INTERVAL', 30))
+RESERVATION_SWEEP_BATCH_SIZE = int(os.getenv('RESERVATION_SWEEP_BATCH_SIZE', 500))
+
+
+
+def hold_expiry():
+	return func.localtimestamp() + timedelta(seconds=RESERVATION_TTL_SECONDS)
+
+
+
+def available_quantity():
+	# Sharded products keep their stock in product_stock_shards and never take holds.
+	shard_total = select(func.coalesce(func.sum(ProductStockShard.shard_quantity), 0)).filter(ProductStockShard.product_id == Product.product_id).scalar_subquery()
+	return case((Product.product_stock_shards > 0, shard_total), else_=Product.product_stock_quantity - Product.product_reserved_quantity)
+
+
+
+async def adjust_holds(db: AsyncSession, deltas: dict[int, int]):
+	# Positive deltas only apply while enough unreserved stock is left; releases always apply.
+	# Returns False if any hold could not be placed, in which case the caller rolls back.
+	if not deltas:
+		return True
+	# The products are locked in product_id order first, as checkout does; the caller already
+	# holds the cart lines involved.
+	locked = select(Product.product_id).filter(Product.product_id.in_(deltas)).order_by(Product.product_id).with_for_update().cte('locked')
+	changes = values(column('product_id', Integer), column('delta', Integer), name='hold').data(list(deltas.items()))
+	result = await db.execute(
+		update(Product)
+		.where(Product.product_id == changes.c.product_id, Product.product_id.in_(select(locked.c.product_id)), or_(changes.c.delta <= 0, available_quantity() >= changes.c.delta))
+		.values(product_reserved_quantity=Product.product_reserved_quantity + changes.c.delta)
+		.returning(Product.product_id)
+		.execution_options(synchronize_session=False)
+		)
+	return len(result.all()) == len(deltas)
+
+
+
+async def release_expired_holds(db: AsyncSession, batch_size: int = RESERVATION_SWEEP_BATCH_SIZE):
+	expired = (
+		select(OrderItem.order_items_id)
+		.filter(OrderItem.reserved_until < func.localtimestamp())
+		.order_by(OrderItem.reserved_until)
+		.limit(batch_size)
+		.with_for_update(skip_locked=True)
+		.cte('expired')
+		)
+	released = (
+		update(OrderItem)
+		.where(OrderItem.order_items_id == expired.c.order_items_id)
+		.values(reserved_until=None)
+		.returning(OrderItem.product_id, OrderItem.product_quantity)
+		.cte('released')
+		)
+	totals = select(released.c.product_id, func.sum(released.c.product_quantity).label('quantity')).group_by(released.c.product_id).cte('totals')
+	# Lines before products, and products in product_id order, like every other hold change.
+	locked = select(Product.product_id).filter(Product.product_id.in_(select(totals.c.product_id))).order_by(Product.product_id).with_for_update().cte('locked')
+	products = (
+		update(Product)
+		.where(Product.product_id == totals.c.product_id, Product.product_id.in_(select(locked.c.product_id)))
+		.values(product_reserved_quantity=Product.product_reserved_quantity - totals.c.quantity)
+		.returning(Product.product_id)
+		.cte('products')
+		)
+	result = await db.execute(select(func.count()).select_from(released).add_cte(products))
+	count = result.scalar_one()
+	await db.commit()
+	return count
+
+
+
+async def sweep_expired_holds(session_factory=AsyncSessionLocal, interval: float = RESERVATION_SWEEP_INTERVAL, batch_size: int = RESERVATION_SWEEP_BATCH_SIZE):
+	while True:
+		try:
+			async with session_factory() as db:
+				released = batch_size
+				while released == batch_size:
+					released = await release_expired_holds(db, batch_size)
+					if released:
+						logger.info(f'Released {released} expired stock holds')
+		except Exception as e:
+			logger.exception(f'Stock hold sweep failed: {str(e)}')
+		await asyncio.sleep(interval)
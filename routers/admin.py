@@ -1,11 +1,18 @@
-from fastapi import FastAPI, HTTPException, Depends, APIRouter, status
+from fastapi import FastAPI, HTTPException, Depends, APIRouter, status, Query
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.responses import JSONResponse
-from sqlalchemy import select
+from sqlalchemy import select, func, delete
 from sqlalchemy.ext.asyncio import AsyncSession
-from database import User, CreateUser,UpdateEmail, UpdatePassword, UpdateBalance, get_db, Base, ProductResponse, ProductCreate, Product, ProductUpdate, OrderItemAdd, OrderItemResponse, Order, OrderItem, OrderResponse, OrderUpdate, MessageResponse,  UserResponse, AdminUpdateBalance
-from security import get_password_hash, get_current_user, create_access_token, verify_password, get_current_admin_user
+from database import User, CreateUser,UpdateEmail, UpdatePassword, UpdateBalance, get_db, Base, ProductResponse, ProductCreate, Product, ProductUpdate, OrderItemAdd, OrderItemResponse, Order, OrderItem, OrderResponse, OrderUpdate, MessageResponse,  UserResponse, AdminUpdateBalance, DailySales, DailyProductSales, SalesDayResponse, ProductSalesResponse
+from security import get_password_hash, get_current_user, create_access_token, verify_password, get_current_admin_user, password_hasher
 from typing import Union
+from cache import catalog_cache, cart_cache, principal_cache
+from cart_totals import check_order_amounts
+from abandoned_carts import sweep_idle_carts, CART_IDLE_SECONDS
+from sales_rollups import roll_up_sales
+from order_archive import archive_orders, ORDER_ARCHIVE_AFTER_DAYS
+from datetime import date
+from serialization import user_rows, validate_rows, rows_response
 from exceptions import ProductNotFoundException, InsufficientStockException, IncorrectPasswordRepedException, IncorrectPasswordException,  CartNotFoundException, OrderItemNotFoundException, QuantityNegativeException, InsufficientFundsException, EmptyCartException, UserAlreadyExistsException, InvalidCredentialsException, UserNotFoundException, NegativeDepositException
 
 
@@ -13,11 +20,14 @@ router = APIRouter(prefix='/admin', tags=['Admin'])
 
 
 
+user_columns = [getattr(User, name) for name in UserResponse.model_fields]
+
+
+
 @router.get('/get/all/users', response_model=list[UserResponse])
 async def get_all_users(current_admin: User = Depends(get_current_admin_user), db: AsyncSession=Depends(get_db)):
-	result = await db.scalars(select(User))
-	users = result.all()
-	return users
+	result = await db.execute(select(*user_columns).order_by(User.id))
+	return rows_response(validate_rows(user_rows, result.mappings()))
 
 
 
@@ -27,13 +37,15 @@ async def admin_delete_user(user_id: int, current_admin: User = Depends(get_curr
 	user = result.scalar_one_or_none()
 	if not user:
 		raise UserNotFoundException()
-	await db.delete(user)
+	email = user.email
+	await db.execute(delete(User).filter(User.id == user_id))
 	try:
 		await db.commit()
 	except Exception as e:
 		await db.rollback()
 		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
-	return {'message': f'User {user.email} is deleted'}
+	principal_cache.invalidate(user_id)
+	return {'message': f'User {email} is deleted'}
 
 
 @router.get('/get/user/{user_id}', response_model=UserResponse)
@@ -59,31 +71,76 @@ async def update_balance_by_admin(user_id: int, update_balance: AdminUpdateBalan
 	except Exception as e:
 		await db.rollback()
 		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
+	principal_cache.invalidate(user_id)
 	return user
 
 
 
+@router.get('/cache/stats')
+async def get_cache_stats(current_admin: User = Depends(get_current_admin_user)):
+	return {'catalog': catalog_cache.stats(), 'carts': cart_cache.stats(), 'principals': principal_cache.stats()}
 
 
 
+@router.get('/password/hashing/stats')
+async def get_password_hashing_stats(current_admin: User = Depends(get_current_admin_user)):
+	return password_hasher.stats()
 
 
 
+@router.post('/orders/amounts/check')
+async def check_cart_totals(current_admin: User = Depends(get_current_admin_user), db: AsyncSession = Depends(get_db)):
+	return await check_order_amounts(db)
 
 
 
+@router.post('/carts/sweep')
+async def sweep_carts(idle_seconds: int = Query(CART_IDLE_SECONDS, ge=0), current_admin: User = Depends(get_current_admin_user), db: AsyncSession = Depends(get_db)):
+	return await sweep_idle_carts(db, idle_seconds)
 
 
 
+@router.post('/orders/archive')
+async def archive_old_orders(after_days: int = Query(ORDER_ARCHIVE_AFTER_DAYS, ge=0), current_admin: User = Depends(get_current_admin_user), db: AsyncSession = Depends(get_db)):
+	return await archive_orders(db, after_days)
 
 
 
+@router.post('/reports/sales/rollup')
+async def roll_up_sales_now(current_admin: User = Depends(get_current_admin_user), db: AsyncSession = Depends(get_db)):
+	return await roll_up_sales(db)
 
 
 
+@router.get('/reports/sales/daily', response_model=list[SalesDayResponse])
+async def get_daily_sales(date_from: date, date_to: date, product_id: int = None, current_admin: User = Depends(get_current_admin_user), db: AsyncSession = Depends(get_db)):
+	# Reports read only the rollups, one row per day (and product), never the order tables.
+	table = DailySales if product_id is None else DailyProductSales
+	statement = (
+		select(table.sales_date, table.revenue, table.units, table.order_count)
+		.filter(table.sales_date.between(date_from, date_to))
+		.order_by(table.sales_date)
+		)
+	if product_id is not None:
+		statement = statement.filter(DailyProductSales.product_id == product_id)
+	result = await db.execute(statement)
+	return [dict(row) for row in result.mappings()]
 
 
 
-
-
-
+@router.get('/reports/sales/products', response_model=list[ProductSalesResponse])
+async def get_product_sales(date_from: date, date_to: date, limit: int = Query(50, ge=1, le=1000), current_admin: User = Depends(get_current_admin_user), db: AsyncSession = Depends(get_db)):
+	revenue = func.sum(DailyProductSales.revenue)
+	result = await db.execute(
+		select(
+			DailyProductSales.product_id,
+			revenue.label('revenue'),
+			func.sum(DailyProductSales.units).label('units'),
+			func.sum(DailyProductSales.order_count).label('order_count'),
+			)
+		.filter(DailyProductSales.sales_date.between(date_from, date_to))
+		.group_by(DailyProductSales.product_id)
+		.order_by(revenue.desc(), DailyProductSales.product_id)
+		.limit(limit)
+		)
+	return [dict(row) for row in result.mappings()]
@@ -1,13 +1,20 @@
-from fastapi import FastAPI, HTTPException, Depends, APIRouter, status
+from fastapi import FastAPI, HTTPException, Depends, APIRouter, status, Query, Response
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.responses import JSONResponse
-from sqlalchemy import select
+from sqlalchemy import select, update, delete, func, literal, true, tuple_, null, cast, union_all, DateTime
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import selectinload, joinedload
 from sqlalchemy.ext.asyncio import AsyncSession
-from database import User, CreateUser,UpdateEmail, UpdatePassword, UpdateBalance, get_db, Base, ProductResponse, ProductCreate, Product, ProductUpdate, OrderItemAdd, OrderItemResponse, Order, OrderItem, OrderResponse, OrderUpdate, MessageResponse,  UserResponse, AdminUpdateBalance
+from database import User, CreateUser,UpdateEmail, UpdatePassword, UpdateBalance, get_db, Base, ProductResponse, ProductCreate, Product, ProductUpdate, OrderItemAdd, OrderItemResponse, Order, OrderItem, ArchivedOrder, OrderResponse, OrderUpdate, CartBatchItem, CheckoutJob, CheckoutJobResponse, MessageResponse,  UserResponse, AdminUpdateBalance
 from security import get_password_hash, get_current_user, create_access_token, verify_password, get_current_admin_user
-from typing import Union
-from exceptions import ProductNotFoundException, InsufficientStockException, IncorrectPasswordRepedException, CartIsEmptyException, IncorrectPasswordException,  CartNotFoundException, OrderItemNotFoundException, QuantityNegativeException, InsufficientFundsException, EmptyCartException, UserAlreadyExistsException, InvalidCredentialsException, UserNotFoundException, NegativeDepositException
+from typing import Union, Optional
+from datetime import datetime
+from reservations import adjust_holds, available_quantity, hold_expiry
+from checkout import order_columns, pending_cart, create_pending_cart, empty_cart, cart_response, perform_checkout, invalidate_checkout
+from idempotency import IdempotentRequest, idempotent_request
+from cache import cart_cache
+from exceptions import CustomHTTPException, ProductNotFoundException, InsufficientStockException, IncorrectPasswordRepedException, CartIsEmptyException, IncorrectPasswordException,  CartNotFoundException, OrderItemNotFoundException, QuantityNegativeException, InsufficientFundsException, EmptyCartException, UserAlreadyExistsException, InvalidCredentialsException, UserNotFoundException, NegativeDepositException, CheckoutJobNotFoundException, InvalidCursorException
+import secrets
 import asyncio
 
 router = APIRouter(prefix='/orders', tags=['Orders'])
@@ -20,59 +27,120 @@ router = APIRouter(prefix='/orders', tags=['Orders'])
 
 
 
-@router.post('/cart/add',  response_model=Union[OrderResponse, MessageResponse])
-async def add_item_to_cart(item_add: OrderItemAdd, current_user: User = Depends(get_current_user), db: AsyncSession=Depends(get_db)):
-	result1 = await db.execute(select(Product).filter(Product.product_id == item_add.product_id))
-	product = result1.scalar_one_or_none()
-	if not product:
-		raise ProductNotFoundException()
-	if product.product_stock_quantity < item_add.product_quantity:
-		raise InsufficientStockException()
+checkout_job_columns = [getattr(CheckoutJob, name) for name in CheckoutJobResponse.model_fields]
 
-	result = await db.execute(select(Order).options(joinedload(Order.order_for_order_items)).filter(
-		Order.user_id == current_user.id,
-		Order.order_status == 'pending'
-		))
-	cart = result.scalars().unique().one_or_none()
 
-	result2 = await db.execute(select(OrderItem).filter(
-		OrderItem.order_id == cart.order_id,
+
+async def locked_cart_id(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+	# Locks the caller's cart row until the request's transaction ends. Declared after the
+	# idempotency dependency, so a replayed request never waits on the cart.
+	result = await db.execute(pending_cart(current_user.id, Order.order_id).with_for_update())
+	order_id = result.scalar_one_or_none()
+	if order_id is None:
+		await create_pending_cart(db, current_user.id)
+		result = await db.execute(pending_cart(current_user.id, Order.order_id).with_for_update())
+		order_id = result.scalar_one()
+	return order_id
+
+
+
+def add_to_cart_statement(user_id: int, item_add: OrderItemAdd):
+	# One statement: the cart lock, the line lock, the stock hold, the upsert of the cart line
+	# and the cart total all run as CTEs. The existing line is locked before the hold touches
+	# the product, the same order checkout and the hold sweeper use, and the lock makes its
+	# held state current rather than a snapshot. The hold covers the added quantity, plus the
+	# existing line if its hold has lapsed. Sharded products take no hold; their line only has
+	# to fit in the stock left on the shards. The total moves by the difference between the new
+	# and the old line, where the old quantity is taken from the upsert itself so concurrent
+	# adds cannot skew it.
+	cart = pending_cart(user_id, Order.order_id).with_for_update().cte('cart')
+	existing_line = select(OrderItem.product_quantity, OrderItem.order_items_price_now, OrderItem.reserved_until).filter(
+		OrderItem.order_id.in_(select(cart.c.order_id)),
 		OrderItem.product_id == item_add.product_id
-		))
-	order_item = result2.scalar_one_or_none()
+		).with_for_update().cte('existing_line')
+	unheld_quantity = select(existing_line.c.product_quantity).filter(existing_line.c.reserved_until.is_(None)).scalar_subquery()
+	hold_quantity = item_add.product_quantity + func.coalesce(unheld_quantity, 0)
+	hold = (
+		update(Product)
+		.where(Product.product_id == item_add.product_id, Product.product_stock_shards == 0, available_quantity() >= hold_quantity, select(cart.c.order_id).exists())
+		.values(product_reserved_quantity=Product.product_reserved_quantity + hold_quantity)
+		.returning(Product.product_id, Product.product_price, hold_expiry().label('reserved_until'))
+		.cte('hold')
+		)
+	unheld = select(Product.product_id, Product.product_price, cast(null(), DateTime).label('reserved_until')).filter(
+		Product.product_id == item_add.product_id,
+		Product.product_stock_shards > 0,
+		available_quantity() >= item_add.product_quantity + func.coalesce(select(existing_line.c.product_quantity).scalar_subquery(), 0),
+		select(cart.c.order_id).exists()
+		)
+	source = union_all(select(hold.c.product_id, hold.c.product_price, hold.c.reserved_until), unheld).subquery('source')
+	line_insert = insert(OrderItem).from_select(
+		['order_id', 'product_id', 'product_quantity', 'order_items_price_now', 'reserved_until'],
+		select(cart.c.order_id, source.c.product_id, literal(item_add.product_quantity), source.c.product_price, source.c.reserved_until).join(source, true())
+		)
+	line = line_insert.on_conflict_do_update(
+		constraint='uq_order_items_order_product',
+		set_={
+		'product_quantity': OrderItem.product_quantity + line_insert.excluded.product_quantity,
+		'order_items_price_now': line_insert.excluded.order_items_price_now,
+		'reserved_until': line_insert.excluded.reserved_until,
+		}
+		).returning(OrderItem.order_id, OrderItem.product_quantity, OrderItem.order_items_price_now).cte('line')
+	old_price = func.coalesce(select(existing_line.c.order_items_price_now).scalar_subquery(), line.c.order_items_price_now)
+	delta = line.c.order_items_price_now * line.c.product_quantity - old_price * (line.c.product_quantity - item_add.product_quantity)
+	return (
+		update(Order)
+		.filter(Order.order_id == line.c.order_id)
+		.values(order_amount=Order.order_amount + delta, order_updated_at=func.localtimestamp())
+		.returning(*order_columns)
+		.execution_options(synchronize_session=False)
+		)
 
-	if order_item:
-		order_item.product_quantity += item_add.product_quantity
-		order_item.order_items_price_now = product.product_price
 
-	else:
-		order_item = OrderItem(
-			order_id = cart.order_id,
-			product_id = item_add.product_id,
-			product_quantity = item_add.product_quantity,
-			order_items_price_now = product.product_price
-			)
-		db.add(order_item)
-		try:
 
-			await db.commit()
-			await db.refresh(order_item)
-			await db.refresh(cart)
-		except Exception as e:
-			await db.rollback()
-			raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
-	cart.order_amount = sum(
-		(item.order_items_price_now * item.product_quantity)
-		for item in cart.order_for_order_items
+def apply_cart_delta(order_id: int, delta: float):
+	return (
+		update(Order)
+		.filter(Order.order_id == order_id)
+		.values(order_amount=Order.order_amount + delta, order_updated_at=func.localtimestamp())
+		.returning(*order_columns)
 		)
+
+
+
+
+@router.post('/cart/add',  response_model=Union[OrderResponse, MessageResponse])
+async def add_item_to_cart(item_add: OrderItemAdd, current_user: User = Depends(get_current_user), db: AsyncSession=Depends(get_db), idempotency: Optional[IdempotentRequest] = Depends(idempotent_request)):
+	# Read before the commit, which expires current_user.
+	user_id = current_user.id
+	if item_add.product_quantity < 0:
+		raise QuantityNegativeException()
 	try:
-		await db.commit()
-		await db.refresh(order_item)
-		await db.refresh(cart)
+		result = await db.execute(add_to_cart_statement(user_id, item_add))
+		cart = result.mappings().one_or_none()
+		if not cart:
+			# Also retried when a concurrent first add created the cart: the insert waited for
+			# that commit, so the next statement sees the cart.
+			await create_pending_cart(db, user_id)
+			result = await db.execute(add_to_cart_statement(user_id, item_add))
+			cart = result.mappings().one_or_none()
+		if cart:
+			response = await cart_response(db, dict(cart))
+			if idempotency:
+				await idempotency.save(response)
+			await db.commit()
+			cart_cache.set(user_id, response)
 	except Exception as e:
 		await db.rollback()
 		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
-	return cart
+	if not cart:
+		result = await db.execute(select(Product.product_id).filter(Product.product_id == item_add.product_id))
+		if result.scalar_one_or_none() is None:
+			raise ProductNotFoundException()
+		# Either the added quantity does not fit, or the line's earlier hold has lapsed and its
+		# quantity no longer fits next to the new one.
+		raise InsufficientStockException()
+	return response
 
 
 
@@ -83,14 +151,149 @@ async def add_item_to_cart(item_add: OrderItemAdd, current_user: User = Depends(
 
 @router.get('/get', response_model=Union[OrderResponse, MessageResponse])
 async def get_order(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-	result = await db.execute(select(Order).options(selectinload(Order.order_for_order_items)).filter(
-		Order.user_id == current_user.id,
-		Order.order_status == 'pending'
-		))
-	cart = result.unique().scalar_one_or_none()
-	if not cart:
-		raise CartNotFoundException()
-	return cart 
+	cart = cart_cache.get(current_user.id)
+	if cart is not None:
+		return cart
+	generation = cart_cache.generation
+	result = await db.execute(pending_cart(current_user.id))
+	cart = result.mappings().one_or_none()
+	response = await cart_response(db, dict(cart)) if cart else empty_cart(current_user.id)
+	cart_cache.fill(current_user.id, response, generation)
+	return response
+
+
+
+
+
+
+def stored_time(value: datetime):
+	# Order times are naive timestamps written in the database session's time zone, so an aware
+	# filter value is converted there by the database. The conversion is done on the parameter,
+	# which keeps the comparison on the bare column and the index usable.
+	if value.tzinfo is None:
+		return value
+	return func.timezone(func.current_setting('TimeZone'), literal(value, DateTime(timezone=True)))
+
+
+
+@router.get('/history', response_model=list[OrderResponse])
+async def order_history(
+	response: Response,
+	order_status: str = 'completed',
+	since: Optional[datetime] = None,
+	until: Optional[datetime] = None,
+	limit: int = Query(20, ge=1, le=100),
+	after_time: Optional[datetime] = None,
+	after_id: Optional[int] = None,
+	current_user: User = Depends(get_current_user),
+	db: AsyncSession = Depends(get_db)
+	):
+	# Newest first, walked by keyset on (order_time_info, order_id) so every page is a range
+	# scan of ix_orders_user_status_time. Archived orders are all completed; for those the
+	# same page is also read from the archive's matching index and the two are merged.
+	if (after_time is None) != (after_id is None):
+		raise InvalidCursorException('after_time and after_id must be given together')
+	orders = []
+	for model in (Order, ArchivedOrder) if order_status == 'completed' else (Order,):
+		query = select(model).options(selectinload(model.order_for_order_items)).filter(
+			model.user_id == current_user.id,
+			model.order_status == order_status
+			)
+		if since is not None:
+			query = query.filter(model.order_time_info >= stored_time(since))
+		if until is not None:
+			query = query.filter(model.order_time_info < stored_time(until))
+		if after_id is not None:
+			query = query.filter(tuple_(model.order_time_info, model.order_id) < tuple_(stored_time(after_time), after_id))
+		query = query.order_by(model.order_time_info.desc(), model.order_id.desc()).limit(limit)
+		result = await db.execute(query)
+		orders.extend(result.scalars().all())
+	orders = sorted(orders, key=lambda order: (order.order_time_info, order.order_id), reverse=True)[:limit]
+	if len(orders) == limit:
+		response.headers['X-Next-Cursor'] = str(orders[-1].order_id)
+		response.headers['X-Next-Cursor-Time'] = orders[-1].order_time_info.isoformat()
+	return orders
+
+
+
+
+
+
+
+@router.post('/cart/batch', response_model=Union[OrderResponse, MessageResponse])
+async def batch_update_cart(cart_items: list[CartBatchItem], current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db), idempotency: Optional[IdempotentRequest] = Depends(idempotent_request), order_id: int = Depends(locked_cart_id)):
+	user_id = current_user.id
+	# Quantities are absolute (0 removes the line); a product listed twice keeps its last quantity.
+	quantities = {}
+	for cart_item in cart_items:
+		if cart_item.quantity < 0:
+			raise QuantityNegativeException()
+		quantities[cart_item.product_id] = cart_item.quantity
+
+	result = await db.execute(select(Product.product_id, Product.product_price, Product.product_stock_shards, available_quantity().label('available')).filter(Product.product_id.in_(quantities)))
+	products = {row.product_id: row for row in result}
+	if len(products) < len(quantities):
+		raise ProductNotFoundException()
+
+	# The touched lines are locked before their products, and the hold sweeper cannot release
+	# them meanwhile, so the new total is the old one plus the difference over those lines and
+	# lines that still hold stock only need the difference reserved (or released).
+	result = await db.execute(select(OrderItem.product_id, OrderItem.product_quantity, OrderItem.order_items_price_now, OrderItem.reserved_until).filter(
+		OrderItem.order_id == order_id,
+		OrderItem.product_id.in_(quantities)
+		).order_by(OrderItem.product_id).with_for_update())
+	existing = result.all()
+	held = {line.product_id: line.product_quantity for line in existing if line.reserved_until is not None}
+	amount_delta = sum(products[product_id].product_price * quantity for product_id, quantity in quantities.items()) - sum(
+		line.order_items_price_now * line.product_quantity for line in existing
+		)
+	if any(products[product_id].available + held.get(product_id, 0) < quantity for product_id, quantity in quantities.items()):
+		raise InsufficientStockException()
+	hold_deltas = {
+		product_id: quantity - held.get(product_id, 0) for product_id, quantity in quantities.items()
+		if quantity > 0 and quantity != held.get(product_id, 0) and not products[product_id].product_stock_shards
+		}
+
+	lines = [
+		{
+		'order_id': order_id,
+		'product_id': product_id,
+		'product_quantity': quantity,
+		'order_items_price_now': products[product_id].product_price,
+		'reserved_until': None if products[product_id].product_stock_shards else hold_expiry(),
+		}
+		for product_id, quantity in quantities.items() if quantity > 0
+		]
+	removed_ids = [product_id for product_id, quantity in quantities.items() if quantity == 0]
+	try:
+		if not await adjust_holds(db, hold_deltas):
+			await db.rollback()
+			raise InsufficientStockException()
+		if lines:
+			line_insert = insert(OrderItem).values(lines)
+			await db.execute(line_insert.on_conflict_do_update(
+				constraint='uq_order_items_order_product',
+				set_={
+				'product_quantity': line_insert.excluded.product_quantity,
+				'order_items_price_now': line_insert.excluded.order_items_price_now,
+				'reserved_until': line_insert.excluded.reserved_until,
+				}
+				))
+		if removed_ids:
+			await db.execute(delete(OrderItem).filter(OrderItem.order_id == order_id, OrderItem.product_id.in_(removed_ids)))
+		result = await db.execute(apply_cart_delta(order_id, amount_delta))
+		response = await cart_response(db, dict(result.mappings().one()))
+		if idempotency:
+			await idempotency.save(response)
+		await db.commit()
+	except CustomHTTPException:
+		raise
+	except Exception as e:
+		await db.rollback()
+		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
+	cart_cache.set(user_id, response)
+	return response
+
 
 
 
@@ -98,18 +301,12 @@ async def get_order(current_user: User = Depends(get_current_user), db: AsyncSes
 
 
 @router.patch('/cart/update/{order_items_id}', response_model=Union[OrderResponse, MessageResponse])
-async def update_cart_items_quantity( order_items_id: int, order_update: OrderUpdate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-	result = await db.execute(select(Order).options(selectinload(Order.order_for_order_items)).filter(
-		Order.user_id == current_user.id,
-		Order.order_status == 'pending'
-		))
-	cart = result.unique().scalar_one_or_none()
-	if not cart:
-		raise CartNotFoundException()
+async def update_cart_items_quantity( order_items_id: int, order_update: OrderUpdate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db), idempotency: Optional[IdempotentRequest] = Depends(idempotent_request), order_id: int = Depends(locked_cart_id)):
+	user_id = current_user.id
 	result2 = await db.execute(select(OrderItem).filter(
-		OrderItem.order_id == cart.order_id,
+		OrderItem.order_id == order_id,
 		OrderItem.order_items_id == order_items_id
-		))
+		).with_for_update())
 	order_item = result2.scalar_one_or_none()
 	if not order_item:
 		raise OrderItemNotFoundException()
@@ -117,27 +314,37 @@ async def update_cart_items_quantity( order_items_id: int, order_update: OrderUp
 	if order_update.quantity < 0:
 		raise QuantityNegativeException()
 
+	amount_delta = order_item.order_items_price_now * (order_update.quantity - order_item.product_quantity)
 	if order_update.quantity == 0:
 		await db.delete(order_item)
 
 	if order_update.quantity > 0:
+		result = await db.execute(select(Product.product_stock_shards, available_quantity()).filter(Product.product_id == order_item.product_id))
+		shards, available = result.one()
+		if shards:
+			if available < order_update.quantity:
+				await db.rollback()
+				raise InsufficientStockException()
+			order_item.reserved_until = None
+		else:
+			held_quantity = order_item.product_quantity if order_item.reserved_until is not None else 0
+			if not await adjust_holds(db, {order_item.product_id: order_update.quantity - held_quantity}):
+				await db.rollback()
+				raise InsufficientStockException()
+			order_item.reserved_until = hold_expiry()
 		order_item.product_quantity = order_update.quantity
 	try:
+		await db.flush()
+		result = await db.execute(apply_cart_delta(order_id, amount_delta))
+		response = await cart_response(db, dict(result.mappings().one()))
+		if idempotency:
+			await idempotency.save(response)
 		await db.commit()
-		await db.refresh(cart)
-		db.expire(cart, ['order_for_order_items'])
-		await db.refresh(cart, attribute_names=['order_for_order_items'])
-		cart.order_amount = sum(
-		(item.order_items_price_now * item.product_quantity)
-		for item in cart.order_for_order_items
-		)
-		await db.commit()
-		await db.refresh(cart)		
 	except Exception as e:
 		await db.rollback()
 		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
-
-	return cart
+	cart_cache.set(user_id, response)
+	return response
 
 
 
@@ -146,37 +353,29 @@ async def update_cart_items_quantity( order_items_id: int, order_update: OrderUp
 
 
 @router.delete('/item/cart/delete/{order_items_id}', response_model=Union[OrderResponse, MessageResponse])
-async def delete_item_from_cart( order_items_id: int, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-	result = await db.execute(select(Order).options(selectinload(Order.order_for_order_items)).filter(
-		Order.user_id == current_user.id,
-		Order.order_status == 'pending'
-		))
-	cart = result.unique().scalar_one_or_none()
-	if not cart:
-		raise CartNotFoundException()
+async def delete_item_from_cart( order_items_id: int, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db), idempotency: Optional[IdempotentRequest] = Depends(idempotent_request), order_id: int = Depends(locked_cart_id)):
+	user_id = current_user.id
 	result2 = await db.execute(select(OrderItem).filter(
-		OrderItem.order_id == cart.order_id,
+		OrderItem.order_id == order_id,
 		OrderItem.order_items_id == order_items_id
 		))
 	order_item = result2.scalar_one_or_none()
 	if not order_item:
 		raise OrderItemNotFoundException()
+	amount_delta = -order_item.order_items_price_now * order_item.product_quantity
 	await db.delete(order_item)
 	try:
+		await db.flush()
+		result = await db.execute(apply_cart_delta(order_id, amount_delta))
+		response = await cart_response(db, dict(result.mappings().one()))
+		if idempotency:
+			await idempotency.save(response)
 		await db.commit()
-		await db.refresh(cart)
-		await db.refresh(cart, attribute_names=['order_for_order_items'])
-		cart.order_amount = sum(
-		(item.order_items_price_now * item.product_quantity)
-		for item in cart.order_for_order_items
-		)
-		await db.commit()
-		await db.refresh(cart)		
 	except Exception as e:
 		await db.rollback()
 		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
-	
-	return cart
+	cart_cache.set(user_id, response)
+	return response
 
 
 
@@ -184,63 +383,52 @@ async def delete_item_from_cart( order_items_id: int, current_user: User = Depen
 
 
 @router.post('/checkout', response_model=Union[OrderResponse, MessageResponse])
-async def order_checkout(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-	result = await db.execute(select(Order).options(selectinload(Order.order_for_order_items)).filter(
-		Order.user_id == current_user.id,
-		Order.order_status == 'pending'
-		))
-	cart = result.unique().scalar_one_or_none()
-	if not cart.order_for_order_items:
-			raise CartIsEmptyException()
-	if not cart:
-		raise EmptyCartException()
-	for item in cart.order_for_order_items:
-		result1 = await db.execute(select(Product).filter(Product.product_id == item.product_id))
-		product = result1.scalar_one_or_none()
-		if not product:
-			raise ProductNotFoundException()
-		if item.product_quantity > product.product_stock_quantity:
-			raise HTTPException(status_code=400, detail=f'Error, product {item.product_id} has only {product.product_stock_quantity} units on our stock at the moment')
-		product.product_stock_quantity -= item.product_quantity
-	if current_user.balance < cart.order_amount:
-		raise InsufficientFundsException()
-	current_user.bonus_points += (cart.order_amount / 90)
-	current_user.balance -= cart.order_amount
-	cart.order_status = 'completed'
-	new_cart = Order(user_id = current_user.id, order_status = 'pending')
-	db.add(new_cart)
+async def order_checkout(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db), idempotency: Optional[IdempotentRequest] = Depends(idempotent_request)):
 	try:
+		response = await perform_checkout(db, current_user.id)
+		if idempotency:
+			await idempotency.save(response)
 		await db.commit()
-		await db.refresh(cart)
-		await db.refresh(new_cart)
+	except HTTPException:
+		await db.rollback()
+		raise
 	except Exception as e:
 		await db.rollback()
 		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
-	return cart
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+	await invalidate_checkout(db, response)
+	return response
 
 
 
 
 
 
+@router.post('/checkout/async', response_model=CheckoutJobResponse, status_code=status.HTTP_202_ACCEPTED)
+async def enqueue_checkout(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db), idempotency: Optional[IdempotentRequest] = Depends(idempotent_request)):
+	try:
+		result = await db.execute(
+			insert(CheckoutJob)
+			.values(token=secrets.token_urlsafe(16), user_id=current_user.id, job_status='queued')
+			.returning(*checkout_job_columns)
+			)
+		job = dict(result.mappings().one())
+		if idempotency:
+			await idempotency.save(job, status.HTTP_202_ACCEPTED)
+		await db.commit()
+	except Exception as e:
+		await db.rollback()
+		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
+	return job
 
 
 
 
 
 
+@router.get('/checkout/status/{token}', response_model=CheckoutJobResponse)
+async def checkout_status(token: str, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+	result = await db.execute(select(*checkout_job_columns).filter(CheckoutJob.token == token, CheckoutJob.user_id == current_user.id))
+	job = result.mappings().one_or_none()
+	if not job:
+		raise CheckoutJobNotFoundException()
+	return job
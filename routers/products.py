@@ -1,12 +1,26 @@
-from fastapi import FastAPI, HTTPException, Depends, APIRouter, status
+from fastapi import FastAPI, HTTPException, Depends, APIRouter, status, Query, Response, Request
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.responses import JSONResponse
-from sqlalchemy import select
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, update, delete, values, column, tuple_, func, literal_column, Integer
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import AsyncSession
-from database import User, CreateUser,UpdateEmail, UpdatePassword, UpdateBalance, get_db, Base, ProductResponse, ProductCreate, Product, ProductUpdate, OrderItemAdd, OrderItemResponse, Order, OrderItem, OrderResponse, OrderUpdate, MessageResponse,  UserResponse, AdminUpdateBalance
+from database import User, CreateUser,UpdateEmail, UpdatePassword, UpdateBalance, get_db, Base, PRODUCT_SEARCH_CONFIG, PRICE_FACET_BUCKET, ProductFacet, ProductFacetsResponse, ProductAvailability, ProductResponse, ProductCreate, ProductImportResponse, ProductImportError, Product, ProductUpdate, ProductBulkUpdateItem, ProductBulkUpdateResponse, ProductStockShard, StockShardsUpdate, StockShardsResponse, OrderItemAdd, OrderItemResponse, Order, OrderItem, OrderResponse, OrderUpdate, MessageResponse,  UserResponse, AdminUpdateBalance
 from security import get_password_hash, get_current_user, create_access_token, verify_password, get_current_admin_user
-from typing import Union
-from exceptions import ProductNotFoundException, InsufficientStockException, IncorrectPasswordRepedException, IncorrectPasswordException,  CartNotFoundException, OrderItemNotFoundException, QuantityNegativeException, InsufficientFundsException, EmptyCartException, UserAlreadyExistsException, InvalidCredentialsException, UserNotFoundException, NegativeDepositException
+from typing import Union, Optional, Literal, AsyncIterator
+from pydantic import ValidationError, TypeAdapter
+from cache import catalog_cache, cart_cache
+from reservations import available_quantity
+from stock_shards import set_stock_shards
+from sales_rollups import roll_up_product_orders
+from http_cache import CatalogConditionalGet, ConditionalGet, bump_catalog_version
+from serialization import product_rows, validate_rows
+import orjson
+from collections import defaultdict
+from operator import attrgetter
+import codecs
+import json
+import csv
+from exceptions import ProductNotFoundException, InsufficientStockException, IncorrectPasswordRepedException, IncorrectPasswordException,  CartNotFoundException, OrderItemNotFoundException, QuantityNegativeException, InsufficientFundsException, EmptyCartException, UserAlreadyExistsException, InvalidCredentialsException, UserNotFoundException, NegativeDepositException, InvalidCursorException, InvalidImportException
 
 
 
@@ -14,13 +28,156 @@ from exceptions import ProductNotFoundException, InsufficientStockException, Inc
 router = APIRouter(prefix='/products', tags=['Products'])
 
 
+STREAM_BATCH_SIZE = 1000
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_COLUMNS = list(ProductCreate.model_fields)
+import_rows_adapter = TypeAdapter(list[ProductCreate])
+product_import_values = attrgetter(*IMPORT_COLUMNS)
+product_columns = [getattr(Product, name) for name in ProductResponse.model_fields]
+
+
+
+async def stream_products(db: AsyncSession):
+	# The request-scoped session is already closed by get_db when the body starts streaming,
+	# so the server-side cursor runs on a fresh transaction that we close ourselves.
+	try:
+		result = await db.stream(
+			select(*product_columns).order_by(Product.product_id).execution_options(yield_per=STREAM_BATCH_SIZE)
+			)
+		async for rows in result.mappings().partitions():
+			yield b''.join(orjson.dumps(row) + b'\n' for row in validate_rows(product_rows, rows))
+	finally:
+		await db.close()
+
+
 
 
 @router.get('/all', response_model=list[ProductResponse])
-async def get_all_products(db: AsyncSession=Depends(get_db)):
-	result = await db.scalars(select(Product))
-	products = result.all()
-	return products
+async def get_all_products(limit: int = Query(100, ge=1, le=1000), after: Optional[int] = None, stream: bool = False, conditional: ConditionalGet = Depends(CatalogConditionalGet('products_all')), db: AsyncSession=Depends(get_db)):
+	if stream:
+		return StreamingResponse(stream_products(db), media_type='application/x-ndjson', headers=conditional.headers)
+	products = catalog_cache.get_page(limit, after)
+	if products is None:
+		version = catalog_cache.version
+		query = select(*product_columns).order_by(Product.product_id).limit(limit)
+		if after is not None:
+			query = query.filter(Product.product_id > after)
+		result = await db.execute(query)
+		products = validate_rows(product_rows, result.mappings())
+		catalog_cache.set_page(limit, after, products, version)
+	headers = {}
+	if len(products) == limit:
+		headers['X-Next-Cursor'] = str(products[-1]['product_id'])
+	return conditional.response(products, headers)
+
+
+
+
+
+
+@router.get('/search', response_model=list[ProductResponse])
+async def search_products(
+	product_color: Optional[str] = None,
+	product_size: Optional[int] = None,
+	min_price: Optional[float] = None,
+	max_price: Optional[float] = None,
+	in_stock: bool = False,
+	sort_by: Literal['id', 'price'] = 'id',
+	descending: bool = False,
+	limit: int = Query(20, ge=1, le=100),
+	after_id: Optional[int] = None,
+	after_price: Optional[float] = None,
+	conditional: ConditionalGet = Depends(CatalogConditionalGet('products_search')),
+	db: AsyncSession = Depends(get_db)
+	):
+	query = select(*product_columns)
+	if product_color is not None:
+		query = query.filter(Product.product_color == product_color)
+	if product_size is not None:
+		query = query.filter(Product.product_size == product_size)
+	if min_price is not None:
+		query = query.filter(Product.product_price >= min_price)
+	if max_price is not None:
+		query = query.filter(Product.product_price <= max_price)
+	if in_stock:
+		query = query.filter(Product.product_stock_quantity > 0)
+
+	sort_key = (Product.product_price, Product.product_id) if sort_by == 'price' else (Product.product_id,)
+	if after_id is not None:
+		if sort_by == 'price' and after_price is None:
+			raise InvalidCursorException('after_price is required together with after_id when sorting by price')
+		cursor = (after_price, after_id) if sort_by == 'price' else (after_id,)
+		key = tuple_(*sort_key)
+		query = query.filter(key < tuple_(*cursor) if descending else key > tuple_(*cursor))
+	query = query.order_by(*(column.desc() if descending else column.asc() for column in sort_key)).limit(limit)
+
+	result = await db.execute(query)
+	products = validate_rows(product_rows, result.mappings())
+	headers = {}
+	if len(products) == limit:
+		headers['X-Next-Cursor'] = str(products[-1]['product_id'])
+		if sort_by == 'price':
+			headers['X-Next-Cursor-Price'] = repr(products[-1]['product_price'])
+	return conditional.response(products, headers)
+
+
+
+
+
+
+@router.get('/search/text', response_model=list[ProductResponse])
+async def full_text_search_products(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=100), offset: int = Query(0, ge=0), conditional: ConditionalGet = Depends(CatalogConditionalGet('products_search')), db: AsyncSession = Depends(get_db)):
+	ts_query = func.websearch_to_tsquery(literal_column(f"'{PRODUCT_SEARCH_CONFIG}'::regconfig"), q)
+	rank = func.ts_rank_cd(Product.product_search, ts_query)
+	result = await db.execute(
+		select(*product_columns)
+		.filter(Product.product_search.op('@@')(ts_query))
+		.order_by(rank.desc(), Product.product_id)
+		.limit(limit)
+		.offset(offset)
+		)
+	return conditional.response(validate_rows(product_rows, result.mappings()))
+
+
+
+
+
+
+@router.get('/facets', response_model=ProductFacetsResponse)
+async def get_product_facets(conditional: ConditionalGet = Depends(CatalogConditionalGet('products_facets')), db: AsyncSession = Depends(get_db)):
+	result = await db.execute(
+		select(ProductFacet.facet, ProductFacet.value, ProductFacet.product_count)
+		.filter(ProductFacet.product_count > 0)
+		)
+	facets = {'colors': [], 'sizes': [], 'price_buckets': []}
+	for facet, value, count in result:
+		if facet == 'color':
+			facets['colors'].append({'value': value, 'count': count})
+		elif facet == 'size':
+			facets['sizes'].append({'value': int(value), 'count': count})
+		else:
+			min_price = float(value)
+			facets['price_buckets'].append({'min_price': min_price, 'max_price': min_price + PRICE_FACET_BUCKET, 'count': count})
+	facets['colors'].sort(key=lambda facet: facet['value'])
+	facets['sizes'].sort(key=lambda facet: facet['value'])
+	facets['price_buckets'].sort(key=lambda facet: facet['min_price'])
+	return conditional.response(facets)
+
+
+
+
+
+
+@router.get('/availability', response_model=list[ProductAvailability])
+async def get_product_availability(product_id: list[int] = Query(..., max_length=1000), db: AsyncSession = Depends(get_db)):
+	# Stock minus active cart holds (or the stock left on the shards of a sharded product),
+	# read straight off the primary key.
+	result = await db.execute(
+		select(Product.product_id, available_quantity().label('available_quantity'))
+		.filter(Product.product_id.in_(product_id))
+		.order_by(Product.product_id)
+		)
+	return [dict(row) for row in result.mappings()]
 
 
 
@@ -37,19 +194,143 @@ async def create_product( product: ProductCreate, current_admin: User = Depends(
 	except Exception as e:
 		await db.rollback()
 		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
+	await bump_catalog_version(db)
+	catalog_cache.invalidate_product(db_product.product_id)
 	return db_product
 
 
 
 
 
+async def iter_records(chunks: AsyncIterator[bytes], quoted: bool):
+	# Splits the body into records as it arrives; for CSV a newline only ends a record
+	# when it is outside a quoted field, i.e. the record has an even number of quotes.
+	decoder = codecs.getincrementaldecoder('utf-8-sig')()
+	buffer = ''
+	async for chunk in chunks:
+		buffer += decoder.decode(chunk)
+		start = search = 0
+		while (end := buffer.find('\n', search)) != -1:
+			search = end + 1
+			record = buffer[start:search]
+			if quoted and record.count('"') % 2:
+				continue
+			yield record
+			start = search
+		buffer = buffer[start:]
+	buffer += decoder.decode(b'', final=True)
+	if buffer:
+		yield buffer
+
+
+
+async def iter_import_chunks(chunks: AsyncIterator[bytes], quoted: bool):
+	# Pairs each record with the line of the body it starts on. Lines are counted before blank
+	# records are dropped, so the row numbers in the error report point at the uploaded file.
+	chunk = []
+	line = 1
+	async for record in iter_records(chunks, quoted):
+		row = line
+		line += record.count('\n')
+		if not record.strip():
+			continue
+		chunk.append((row, record))
+		if len(chunk) >= IMPORT_CHUNK_SIZE:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+
+
+def parse_import_chunk(records: list[tuple[int, str]], format: str, header: list[str], report: ProductImportResponse):
+	if format == 'csv':
+		return [(row, dict(zip(header, values))) for (row, _), values in zip(records, csv.reader(record for _, record in records))]
+	rows = []
+	for row, record in records:
+		try:
+			rows.append((row, json.loads(record)))
+		except ValueError as e:
+			report.errors.append(ProductImportError(row=row, errors=[f'row: Invalid JSON: {e}']))
+			report.failed += 1
+	return rows
+
+
+
+def validate_import_chunk(rows: list[tuple[int, object]], report: ProductImportResponse):
+	# The whole chunk is validated in one pydantic-core call; only a chunk with errors
+	# is split into failed rows and valid rows.
+	try:
+		products = import_rows_adapter.validate_python([data for _, data in rows])
+	except ValidationError as e:
+		errors = defaultdict(list)
+		for error in e.errors():
+			index, *field = error['loc']
+			errors[index].append(f"{'.'.join(map(str, field)) or 'row'}: {error['msg']}")
+		for index, messages in errors.items():
+			report.errors.append(ProductImportError(row=rows[index][0], errors=messages))
+		report.failed += len(errors)
+		products = import_rows_adapter.validate_python([data for index, (_, data) in enumerate(rows) if index not in errors])
+	return list(map(product_import_values, products))
+
+
+
+async def copy_products(db: AsyncSession, records: list[tuple]):
+	connection = await db.connection()
+	raw_connection = await connection.get_raw_connection()
+	await raw_connection.driver_connection.copy_records_to_table('products', records=records, columns=IMPORT_COLUMNS)
+
+
+
+
+@router.post('/admin/import', response_model=ProductImportResponse)
+async def import_products(request: Request, format: Optional[Literal['csv', 'ndjson']] = None, current_admin: User = Depends(get_current_admin_user), db: AsyncSession = Depends(get_db)):
+	if format is None:
+		format = 'csv' if 'csv' in request.headers.get('content-type', '') else 'ndjson'
+	report = ProductImportResponse(imported=0, failed=0)
+	header = None
+	try:
+		async for chunk in iter_import_chunks(request.stream(), quoted=format == 'csv'):
+			if format == 'csv' and header is None:
+				header = [name.strip() for name in next(csv.reader([chunk[0][1]]))]
+				chunk = chunk[1:]
+			rows = parse_import_chunk(chunk, format, header, report)
+			products = validate_import_chunk(rows, report)
+			if products:
+				await copy_products(db, products)
+				report.imported += len(products)
+		await db.commit()
+	except (UnicodeDecodeError, csv.Error) as e:
+		# A body that is not UTF-8 text or not readable as CSV is the client's mistake, not ours.
+		await db.rollback()
+		raise InvalidImportException(f'Invalid {format} body: {str(e)}')
+	except Exception as e:
+		await db.rollback()
+		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
+	report.errors.sort(key=lambda error: error.row)
+	await bump_catalog_version(db)
+	# COPY does not return the new ids; imports are rare enough to drop the whole catalog cache.
+	catalog_cache.invalidate_all()
+	return report
+
+
+
+
+
+
 @router.get('/admin/get/{product_id}', response_model=Union[ProductResponse, MessageResponse])
-async def product_info( product_id: int, current_admin: User = Depends(get_current_admin_user), db: AsyncSession = Depends(get_db)):
-	result = await db.execute(select(Product).filter(Product.product_id == product_id))
-	db_product = result.scalar_one_or_none()
-	if not db_product:
+async def product_info( product_id: int, current_admin: User = Depends(get_current_admin_user), conditional: ConditionalGet = Depends(CatalogConditionalGet('product_info')), db: AsyncSession = Depends(get_db)):
+	db_product = catalog_cache.get_product(product_id)
+	if db_product is not None:
+		return conditional.response(db_product)
+	version = catalog_cache.version
+	result = await db.execute(select(*product_columns).filter(Product.product_id == product_id))
+	row = result.mappings().one_or_none()
+	if not row:
 		raise ProductNotFoundException()
-	return db_product
+	db_product = validate_rows(product_rows, [row])[0]
+	catalog_cache.set_product(product_id, db_product, version)
+	return conditional.response(db_product)
 
 
 
@@ -58,17 +339,28 @@ async def product_info( product_id: int, current_admin: User = Depends(get_curre
 
 @router.delete('/admin/delete/{product_id}', response_model=MessageResponse)
 async def delete_product( product_id: int, current_admin: User = Depends(get_current_admin_user), db: AsyncSession = Depends(get_db)):
-	result = await db.execute(select(Product).filter(Product.product_id == product_id))
+	# The product and its stock shards are locked first, as set_stock_shards does, so no
+	# checkout can complete an order of it between the rollup and the delete.
+	result = await db.execute(select(Product).filter(Product.product_id == product_id).with_for_update())
 	product = result.scalar_one_or_none()
 	if not product:
 		raise ProductNotFoundException()
-	await db.delete(product)
+	product_name = product.product_name
+	await db.execute(select(ProductStockShard.shard_id).filter(ProductStockShard.product_id == product_id).with_for_update())
+	await roll_up_product_orders(db, product_id)
+	# Deleted in SQL, not through the ORM, so the database cascade removes the product's lines
+	# (and their stock holds) instead of leaving them with a null product_id.
+	await db.execute(delete(Product).filter(Product.product_id == product_id))
 	try:
 		await db.commit()
 	except Exception as e:
 		await db.rollback()
 		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
-	return {'message': f'Product {product.product_name} with id: {product.product_id} is deleted'}	
+	await bump_catalog_version(db)
+	catalog_cache.invalidate_product(product_id)
+	# Deleting a product cascades its lines out of every cart and order that held it.
+	cart_cache.invalidate_all()
+	return {'message': f'Product {product_name} with id: {product_id} is deleted'}	
 
 
 
@@ -85,11 +377,16 @@ async def update_product( product_id: int, product_update: ProductUpdate, curren
 	for key, value in update_data.items():
 		setattr (product, key, value)
 	try:
+		if 'product_stock_quantity' in update_data and product.product_stock_shards:
+			await db.flush()
+			await set_stock_shards(db, product_id, product.product_stock_shards, update_data['product_stock_quantity'])
 		await db.commit()
 		await db.refresh(product)
 	except Exception as e:
 		await db.rollback()
 		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
+	await bump_catalog_version(db)
+	catalog_cache.invalidate_product(product_id)
 	return product 
 
 
@@ -97,26 +394,86 @@ async def update_product( product_id: int, product_update: ProductUpdate, curren
 
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+@router.put('/admin/{product_id}/stock/shards', response_model=StockShardsResponse)
+async def update_stock_shards(product_id: int, shards_update: StockShardsUpdate, current_admin: User = Depends(get_current_admin_user), db: AsyncSession = Depends(get_db)):
+	# Sharding splits a hot product's stock over several rows so flash-sale checkouts do not
+	# queue on one lock; 0 shards moves the stock back onto the product row.
+	try:
+		total = await set_stock_shards(db, product_id, shards_update.shards)
+		if total is None:
+			raise ProductNotFoundException()
+		await db.commit()
+	except ProductNotFoundException:
+		raise
+	except Exception as e:
+		await db.rollback()
+		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
+	await bump_catalog_version(db)
+	catalog_cache.invalidate_product(product_id)
+	return {'product_id': product_id, 'product_stock_shards': shards_update.shards, 'available_quantity': total}
+
+
+
+
+
+
+@router.patch('/admin/bulk/refresh', response_model=ProductBulkUpdateResponse)
+async def bulk_update_products(product_updates: list[ProductBulkUpdateItem], current_admin: User = Depends(get_current_admin_user), db: AsyncSession = Depends(get_db)):
+	patches = {}
+	failed_ids = []
+	for product_update in product_updates:
+		update_data = product_update.model_dump(exclude_unset=True)
+		product_id = update_data.pop('product_id')
+		if not update_data or product_id in patches:
+			failed_ids.append(product_id)
+			continue
+		patches[product_id] = update_data
+
+	# One UPDATE ... FROM (VALUES ...) per distinct set of patched columns, so a patch
+	# never overwrites a column it did not mention.
+	groups = defaultdict(list)
+	for product_id, update_data in patches.items():
+		groups[tuple(sorted(update_data))].append(product_id)
+	updated_ids = []
+	for fields, product_ids in groups.items():
+		patch = values(
+			column('product_id', Integer),
+			*(column(field, Product.__table__.c[field].type) for field in fields),
+			name='patch'
+			).data([(product_id, *(patches[product_id][field] for field in fields)) for product_id in product_ids])
+		statement = (
+			update(Product)
+			.where(Product.product_id == patch.c.product_id)
+			.values({field: patch.c[field] for field in fields})
+			.returning(Product.product_id)
+			.execution_options(synchronize_session=False)
+			)
+		try:
+			async with db.begin_nested():
+				result = await db.execute(statement)
+				updated_ids.extend(result.scalars())
+		except DBAPIError:
+			failed_ids.extend(product_ids)
+	try:
+		stock_ids = [product_id for product_id in updated_ids if 'product_stock_quantity' in patches[product_id]]
+		if stock_ids:
+			result = await db.execute(select(Product.product_id, Product.product_stock_shards).filter(Product.product_id.in_(stock_ids), Product.product_stock_shards > 0))
+			for product_id, shards in result.all():
+				await set_stock_shards(db, product_id, shards, patches[product_id]['product_stock_quantity'])
+		await db.commit()
+	except Exception as e:
+		await db.rollback()
+		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
+	if updated_ids:
+		await bump_catalog_version(db)
+	for product_id in updated_ids:
+		catalog_cache.invalidate_product(product_id)
+
+	missing_ids = sorted(set(patches) - set(updated_ids) - set(failed_ids))
+	return {
+	'updated': len(updated_ids),
+	'missing': len(missing_ids),
+	'failed': len(failed_ids),
+	'missing_ids': missing_ids,
+	'failed_ids': failed_ids,
+	}
@@ -2,10 +2,12 @@ from fastapi import FastAPI, HTTPException, Depends, status, APIRouter
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.responses import JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update, delete as sql_delete
 from database import User, CreateUser,UpdateEmail, UpdatePassword, UpdateBalance, get_db, Base, ProductResponse, ProductCreate, Product, ProductUpdate, OrderItemAdd, OrderItemResponse, Order, OrderItem, OrderResponse, OrderUpdate, MessageResponse,  UserResponse, AdminUpdateBalance
 from security import get_password_hash, get_current_user, create_access_token, verify_password, get_current_admin_user
-from typing import Union
+from typing import Union, Optional
+from idempotency import IdempotentRequest, idempotent_request
+from cache import principal_cache
 from exceptions import ProductNotFoundException, InsufficientStockException, IncorrectPasswordRepedException, IncorrectPasswordException,  CartNotFoundException, OrderItemNotFoundException, QuantityNegativeException, InsufficientFundsException, EmptyCartException, UserAlreadyExistsException, InvalidCredentialsException, UserNotFoundException, NegativeDepositException
 
 
@@ -25,9 +27,6 @@ async def registration(user: CreateUser, db: AsyncSession = Depends(get_db)):
 	new_user = User(email = user.email, hashed_password=hashed_password)
 	db.add(new_user)
 	try:
-		await db.flush()
-		cart = Order(user_id = new_user.id, order_status = 'pending')
-		db.add(cart)
 		await db.commit()
 		await db.refresh(new_user)
 	except Exception as e:
@@ -46,9 +45,12 @@ async def login(form_data: OAuth2PasswordRequestForm=Depends(), db: AsyncSession
 	user = result.scalar_one_or_none()
 	if not user:
 		raise UserNotFoundException()
-	if not await verify_password(form_data.password, user.hashed_password):
+	email, hashed_password = user.email, user.hashed_password
+	# Ends the read so the connection goes back to the pool while the hash is checked.
+	await db.commit()
+	if not await verify_password(form_data.password, hashed_password):
 		raise InvalidCredentialsException()
-	access_token = await create_access_token(data={'sub': user.email})
+	access_token = await create_access_token(data={'sub': email})
 	return {
 	'access_token': access_token,
 	'token_type': 'bearer'
@@ -71,20 +73,32 @@ async def get_me(current_user: User = Depends(get_current_user)):
 
 
 @router.patch('/add/balance')
-async def deposit(update_balance: UpdateBalance, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+async def deposit(update_balance: UpdateBalance, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db), idempotency: Optional[IdempotentRequest] = Depends(idempotent_request)):
 	if update_balance.amount < 0:
 		raise NegativeDepositException()
-	current_user.balance += update_balance.amount
+	user_id = current_user.id
 	try:
+		# Incremented in SQL: current_user may come from the principal cache, so its balance
+		# is not necessarily the one in the row.
+		result = await db.execute(
+			update(User)
+			.filter(User.id == user_id)
+			.values(balance=User.balance + update_balance.amount)
+			.returning(User.balance)
+			.execution_options(synchronize_session='fetch')
+			)
+		response = {
+		'message': f'Balance updated by {update_balance.amount} $',
+		'new_balance': result.scalar_one()
+		}
+		if idempotency:
+			await idempotency.save(response)
 		await db.commit()
-		await db.refresh(current_user)
 	except Exception as e:
 		await db.rollback()
 		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
-	return {
-	'message': f'Balance updated by {update_balance.amount} $',
-	'new_balance': current_user.balance
-	}
+	principal_cache.invalidate(user_id)
+	return response
 
 
 
@@ -105,6 +119,7 @@ async def change_password(change_password: UpdatePassword, current_user: User =
 	except Exception as e:
 		await db.rollback()
 		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
+	principal_cache.invalidate(current_user.id)
 	return {'message': 'Accept your password is change'}
 
 
@@ -124,6 +139,7 @@ async def change_email(change_email: UpdateEmail, current_user: User = Depends(g
 	except Exception as e:
 		await db.rollback()
 		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
+	principal_cache.invalidate(current_user.id)
 	return {'message': f'Accept your email is change, new email: {current_user.email}'}
 
 
@@ -141,13 +157,17 @@ async def delete(current_user: User = Depends(get_current_user), db: AsyncSessio
 	# cart = result.unique().scalar_one_or_none()
 	# if  cart:
 	# 	await db.delete(cart)
-	await db.delete(user)
+	user_id, email = user.id, user.email
+	# Deleted in SQL so the database cascades it to the orders and their lines, which releases
+	# the stock held by the cart.
+	await db.execute(sql_delete(User).filter(User.id == user_id))
 	try:
 		await db.commit()
 	except Exception as e:
 		await db.rollback()
 		raise HTTPException(status_code=500, detail=f'DB Error: {str(e)}')
-	return {'message': f'User {user.email}, is deleted'}
+	principal_cache.invalidate(user_id)
+	return {'message': f'User {email}, is deleted'}
 
 
 
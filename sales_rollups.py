@@ -0,0 +1,150 @@
+from sqlalchemy import select, update, func, cast, and_, literal_column, Date
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, Order, OrderItem, DailyProductSales, DailySales
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import logging
+import time
+import os
+
+
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+SALES_ROLLUP_INTERVAL = float(os.getenv('SALES_ROLLUP_INTERVAL', 60))
+SALES_ROLLUP_BATCH_SIZE = int(os.getenv('SALES_ROLLUP_BATCH_SIZE', 1000))
+
+
+
+def add_to_rollup(table, key_columns: list[str], rows):
+	statement = insert(table).from_select([*key_columns, 'revenue', 'units', 'order_count'], rows)
+	return statement.on_conflict_do_update(
+		index_elements=key_columns,
+		set_={
+		'revenue': table.revenue + statement.excluded.revenue,
+		'units': table.units + statement.excluded.units,
+		'order_count': table.order_count + statement.excluded.order_count,
+		},
+		)
+
+
+
+def unrolled_orders():
+	return and_(Order.order_status == literal_column("'completed'"), Order.order_rolled_up.is_(False))
+
+
+
+async def add_orders_to_rollups(db: AsyncSession, orders):
+	# Marks the orders matching the condition and adds their lines to the rollups. The mark
+	# and the additions commit together, so an order is counted exactly once. Orders are
+	# dated by their completion time. Leaves committing to the caller.
+	result = await db.execute(
+		update(Order)
+		.where(orders)
+		.values(order_rolled_up=True)
+		.returning(Order.order_id)
+		.execution_options(synchronize_session=False)
+		)
+	order_ids = result.scalars().all()
+	if order_ids:
+		sales_date = cast(Order.order_updated_at, Date)
+		lines = and_(Order.order_id.in_(order_ids), OrderItem.order_id == Order.order_id)
+		# Lines whose product_id was nulled by a product deleted before product deletes
+		# cascaded only count towards the daily totals.
+		await db.execute(add_to_rollup(DailyProductSales, ['sales_date', 'product_id'],
+			select(
+				sales_date,
+				OrderItem.product_id,
+				func.sum(OrderItem.order_items_price_now * OrderItem.product_quantity),
+				func.sum(OrderItem.product_quantity),
+				func.count(),
+				)
+			.filter(lines, OrderItem.product_id.is_not(None))
+			.group_by(sales_date, OrderItem.product_id)
+			))
+		await db.execute(add_to_rollup(DailySales, ['sales_date'],
+			select(
+				sales_date,
+				func.sum(OrderItem.order_items_price_now * OrderItem.product_quantity),
+				func.sum(OrderItem.product_quantity),
+				func.count(func.distinct(Order.order_id)),
+				)
+			.filter(lines)
+			.group_by(sales_date)
+			))
+	return order_ids
+
+
+
+async def roll_up_orders(db: AsyncSession, batch_size: int = SALES_ROLLUP_BATCH_SIZE):
+	# Completed orders not yet counted are found through ix_orders_unrolled, which only ever
+	# holds the orders completed since the last run. SKIP LOCKED lets several runs share the
+	# backlog.
+	batch = (
+		select(Order.order_id)
+		.filter(unrolled_orders())
+		.order_by(Order.order_id)
+		.limit(batch_size)
+		.with_for_update(skip_locked=True)
+		)
+	order_ids = await add_orders_to_rollups(db, Order.order_id.in_(batch.scalar_subquery()))
+	await db.commit()
+	return len(order_ids)
+
+
+
+async def roll_up_product_orders(db: AsyncSession, product_id: int):
+	# Deleting a product cascades its lines away, so the completed orders that hold one are
+	# counted first, in the delete's transaction. Orders a rollup run has locked are waited
+	# for rather than skipped, and come back already marked. Leaves committing to the caller.
+	product_orders = select(OrderItem.order_id).filter(OrderItem.product_id == product_id)
+	order_ids = await add_orders_to_rollups(db, and_(unrolled_orders(), Order.order_id.in_(product_orders)))
+	return len(order_ids)
+
+
+
+async def roll_up_sales(db: AsyncSession, batch_size: int = SALES_ROLLUP_BATCH_SIZE):
+	orders, batches = 0, 0
+	start = time.perf_counter()
+	batch_orders = batch_size
+	while batch_orders == batch_size:
+		batch_orders = await roll_up_orders(db, batch_size)
+		orders += batch_orders
+		batches += 1
+	return {
+	'orders': orders,
+	'batches': batches,
+	'seconds': round(time.perf_counter() - start, 3),
+	}
+
+
+
+async def run_sales_rollup(session_factory=AsyncSessionLocal, interval: float = SALES_ROLLUP_INTERVAL, batch_size: int = SALES_ROLLUP_BATCH_SIZE):
+	while True:
+		await asyncio.sleep(interval)
+		try:
+			async with session_factory() as db:
+				stats = await roll_up_sales(db, batch_size)
+			if stats['orders']:
+				logger.info(f"Rolled up {stats['orders']} orders in {stats['batches']} batches, {stats['seconds']}s")
+		except Exception as e:
+			logger.exception(f'Sales rollup failed: {str(e)}')
+
+
+
+async def main(batch_size: int):
+	async with AsyncSessionLocal() as db:
+		stats = await roll_up_sales(db, batch_size)
+	print(stats)
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Add completed orders to the daily sales rollups.')
+	parser.add_argument('--batch-size', type=int, default=SALES_ROLLUP_BATCH_SIZE)
+	args = parser.parse_args()
+	asyncio.run(main(args.batch_size))
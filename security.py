@@ -2,13 +2,20 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
 from passlib.context import CryptContext
 from jose import jwt, JWTError
 from dotenv  import load_dotenv
 from datetime import datetime, timedelta, UTC
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import asyncio
+import time
 import os 
 import sys
 from database import get_db, User
+from exceptions import PasswordHashingBusyException
+from cache import principal_cache
 
 
 
@@ -18,18 +25,91 @@ load_dotenv()
 SECRET_KEY = os.getenv('SECRET_KEY')
 ALGORITHM = os.getenv('ALGORITHM')
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv('PASSWORD_HASH_MAX_QUEUE', 64))
+PASSWORD_HASH_SAMPLES = 1000
 pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
 oauth2_scheme=OAuth2PasswordBearer(tokenUrl='/users/login')
 
 
 
+def percentile_ms(samples, fraction: float):
+	if not samples:
+		return 0.0
+	ordered = sorted(samples)
+	return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 1)
+
+
+
+class PasswordHasher:
+	# bcrypt releases the GIL, so running it on a thread pool keeps the event loop serving other
+	# requests. Calls beyond the workers wait in the pool's queue; once max_queue are waiting,
+	# new ones are refused instead of queueing up seconds of CPU work.
+	def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_queue: int = PASSWORD_HASH_MAX_QUEUE):
+		self.workers = workers
+		self.max_queue = max_queue
+		self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+		self.in_flight = 0
+		self.clear()
+
+
+	async def run(self, function, *args):
+		if self.in_flight >= self.workers + self.max_queue:
+			self.rejected += 1
+			raise PasswordHashingBusyException()
+		self.in_flight += 1
+		submitted = time.perf_counter()
+		try:
+			started, finished, result = await asyncio.get_running_loop().run_in_executor(self.executor, self._timed, function, args)
+		finally:
+			self.in_flight -= 1
+		self.completed += 1
+		self.queue_wait.append(started - submitted)
+		self.hash_time.append(finished - started)
+		return result
+
+
+	@staticmethod
+	def _timed(function, args):
+		started = time.perf_counter()
+		result = function(*args)
+		return started, time.perf_counter(), result
+
+
+	def clear(self):
+		self.completed = 0
+		self.rejected = 0
+		self.queue_wait = deque(maxlen=PASSWORD_HASH_SAMPLES)
+		self.hash_time = deque(maxlen=PASSWORD_HASH_SAMPLES)
+
+
+	def stats(self):
+		# Percentiles cover the last PASSWORD_HASH_SAMPLES calls.
+		return {
+		'workers': self.workers,
+		'max_queue': self.max_queue,
+		'in_flight': self.in_flight,
+		'completed': self.completed,
+		'rejected': self.rejected,
+		'queue_wait_p50_ms': percentile_ms(self.queue_wait, 0.5),
+		'queue_wait_p99_ms': percentile_ms(self.queue_wait, 0.99),
+		'hash_time_p50_ms': percentile_ms(self.hash_time, 0.5),
+		'hash_time_p99_ms': percentile_ms(self.hash_time, 0.99),
+		}
+
+
+
+password_hasher = PasswordHasher()
+
+
+
 async def get_password_hash(password):
-	return pwd_context.hash(password)
+	return await password_hasher.run(pwd_context.hash, password)
 
 
 
 async def verify_password(plain_password, hashed_password):
-	return pwd_context.verify(plain_password, hashed_password)
+	return await password_hasher.run(pwd_context.verify, plain_password, hashed_password)
 
 
 
@@ -48,10 +128,18 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
 			raise HTTPException(status_code=401, detail='Invalid token')
 	except JWTError:
 		raise HTTPException(status_code=401, detail='Invalid token')
+	snapshot = principal_cache.get(email)
+	if snapshot is not None:
+		# Attached without a query; handlers can still change and commit it as usual.
+		user = User(**snapshot)
+		make_transient_to_detached(user)
+		return await db.merge(user, load=False)
+	generation = principal_cache.generation
 	result = await db.execute(select(User).filter(User.email == email))
 	user = result.scalar_one_or_none()
 	if not user:
 		raise HTTPException(status_code=404, detail='User not found')
+	principal_cache.fill(email, {column.name: getattr(user, column.name) for column in User.__table__.columns}, generation)
 	return user 
 
 
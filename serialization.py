@@ -0,0 +1,28 @@
+from fastapi.responses import Response
+from pydantic import BaseModel, TypeAdapter
+from typing_extensions import TypedDict
+from database import ProductResponse, UserResponse
+import orjson
+
+
+
+def row_adapter(model: type[BaseModel], **overrides):
+	# A TypedDict mirror of the response model validates plain column rows without
+	# building model instances, and the resulting dicts go straight to orjson.
+	fields = {name: overrides.get(name, field.annotation) for name, field in model.model_fields.items()}
+	return TypeAdapter(list[TypedDict(f'{model.__name__}Row', fields)])
+
+
+product_rows = row_adapter(ProductResponse)
+# Stored emails were validated on the way in, so reads skip the EmailStr check.
+user_rows = row_adapter(UserResponse, email=str)
+
+
+
+def validate_rows(adapter: TypeAdapter, rows):
+	return adapter.validate_python([dict(row) for row in rows])
+
+
+
+def rows_response(rows: list[dict], headers: dict = None):
+	return Response(content=orjson.dumps(rows), media_type='application/json', headers=headers)
@@ -0,0 +1,226 @@
+from sqlalchemy import select, update, delete, insert, func, values, column, Integer
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, Product, ProductStockShard, OrderItem
+from cache import catalog_cache
+from http_cache import bump_catalog_version
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+
+
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+STOCK_SHARD_REBALANCE_INTERVAL = float(os.getenv('STOCK_SHARD_REBALANCE_INTERVAL', 10))
+STOCK_SHARD_REBALANCE_BATCH_SIZE = int(os.getenv('STOCK_SHARD_REBALANCE_BATCH_SIZE', 100))
+
+
+
+def split_stock(total: int, shards: int):
+	return [total // shards + (1 if shard_id < total % shards else 0) for shard_id in range(shards)]
+
+
+
+async def set_stock_shards(db: AsyncSession, product_id: int, shards: int, total: int = None):
+	# Moves a product in or out of sharded mode (or changes its shard count), keeping its total
+	# stock unless a new one is given. Sharded products take no cart holds, so the product's
+	# outstanding holds are dropped; the carts keep their lines and checkout re-checks the stock.
+	# Returns the total stock, or None if there is no such product. Leaves committing to the caller.
+	result = await db.execute(select(Product.product_stock_quantity, Product.product_stock_shards).filter(Product.product_id == product_id).with_for_update())
+	product = result.one_or_none()
+	if product is None:
+		return None
+	if product.product_stock_shards:
+		result = await db.execute(select(ProductStockShard.shard_quantity).filter(ProductStockShard.product_id == product_id).with_for_update())
+		if total is None:
+			total = sum(result.scalars())
+		await db.execute(delete(ProductStockShard).filter(ProductStockShard.product_id == product_id))
+	else:
+		await db.execute(
+			update(OrderItem)
+			.filter(OrderItem.product_id == product_id, OrderItem.reserved_until.is_not(None))
+			.values(reserved_until=None)
+			.execution_options(synchronize_session=False)
+			)
+	if total is None:
+		total = product.product_stock_quantity or 0
+	if shards:
+		await db.execute(insert(ProductStockShard), [
+			{'product_id': product_id, 'shard_id': shard_id, 'shard_quantity': quantity}
+			for shard_id, quantity in enumerate(split_stock(total, shards))
+			])
+	await db.execute(
+		update(Product)
+		.filter(Product.product_id == product_id)
+		.values(product_stock_quantity=total, product_reserved_quantity=0, product_stock_shards=shards)
+		.execution_options(synchronize_session=False)
+		)
+	return total
+
+
+
+async def take_from_one_shard(db: AsyncSession, statement):
+	# A locking read or conditional update that finds its row changed under it keeps the lock
+	# on the row even when it no longer qualifies. Such a stray shard lock would break the
+	# shard order of the fallback, so each attempt runs in a savepoint rolled back on a miss.
+	savepoint = await db.begin_nested()
+	result = await db.execute(statement)
+	if result.scalar_one_or_none() is None:
+		await savepoint.rollback()
+		return False
+	await savepoint.commit()
+	return True
+
+
+
+async def take_sharded_stock(db: AsyncSession, product_id: int, quantity: int):
+	# Takes the whole quantity from one random shard that can cover it: first one no other
+	# checkout is holding, then (if all of them are busy) by queueing on a random one, so
+	# waiters spread over the shards. Only if no single shard has enough is every shard
+	# locked in shard order and the quantity taken across them. Returns False if the shards
+	# together do not have enough.
+	candidate = (
+		select(ProductStockShard.product_id, ProductStockShard.shard_id)
+		.filter(ProductStockShard.product_id == product_id, ProductStockShard.shard_quantity >= quantity)
+		.order_by(func.random())
+		.limit(1)
+		.with_for_update(skip_locked=True)
+		.cte('candidate')
+		)
+	taken = await take_from_one_shard(db,
+		update(ProductStockShard)
+		.where(ProductStockShard.product_id == candidate.c.product_id, ProductStockShard.shard_id == candidate.c.shard_id)
+		.values(shard_quantity=ProductStockShard.shard_quantity - quantity)
+		.returning(ProductStockShard.shard_id)
+		.execution_options(synchronize_session=False)
+		)
+	if taken:
+		return True
+
+	# Queued on a single row by a plain conditional update: a FOR UPDATE over several
+	# candidates would go on to lock other shards in random order.
+	result = await db.execute(
+		select(ProductStockShard.shard_id)
+		.filter(ProductStockShard.product_id == product_id, ProductStockShard.shard_quantity >= quantity)
+		.order_by(func.random())
+		.limit(1)
+		)
+	shard_id = result.scalar_one_or_none()
+	if shard_id is not None:
+		taken = await take_from_one_shard(db,
+			update(ProductStockShard)
+			.where(ProductStockShard.product_id == product_id, ProductStockShard.shard_id == shard_id, ProductStockShard.shard_quantity >= quantity)
+			.values(shard_quantity=ProductStockShard.shard_quantity - quantity)
+			.returning(ProductStockShard.shard_id)
+			.execution_options(synchronize_session=False)
+			)
+		if taken:
+			return True
+
+	result = await db.execute(
+		select(ProductStockShard.shard_id, ProductStockShard.shard_quantity)
+		.filter(ProductStockShard.product_id == product_id)
+		.order_by(ProductStockShard.shard_id)
+		.with_for_update()
+		)
+	shards = result.all()
+	if sum(shard_quantity for _, shard_quantity in shards) < quantity:
+		return False
+	takes, remaining = [], quantity
+	for shard_id, shard_quantity in shards:
+		if remaining == 0:
+			break
+		take = min(shard_quantity, remaining)
+		if take:
+			takes.append((shard_id, take))
+			remaining -= take
+	await apply_shard_deltas(db, product_id, [(shard_id, -take) for shard_id, take in takes])
+	return True
+
+
+
+async def apply_shard_deltas(db: AsyncSession, product_id: int, deltas: list[tuple[int, int]]):
+	changes = values(column('shard_id', Integer), column('delta', Integer), name='shard_delta').data(deltas)
+	await db.execute(
+		update(ProductStockShard)
+		.where(ProductStockShard.product_id == product_id, ProductStockShard.shard_id == changes.c.shard_id)
+		.values(shard_quantity=ProductStockShard.shard_quantity + changes.c.delta)
+		.execution_options(synchronize_session=False)
+		)
+
+
+
+async def rebalance_product(db: AsyncSession, product_id: int):
+	# Shards held by an in-flight checkout are skipped; stock is only moved between the rest,
+	# so a rebalance never waits behind the checkouts it is trying to help.
+	result = await db.execute(
+		select(ProductStockShard.shard_id, ProductStockShard.shard_quantity)
+		.filter(ProductStockShard.product_id == product_id)
+		.order_by(ProductStockShard.shard_id)
+		.with_for_update(skip_locked=True)
+		)
+	shards = result.all()
+	if len(shards) < 2:
+		return False
+	target = split_stock(sum(shard_quantity for _, shard_quantity in shards), len(shards))
+	deltas = [(shard_id, wanted - shard_quantity) for (shard_id, shard_quantity), wanted in zip(shards, target) if wanted != shard_quantity]
+	if not deltas:
+		return False
+	await apply_shard_deltas(db, product_id, deltas)
+	return True
+
+
+
+async def rebalance_stock_shards(db: AsyncSession, after_product_id: int = 0, batch_size: int = STOCK_SHARD_REBALANCE_BATCH_SIZE):
+	result = await db.execute(
+		select(Product.product_id)
+		.filter(Product.product_stock_shards > 0, Product.product_id > after_product_id)
+		.order_by(Product.product_id)
+		.limit(batch_size)
+		)
+	product_ids = result.scalars().all()
+	rebalanced, synced_ids = 0, []
+	for product_id in product_ids:
+		rebalanced += await rebalance_product(db, product_id)
+	# The shard locks are released before any product row is locked: set_stock_shards locks
+	# the product first and its shards second, so waiting on a product while holding its
+	# shards could deadlock with it.
+	await db.commit()
+	if product_ids:
+		# Catalog reads show product_stock_quantity, which for sharded products is refreshed
+		# here rather than on every checkout. The products are locked in product_id order,
+		# as checkout does.
+		locked = select(Product.product_id).filter(Product.product_id.in_(product_ids)).order_by(Product.product_id).with_for_update().cte('locked')
+		shard_total = select(func.coalesce(func.sum(ProductStockShard.shard_quantity), 0)).filter(ProductStockShard.product_id == Product.product_id).scalar_subquery()
+		result = await db.execute(
+			update(Product)
+			.where(Product.product_id == locked.c.product_id, Product.product_stock_quantity.is_distinct_from(shard_total))
+			.values(product_stock_quantity=shard_total)
+			.returning(Product.product_id)
+			.execution_options(synchronize_session=False)
+			)
+		synced_ids = result.scalars().all()
+		await db.commit()
+	if synced_ids:
+		await bump_catalog_version(db)
+	for product_id in synced_ids:
+		catalog_cache.invalidate_product(product_id)
+	return len(product_ids), rebalanced, product_ids[-1] if product_ids else None
+
+
+
+async def run_stock_rebalancer(session_factory=AsyncSessionLocal, interval: float = STOCK_SHARD_REBALANCE_INTERVAL, batch_size: int = STOCK_SHARD_REBALANCE_BATCH_SIZE):
+	while True:
+		await asyncio.sleep(interval)
+		try:
+			async with session_factory() as db:
+				after_product_id = 0
+				while after_product_id is not None:
+					_, rebalanced, after_product_id = await rebalance_stock_shards(db, after_product_id, batch_size)
+					if rebalanced:
+						logger.info(f'Rebalanced stock shards of {rebalanced} products')
+		except Exception as e:
+			logger.exception(f'Stock shard rebalance failed: {str(e)}')
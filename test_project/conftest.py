@@ -9,6 +9,7 @@ from database import Base, get_db, User, Order
 from main import app
 from dotenv import load_dotenv
 from security import create_access_token, get_password_hash
+from cache import catalog_cache, cart_cache, principal_cache
 from datetime import timedelta
 import os
 
@@ -75,6 +76,9 @@ async def client(async_session):
 
 
 	app.dependency_overrides[get_db] = override_get_db
+	catalog_cache.clear()
+	cart_cache.clear()
+	principal_cache.clear()
 	transport = ASGITransport(app=app)
 	async with AsyncClient(transport=transport, base_url='http://test') as ac:
 		yield ac 
@@ -1,8 +1,10 @@
 import pytest
 import pytest_asyncio
 from httpx import AsyncClient
-from database import User, UserResponse
+from sqlalchemy import select, insert, update
+from database import User, UserResponse, Product, Order, OrderItem
 from exceptions import UserNotFoundException
+from datetime import datetime
 
 
 
@@ -69,4 +71,66 @@ async def test_admin_update_balance(client: AsyncClient, async_session, admin_he
 	assert users.id == 2
 	assert users.role == 'user'
 	assert users.balance == 100
-	assert users.bonus_points == 0
\ No newline at end of file
+	assert users.bonus_points == 0
+
+
+
+@pytest.mark.asyncio
+async def test_check_cart_totals(client: AsyncClient, async_session, admin_headers):
+	user_id = await registr(client)
+	async_session.add(Order(user_id=user_id, order_status='pending'))
+	async_session.add(Product(product_name='Pear', product_price=2.5, product_size=1, product_color='green', product_stock_quantity=10, product_description='Pear'))
+	await async_session.flush()
+	await async_session.execute(insert(OrderItem).values(order_id=1, product_id=1, product_quantity=2, order_items_price_now=2.5))
+	await async_session.execute(update(Order).values(order_amount=1))
+	response = await client.post('/admin/orders/amounts/check', headers=admin_headers)
+	assert response.status_code == 200
+	assert response.json() == {'checked': 1, 'repaired': 1}
+	result = await async_session.execute(select(Order.order_amount).filter(Order.user_id == user_id))
+	assert result.scalar_one() == 5
+	response = await client.post('/admin/orders/amounts/check', headers=admin_headers)
+	assert response.json() == {'checked': 1, 'repaired': 0}
+
+
+
+@pytest.mark.asyncio
+async def test_sales_reports(client: AsyncClient, async_session, admin_headers):
+	user_id = await registr(client)
+	for name, price in (('Pear', 2.5), ('Plum', 4.0)):
+		async_session.add(Product(product_name=name, product_price=price, product_size=1, product_color='green', product_stock_quantity=10, product_description=name))
+	await async_session.flush()
+	await async_session.execute(insert(Order), [
+		{'user_id': user_id, 'order_status': 'completed', 'order_updated_at': datetime(2026, 3, 1, 10)},
+		{'user_id': user_id, 'order_status': 'completed', 'order_updated_at': datetime(2026, 3, 1, 23)},
+		{'user_id': user_id, 'order_status': 'completed', 'order_updated_at': datetime(2026, 3, 2, 9)},
+		{'user_id': user_id, 'order_status': 'pending', 'order_updated_at': datetime(2026, 3, 2, 9)},
+		])
+	await async_session.execute(insert(OrderItem), [
+		{'order_id': 1, 'product_id': 1, 'product_quantity': 2, 'order_items_price_now': 2.5},
+		{'order_id': 1, 'product_id': 2, 'product_quantity': 1, 'order_items_price_now': 4.0},
+		{'order_id': 2, 'product_id': 1, 'product_quantity': 1, 'order_items_price_now': 2.5},
+		{'order_id': 3, 'product_id': 2, 'product_quantity': 3, 'order_items_price_now': 4.0},
+		{'order_id': 4, 'product_id': 2, 'product_quantity': 5, 'order_items_price_now': 4.0},
+		])
+	response = await client.post('/admin/reports/sales/rollup', headers=admin_headers)
+	assert response.status_code == 200
+	assert response.json()['orders'] == 3
+	response = await client.post('/admin/reports/sales/rollup', headers=admin_headers)
+	assert response.json()['orders'] == 0
+
+	params = {'date_from': '2026-03-01', 'date_to': '2026-03-31'}
+	response = await client.get('/admin/reports/sales/daily', headers=admin_headers, params=params)
+	assert response.status_code == 200
+	assert response.json() == [
+		{'sales_date': '2026-03-01', 'revenue': 11.5, 'units': 4, 'order_count': 2},
+		{'sales_date': '2026-03-02', 'revenue': 12.0, 'units': 3, 'order_count': 1},
+		]
+	response = await client.get('/admin/reports/sales/daily', headers=admin_headers, params={**params, 'product_id': 1})
+	assert response.json() == [{'sales_date': '2026-03-01', 'revenue': 7.5, 'units': 3, 'order_count': 2}]
+	response = await client.get('/admin/reports/sales/products', headers=admin_headers, params=params)
+	assert response.json() == [
+		{'product_id': 2, 'revenue': 16.0, 'units': 4, 'order_count': 2},
+		{'product_id': 1, 'revenue': 7.5, 'units': 3, 'order_count': 2},
+		]
+	response = await client.get('/admin/reports/sales/products', headers=admin_headers, params={'date_from': '2026-03-02', 'date_to': '2026-03-02', 'limit': 1})
+	assert response.json() == [{'product_id': 2, 'revenue': 12.0, 'units': 3, 'order_count': 1}]
@@ -0,0 +1,187 @@
+import pytest
+import asyncio
+import time
+import os
+from cache import LRUCache, LocalBroker, PostgresBroker, BrokerInvalidationBackend, CatalogCache, CartCache, PrincipalCache
+
+
+
+def test_lru_cache_evicts_least_recently_used():
+	cache = LRUCache(max_size=2, ttl=60)
+	cache.set('a', 1)
+	cache.set('b', 2)
+	assert cache.get('a') == 1
+	cache.set('c', 3)
+	assert cache.get('b') is None
+	assert cache.get('a') == 1
+	assert cache.get('c') == 3
+	assert cache.stats()['hits'] == 3
+	assert cache.stats()['misses'] == 1
+
+
+
+def test_lru_cache_expires_entries():
+	cache = LRUCache(max_size=2, ttl=0.01)
+	cache.set('a', 1)
+	time.sleep(0.02)
+	assert cache.get('a') is None
+	assert cache.stats()['size'] == 0
+
+
+
+def test_catalog_cache_invalidates_only_covering_pages():
+	cache = CatalogCache(BrokerInvalidationBackend(LocalBroker(), 'catalog'))
+	cache.set_page(2, None, [{'product_id': 1}, {'product_id': 2}], cache.version)
+	cache.set_page(2, 2, [{'product_id': 3}], cache.version)
+	cache.set_product(1, {'product_id': 1}, cache.version)
+	cache.invalidate_product(4)
+	assert cache.get_page(2, None) is not None
+	assert cache.get_page(2, 2) is None
+	cache.invalidate_product(1)
+	assert cache.get_page(2, None) is None
+	assert cache.get_product(1) is None
+
+
+
+def test_catalog_cache_invalidation_shared_through_broker():
+	broker = LocalBroker()
+	worker1 = CatalogCache(BrokerInvalidationBackend(broker, 'catalog'))
+	worker2 = CatalogCache(BrokerInvalidationBackend(broker, 'catalog'))
+	worker1.set_product(1, {'product_id': 1}, worker1.version)
+	worker2.set_product(1, {'product_id': 1}, worker2.version)
+	worker1.invalidate_product(1)
+	assert worker1.get_product(1) is None
+	assert worker2.get_product(1) is None
+
+
+
+def test_catalog_cache_skips_fill_that_raced_invalidation():
+	cache = CatalogCache(BrokerInvalidationBackend(LocalBroker(), 'catalog'))
+	version = cache.version
+	cache.invalidate_product(1)
+	cache.set_product(1, {'product_id': 1, 'product_price': 1.0}, version)
+	cache.set_page(10, None, [{'product_id': 1, 'product_price': 1.0}], version)
+	assert cache.get_product(1) is None
+	assert cache.get_page(10, None) is None
+	cache.set_product(1, {'product_id': 1, 'product_price': 2.0}, cache.version)
+	assert cache.get_product(1) == {'product_id': 1, 'product_price': 2.0}
+
+
+
+def test_catalog_cache_drops_shared_version_on_any_invalidation():
+	broker = LocalBroker()
+	worker1 = CatalogCache(BrokerInvalidationBackend(broker, 'catalog'))
+	worker2 = CatalogCache(BrokerInvalidationBackend(broker, 'catalog'))
+	worker2.set_shared_version(5, worker2.version)
+	assert worker2.get_shared_version() == 5
+	version = worker2.version
+	worker1.invalidate_product(1)
+	assert worker2.get_shared_version() is None
+	worker2.set_shared_version(5, version)
+	assert worker2.get_shared_version() is None
+
+
+
+def test_cart_cache_fill_does_not_overwrite_newer_cart():
+	cache = CartCache(LRUCache(max_size=10, ttl=60), BrokerInvalidationBackend(LocalBroker(), 'carts'))
+	cache.set(1, {'order_amount': 20})
+	cache.fill(1, {'order_amount': 10}, cache.generation)
+	assert cache.get(1) == {'order_amount': 20}
+	cache.invalidate(1)
+	cache.fill(1, {'order_amount': 30}, cache.generation)
+	assert cache.get(1) == {'order_amount': 30}
+
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_cart_cache_fill_that_raced_invalidate_is_dropped(shared):
+	store = LRUCache(max_size=10, ttl=60)
+	if shared:
+		reader, writer = CartCache(store), CartCache(store)
+	else:
+		broker = LocalBroker()
+		reader = CartCache(store, BrokerInvalidationBackend(broker, 'carts'))
+		writer = CartCache(LRUCache(max_size=10, ttl=60), BrokerInvalidationBackend(broker, 'carts'))
+	# The reader misses and reads the cart, then a checkout commits and invalidates before the
+	# reader fills: the cart it read is gone and must not be cached.
+	generation = reader.generation
+	writer.invalidate(1)
+	reader.fill(1, {'order_amount': 10}, generation)
+	assert reader.get(1) is None
+	generation = reader.generation
+	writer.invalidate_all()
+	reader.fill(1, {'order_amount': 10}, generation)
+	assert reader.get(1) is None
+	reader.fill(1, {'order_amount': 20}, reader.generation)
+	assert reader.get(1) == {'order_amount': 20}
+
+
+
+def test_cart_cache_writes_invalidate_other_workers():
+	broker = LocalBroker()
+	worker1 = CartCache(LRUCache(max_size=10, ttl=60), BrokerInvalidationBackend(broker, 'carts'))
+	worker2 = CartCache(LRUCache(max_size=10, ttl=60), BrokerInvalidationBackend(broker, 'carts'))
+	worker2.fill(1, {'order_amount': 10}, worker2.generation)
+	worker2.fill(2, {'order_amount': 10}, worker2.generation)
+	worker1.set(1, {'order_amount': 20})
+	assert worker1.get(1) == {'order_amount': 20}
+	assert worker2.get(1) is None
+	assert worker2.get(2) == {'order_amount': 10}
+	worker1.invalidate_all()
+	assert worker1.get(1) is None
+	assert worker2.get(2) is None
+
+
+
+def test_cart_cache_shared_store():
+	store = LRUCache(max_size=10, ttl=60)
+	worker1 = CartCache(store)
+	worker2 = CartCache(store)
+	worker1.set(1, {'order_amount': 20})
+	assert worker2.get(1) == {'order_amount': 20}
+	worker2.invalidate(1)
+	assert worker1.get(1) is None
+	assert store.stats()['hits'] == 1
+
+
+
+def test_principal_cache_invalidates_by_user_id():
+	broker = LocalBroker()
+	workers = [PrincipalCache(LRUCache(10, 60), BrokerInvalidationBackend(broker, 'principals')) for _ in range(2)]
+	for worker in workers:
+		worker.fill('a@example.com', {'id': 1, 'email': 'a@example.com'}, worker.generation)
+	workers[0].invalidate(1)
+	assert all(worker.get('a@example.com') is None for worker in workers)
+	# A lookup that started before an invalidation does not fill the cache.
+	generation = workers[1].generation
+	workers[0].invalidate(2)
+	workers[1].fill('a@example.com', {'id': 1, 'email': 'a@example.com'}, generation)
+	assert workers[1].get('a@example.com') is None
+	workers[1].fill('a@example.com', {'id': 1, 'email': 'a@example.com'}, workers[1].generation)
+	assert workers[1].get('a@example.com') == {'id': 1, 'email': 'a@example.com'}
+	assert workers[1].stats()['memory_bytes'] > 0
+
+
+
+@pytest.mark.asyncio
+async def test_postgres_broker_reaches_other_processes():
+	# Two brokers with their own connections stand in for two worker processes.
+	brokers = [PostgresBroker(os.getenv('TEST_DATABASE_URL')) for _ in range(2)]
+	workers = [CartCache(LRUCache(max_size=10, ttl=60), BrokerInvalidationBackend(broker, 'carts')) for broker in brokers]
+	tasks = [task for broker in brokers for task in broker.start()]
+	try:
+		await asyncio.wait_for(asyncio.gather(*(broker.listening.wait() for broker in brokers)), timeout=5)
+		workers[1].fill(1, {'order_amount': 10}, workers[1].generation)
+		workers[0].invalidate(1)
+		await asyncio.wait_for(brokers[0].flush(), timeout=5)
+		for _ in range(50):
+			if workers[1].get(1) is None:
+				break
+			await asyncio.sleep(0.1)
+		assert workers[1].get(1) is None
+		assert workers[1].generation == 1
+		# A worker does not apply its own notification a second time.
+		assert workers[0].generation == 1
+	finally:
+		for task in tasks:
+			task.cancel()
@@ -1,8 +1,20 @@
 import pytest
 import pytest_asyncio
-from httpx import AsyncClient
-from database import User, UserResponse, ProductResponse, OrderResponse, OrderItemResponse
-from exceptions import InsufficientStockException, ProductNotFoundException 
+from httpx import AsyncClient, ASGITransport
+from sqlalchemy import insert, select, update, func, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+from database import User, UserResponse, ProductResponse, OrderResponse, OrderItemResponse, Product, ProductStockShard, Order, OrderItem, ArchivedOrderItem, CheckoutJob, DailySales, DailyProductSales, get_db
+from security import create_access_token
+from reservations import release_expired_holds, available_quantity
+from stock_shards import set_stock_shards, rebalance_stock_shards
+from checkout import process_batch
+from cache import principal_cache, cart_cache
+from order_archive import archive_orders
+from sales_rollups import roll_up_sales
+from datetime import datetime
+from main import app
+from exceptions import InsufficientStockException, ProductNotFoundException, QuantityNegativeException, CartIsEmptyException, CheckoutJobNotFoundException, InvalidCursorException
 import asyncio
 
 product = {
@@ -80,7 +92,9 @@ async def test_get_cart(client: AsyncClient, async_session):
 	response = await client.get('/orders/get', headers=headers)
 	assert response.status_code == 200
 	order = OrderResponse(**response.json())
-	assert order.order_id == 1
+	# Reading the cart does not create it; the first add does.
+	assert order.order_id is None
+	assert (await async_session.execute(select(func.count()).select_from(Order))).scalar_one() == 0
 	assert order.order_amount == 0
 	assert order.order_status == 'pending'
 	assert order.user_id == 1
@@ -90,6 +104,19 @@ async def test_get_cart(client: AsyncClient, async_session):
 
 
 
+@pytest.mark.asyncio 
+async def test_one_pending_cart_per_user(client: AsyncClient, async_session):
+	await current_user_token(client)
+	async with async_session.begin_nested():
+		async_session.add(Order(user_id=1, order_status='pending'))
+	with pytest.raises(IntegrityError):
+		async with async_session.begin_nested():
+			async_session.add(Order(user_id=1, order_status='pending'))
+	async with async_session.begin_nested():
+		async_session.add(Order(user_id=1, order_status='completed'))
+
+
+
 @pytest.mark.parametrize('order_item, expected', [
 	({'product_id': 1, 'product_quantity': 4}, 200),
 	({'product_id': 2, 'product_quantity': 1}, 404),
@@ -123,6 +150,238 @@ async def test_add_item_to_cart(client: AsyncClient, async_session, admin_header
 	
 
 
+@pytest.mark.asyncio
+async def test_add_same_item_twice(client: AsyncClient, async_session, admin_headers):
+	headers = await current_user_token(client)
+	product = await create_product(client, async_session, admin_headers)
+	await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': 3})
+	response = await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': 4})
+	assert response.status_code == 200
+	order = OrderResponse(**response.json())
+	order_items = [OrderItemResponse.model_validate(item) for item in order.order_for_order_items]
+	assert len(order_items) == 1
+	assert order_items[0].product_quantity == 7
+	assert order.order_amount == pytest.approx(product.product_price * 7)
+
+
+
+@pytest.mark.asyncio
+async def test_batch_update_cart(client: AsyncClient, async_session, admin_headers):
+	headers = await current_user_token(client)
+	product = await create_product(client, async_session, admin_headers)
+	await create_product(client, async_session, admin_headers)
+	response = await client.post('/orders/cart/batch', headers=headers, json=[
+		{'product_id': 1, 'quantity': 2},
+		{'product_id': 2, 'quantity': 5}
+		])
+	assert response.status_code == 200
+	order = OrderResponse(**response.json())
+	assert [(item.product_id, item.product_quantity) for item in order.order_for_order_items] == [(1, 2), (2, 5)]
+	assert order.order_amount == pytest.approx(product.product_price * 7)
+
+	response = await client.post('/orders/cart/batch', headers=headers, json=[
+		{'product_id': 1, 'quantity': 0},
+		{'product_id': 2, 'quantity': 3}
+		])
+	assert response.status_code == 200
+	order = OrderResponse(**response.json())
+	assert [(item.product_id, item.product_quantity) for item in order.order_for_order_items] == [(2, 3)]
+	assert order.order_amount == pytest.approx(product.product_price * 3)
+
+
+
+@pytest.mark.parametrize('cart_items, expected', [
+	([{'product_id': 1, 'quantity': 2}, {'product_id': 3, 'quantity': 1}], ProductNotFoundException()),
+	([{'product_id': 1, 'quantity': 2}, {'product_id': 2, 'quantity': 11}], InsufficientStockException()),
+	([{'product_id': 1, 'quantity': -1}], QuantityNegativeException())
+	])
+@pytest.mark.asyncio
+async def test_batch_update_cart_rejected(client: AsyncClient, async_session, admin_headers, cart_items, expected):
+	headers = await current_user_token(client)
+	await create_product(client, async_session, admin_headers)
+	await create_product(client, async_session, admin_headers)
+	response = await client.post('/orders/cart/batch', headers=headers, json=cart_items)
+	assert response.status_code == expected.status_code
+	assert response.json()['message'] == expected.detail
+	response = await client.get('/orders/get', headers=headers)
+	assert response.json()['order_for_order_items'] == []
+
+
+
+async def second_user_token(client: AsyncClient):
+	await client.post('/users/registr', json={'email': 'second@example.com', 'password': '123456'})
+	response = await client.post('/users/login', data={'username': 'second@example.com', 'password': '123456'})
+	return {'Authorization': f"Bearer {response.json()['access_token']}"}
+
+
+
+async def available(client: AsyncClient, product_id: int = 1):
+	response = await client.get('/products/availability', params={'product_id': product_id})
+	return response.json()[0]['available_quantity']
+
+
+
+@pytest.mark.asyncio
+async def test_cart_holds_stock(client: AsyncClient, async_session, admin_headers):
+	headers = await deposit(client, async_session)
+	other_headers = await second_user_token(client)
+	await create_product(client, async_session, admin_headers)
+	response = await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': 4})
+	assert response.status_code == 200
+	assert await available(client) == 6
+	response = await client.post('/orders/cart/add', headers=other_headers, json={'product_id': 1, 'product_quantity': 7})
+	assert response.status_code == InsufficientStockException().status_code
+	order_items_id = (await client.get('/orders/get', headers=headers)).json()['order_for_order_items'][0]['order_items_id']
+	response = await client.patch(f'/orders/cart/update/{order_items_id}', headers=headers, json={'quantity': 2})
+	assert response.status_code == 200
+	assert await available(client) == 8
+	response = await client.post('/orders/cart/batch', headers=other_headers, json=[{'product_id': 1, 'quantity': 8}])
+	assert response.status_code == 200
+	assert await available(client) == 0
+	response = await client.post('/orders/checkout', headers=headers)
+	assert response.status_code == 200
+	response = await client.get('/products/admin/get/1', headers=admin_headers)
+	assert response.json()['product_stock_quantity'] == 8
+	assert await available(client) == 0
+	await client.post('/orders/cart/batch', headers=other_headers, json=[{'product_id': 1, 'quantity': 0}])
+	assert await available(client) == 8
+
+
+
+@pytest.mark.asyncio
+async def test_expired_holds_are_released(client: AsyncClient, async_session, admin_headers):
+	headers = await current_user_token(client)
+	await create_product(client, async_session, admin_headers)
+	await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': 4})
+	await async_session.execute(update(OrderItem).values(reserved_until=datetime(2000, 1, 1)))
+	assert await release_expired_holds(async_session) == 1
+	assert await release_expired_holds(async_session) == 0
+	assert await available(client) == 10
+	response = await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': 1})
+	assert response.status_code == 200
+	assert await available(client) == 5
+	order_items_id = response.json()['order_for_order_items'][0]['order_items_id']
+	await client.delete(f'orders/item/cart/delete/{order_items_id}', headers=headers)
+	assert await available(client) == 10
+
+
+
+@pytest.mark.asyncio
+async def test_deletes_cascade_to_held_lines(client: AsyncClient, async_session, admin_headers):
+	headers = await deposit(client, async_session)
+	other_headers = await second_user_token(client)
+	await create_product(client, async_session, admin_headers)
+	await create_product(client, async_session, admin_headers)
+	await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': 4})
+	await client.post('/orders/cart/add', headers=headers, json={'product_id': 2, 'product_quantity': 3})
+	await client.post('/orders/cart/add', headers=other_headers, json={'product_id': 2, 'product_quantity': 2})
+	response = await client.delete('/products/admin/delete/1', headers=admin_headers)
+	assert response.status_code == 200
+	response = await client.get('/orders/get', headers=headers)
+	assert response.status_code == 200
+	assert [line['product_id'] for line in response.json()['order_for_order_items']] == [2]
+	response = await client.post('/orders/checkout', headers=headers)
+	assert response.status_code == 200
+	response = await client.get('/orders/history', headers=headers)
+	assert response.status_code == 200
+	assert await available(client, 2) == 5
+	response = await client.delete('/users/delete', headers=other_headers)
+	assert response.status_code == 200
+	assert await available(client, 2) == 7
+	assert (await async_session.execute(select(func.count()).select_from(OrderItem).filter(OrderItem.product_id.is_(None)))).scalar_one() == 0
+
+
+
+@pytest.mark.asyncio
+async def test_deleted_products_keep_their_sales(client: AsyncClient, async_session, admin_headers):
+	headers = await deposit(client, async_session)
+	await create_product(client, async_session, admin_headers)
+	await create_product(client, async_session, admin_headers)
+	await client.post('/orders/cart/add', headers=headers, json=item_add)
+	await client.post('/orders/cart/add', headers=headers, json={'product_id': 2, 'product_quantity': 3})
+	await client.post('/orders/checkout', headers=headers)
+	response = await client.delete('/products/admin/delete/1', headers=admin_headers)
+	assert response.status_code == 200
+	assert (await roll_up_sales(async_session))['orders'] == 0
+	product_sales = await async_session.execute(select(DailyProductSales.product_id, DailyProductSales.units).order_by(DailyProductSales.product_id))
+	assert product_sales.all() == [(1, 5), (2, 3)]
+	assert (await async_session.execute(select(DailySales.units))).scalar_one() == 8
+
+	# Lines left with a null product_id by deletes made before they cascaded.
+	await client.post('/orders/cart/add', headers=headers, json={'product_id': 2, 'product_quantity': 1})
+	await client.post('/orders/checkout', headers=headers)
+	await async_session.execute(update(OrderItem).filter(OrderItem.order_id == 2).values(product_id=None))
+	assert (await roll_up_sales(async_session))['orders'] == 1
+	product_sales = await async_session.execute(select(DailyProductSales.product_id, DailyProductSales.units).order_by(DailyProductSales.product_id))
+	assert product_sales.all() == [(1, 5), (2, 3)]
+	assert (await async_session.execute(select(DailySales.units))).scalar_one() == 9
+
+
+
+@pytest.mark.asyncio
+async def test_idle_carts_are_swept(client: AsyncClient, async_session, admin_headers):
+	headers = await current_user_token(client)
+	other_headers = await second_user_token(client)
+	await create_product(client, async_session, admin_headers)
+	await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': 4})
+	await client.post('/orders/cart/add', headers=other_headers, json={'product_id': 1, 'product_quantity': 1})
+	await client.get('/orders/get', headers=headers)
+	await async_session.execute(update(Order).filter(Order.order_id == 1).values(order_updated_at=datetime(2000, 1, 1)))
+	response = await client.post('/admin/carts/sweep', headers=admin_headers, params={'idle_seconds': 3600})
+	assert response.status_code == 200
+	assert response.json()['carts_deleted'] == 1
+	assert response.json()['lines_deleted'] == 1
+	assert await available(client) == 9
+	response = await client.get('/orders/get', headers=headers)
+	assert response.json()['order_id'] is None
+	assert response.json()['order_for_order_items'] == []
+	response = await client.post('/orders/cart/add', headers=other_headers, json={'product_id': 1, 'product_quantity': 1})
+	assert response.json()['order_id'] == 2
+	assert response.json()['order_for_order_items'][0]['product_quantity'] == 2
+
+
+
+@pytest.mark.asyncio
+async def test_cart_total_follows_mutations(client: AsyncClient, async_session, admin_headers):
+	headers = await current_user_token(client)
+	product = await create_product(client, async_session, admin_headers)
+	await create_product(client, async_session, admin_headers)
+	await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': 2})
+	await client.post('/orders/cart/add', headers=headers, json={'product_id': 2, 'product_quantity': 3})
+	await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': 1})
+	response = await client.patch('/orders/cart/update/2', headers=headers, json={'quantity': 5})
+	assert response.json()['order_amount'] == pytest.approx(product.product_price * 8)
+	response = await client.post('/orders/cart/batch', headers=headers, json=[{'product_id': 1, 'quantity': 1}, {'product_id': 2, 'quantity': 2}])
+	assert response.json()['order_amount'] == pytest.approx(product.product_price * 3)
+	response = await client.delete('orders/item/cart/delete/1', headers=headers)
+	assert response.json()['order_amount'] == pytest.approx(product.product_price * 2)
+	response = await client.post('/admin/orders/amounts/check', headers=admin_headers)
+	assert response.json() == {'checked': 1, 'repaired': 0}
+
+
+
+@pytest.mark.asyncio 
+async def test_get_cart_served_from_cache(client: AsyncClient, async_session, admin_headers):
+	headers = await deposit(client, async_session)
+	product = await create_product(client, async_session, admin_headers)
+	response = await client.get('/orders/get', headers=headers)
+	assert response.json()['order_for_order_items'] == []
+	await client.post('/orders/cart/add', headers=headers, json=item_add)
+	response = await client.get('/orders/get', headers=headers)
+	assert response.json()['order_amount'] == pytest.approx(product.product_price * item_add['product_quantity'])
+	await client.patch('/orders/cart/update/1', headers=headers, json=item_update)
+	response = await client.get('/orders/get', headers=headers)
+	assert response.json()['order_for_order_items'][0]['product_quantity'] == item_update['quantity']
+	await client.post('/orders/checkout', headers=headers)
+	response = await client.get('/orders/get', headers=headers)
+	assert response.json()['order_status'] == 'pending'
+	assert response.json()['order_for_order_items'] == []
+	response = await client.get('/admin/cache/stats', headers=admin_headers)
+	assert response.json()['carts']['hits'] == 2
+	assert response.json()['carts']['misses'] == 2
+
+
+
 @pytest.mark.asyncio 
 async def test_update_cart_item_quantity(client: AsyncClient, async_session, admin_headers):
 	headers = await current_user_token(client)
@@ -171,6 +430,19 @@ async def test_delete_cart_item(client: AsyncClient, async_session, admin_header
 
 
 
+@pytest.mark.asyncio
+async def test_checkout_changes_catalog_etag(client: AsyncClient, async_session, admin_headers):
+	headers = await deposit(client, async_session)
+	await create_product(client, async_session, admin_headers)
+	await client.post('/orders/cart/add', headers=headers, json=item_add)
+	etag = (await client.get('/products/all')).headers['ETag']
+	await client.post('/orders/checkout', headers=headers)
+	response = await client.get('/products/all', headers={'If-None-Match': etag})
+	assert response.status_code == 200
+	assert response.json()[0]['product_stock_quantity'] == 10 - item_add['product_quantity']
+
+
+
 @pytest.mark.asyncio
 async def test_checkout(client: AsyncClient, async_session, admin_headers):
 	headers = await deposit(client, async_session)
@@ -190,3 +462,340 @@ async def test_checkout(client: AsyncClient, async_session, admin_headers):
 	assert balance == 100
 
 
+
+
+@pytest.mark.asyncio
+async def test_checkout_replayed_with_idempotency_key(client: AsyncClient, async_session, admin_headers):
+	headers = await deposit(client, async_session)
+	await create_product(client, async_session, admin_headers)
+	await client.post('/orders/cart/add', headers=headers, json=item_add)
+	headers = {**headers, 'Idempotency-Key': 'checkout-1'}
+	first = await client.post('/orders/checkout', headers=headers)
+	assert first.status_code == 200
+	second = await client.post('/orders/checkout', headers=headers)
+	assert second.status_code == 200
+	assert second.headers['Idempotent-Replayed'] == 'true'
+	assert second.json() == first.json()
+	response = await client.get('/users/me', headers=headers)
+	assert response.json()['balance'] == pytest.approx(100 - first.json()['order_amount'])
+
+
+
+@pytest.mark.asyncio
+async def test_order_history(client: AsyncClient, async_session, admin_headers):
+	headers = await deposit(client, async_session)
+	await create_product(client, async_session, admin_headers)
+	for quantity in (1, 2, 3):
+		await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': quantity})
+		await client.post('/orders/checkout', headers=headers)
+	response = await client.get('/orders/history', headers=headers, params={'limit': 2})
+	assert response.status_code == 200
+	orders = [OrderResponse(**order) for order in response.json()]
+	assert [order.order_id for order in orders] == [3, 2]
+	assert all(order.order_status == 'completed' for order in orders)
+	assert orders[0].order_for_order_items[0].product_quantity == 3
+	params = {'limit': 2, 'after_id': response.headers['X-Next-Cursor'], 'after_time': response.headers['X-Next-Cursor-Time']}
+	response = await client.get('/orders/history', headers=headers, params=params)
+	assert [order['order_id'] for order in response.json()] == [1]
+	assert 'X-Next-Cursor' not in response.headers
+	response = await client.get('/orders/history', headers=headers, params={'order_status': 'pending'})
+	assert response.json() == []
+	await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': 1})
+	response = await client.get('/orders/history', headers=headers, params={'order_status': 'pending'})
+	assert [order['order_id'] for order in response.json()] == [4]
+	response = await client.get('/orders/history', headers=headers, params={'since': '2100-01-01T00:00:00'})
+	assert response.json() == []
+	response = await client.get('/orders/history', headers=headers, params={'after_id': 2})
+	assert response.status_code == InvalidCursorException().status_code
+
+
+
+
+@pytest.mark.asyncio
+async def test_order_history_accepts_aware_times(client: AsyncClient, async_session, admin_headers):
+	headers = await deposit(client, async_session)
+	await create_product(client, async_session, admin_headers)
+	for quantity in (1, 2):
+		await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': quantity})
+		await client.post('/orders/checkout', headers=headers)
+	await async_session.execute(text("SET TIME ZONE 'UTC'"))
+	await async_session.execute(update(Order).filter(Order.order_id == 1).values(order_time_info=datetime(2026, 1, 1, 10)))
+	await async_session.execute(update(Order).filter(Order.order_id == 2).values(order_time_info=datetime(2026, 1, 1, 12)))
+	response = await client.get('/orders/history', headers=headers, params={'since': '2026-01-01T13:00:00+02:00'})
+	assert response.status_code == 200
+	assert [order['order_id'] for order in response.json()] == [2]
+	response = await client.get('/orders/history', headers=headers, params={'until': '2026-01-01T11:00:00Z'})
+	assert [order['order_id'] for order in response.json()] == [1]
+	response = await client.get('/orders/history', headers=headers, params={'after_time': '2026-01-01T14:00:00+02:00', 'after_id': 2})
+	assert [order['order_id'] for order in response.json()] == [1]
+
+
+
+@pytest.mark.asyncio
+async def test_archived_orders_stay_in_history(client: AsyncClient, async_session, admin_headers):
+	headers = await deposit(client, async_session)
+	await create_product(client, async_session, admin_headers)
+	for quantity in (1, 2, 3):
+		await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': quantity})
+		await client.post('/orders/checkout', headers=headers)
+	await async_session.execute(update(Order).filter(Order.order_id.in_([1, 2])).values(order_time_info=datetime(2020, 1, 1), order_updated_at=datetime(2020, 1, 1)))
+	# Order 3 was opened long ago but only completed now, so it is not old enough.
+	await async_session.execute(update(Order).filter(Order.order_id == 3).values(order_time_info=datetime(2021, 6, 1)))
+	await async_session.execute(update(Order).filter(Order.order_id == 1).values(order_rolled_up=True))
+	# Order 2 is old enough but not in the sales rollups yet, so it stays.
+	assert (await archive_orders(async_session, after_days=30))['orders_archived'] == 1
+	await roll_up_sales(async_session)
+	stats = await archive_orders(async_session, after_days=30)
+	assert (stats['orders_archived'], stats['lines_archived']) == (1, 1)
+	assert (await async_session.execute(select(Order.order_id).order_by(Order.order_id))).scalars().all() == [3]
+	assert (await async_session.execute(select(func.count()).select_from(ArchivedOrderItem))).scalar_one() == 2
+
+	response = await client.get('/orders/history', headers=headers, params={'limit': 2})
+	assert [order['order_id'] for order in response.json()] == [3, 2]
+	params = {'limit': 2, 'after_id': response.headers['X-Next-Cursor'], 'after_time': response.headers['X-Next-Cursor-Time']}
+	response = await client.get('/orders/history', headers=headers, params=params)
+	orders = [OrderResponse(**order) for order in response.json()]
+	assert [order.order_id for order in orders] == [1]
+	assert orders[0].order_for_order_items[0].product_quantity == 1
+	response = await client.get('/orders/history', headers=headers, params={'until': '2021-01-01T00:00:00'})
+	assert [order['order_id'] for order in response.json()] == [2, 1]
+	response = await client.get('/orders/history', headers=headers, params={'order_status': 'pending'})
+	assert response.json() == []
+
+
+
+@pytest.mark.asyncio
+async def test_async_checkout(client: AsyncClient, async_session, admin_headers):
+	headers = await deposit(client, async_session)
+	product = await create_product(client, async_session, admin_headers)
+	await client.post('/orders/cart/add', headers=headers, json=item_add)
+	response = await client.post('/orders/checkout/async', headers=headers)
+	assert response.status_code == 202
+	token = response.json()['token']
+	assert response.json()['job_status'] == 'queued'
+	response = await client.post('/orders/checkout/async', headers=headers)
+	second_token = response.json()['token']
+
+	assert await process_batch(async_session) == 2
+	assert await process_batch(async_session) == 0
+	response = await client.get(f'/orders/checkout/status/{token}', headers=headers)
+	assert response.json()['job_status'] == 'completed'
+	assert response.json()['order_id'] == 1
+	assert response.json()['finished_at'] is not None
+	response = await client.get(f'/orders/checkout/status/{second_token}', headers=headers)
+	assert response.json()['job_status'] == 'failed'
+	assert response.json()['job_error'] == CartIsEmptyException().detail
+	response = await client.get('/users/me', headers=headers)
+	assert response.json()['balance'] == pytest.approx(100 - product.product_price * item_add['product_quantity'])
+	response = await client.get('/orders/checkout/status/unknown', headers=headers)
+	assert response.status_code == CheckoutJobNotFoundException().status_code
+
+
+
+@pytest.mark.asyncio
+async def test_sharded_stock_checkout(client: AsyncClient, async_session, admin_headers):
+	headers = await deposit(client, async_session)
+	await create_product(client, async_session, admin_headers)
+	await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': 2})
+	response = await client.put('/products/admin/1/stock/shards', headers=admin_headers, json={'shards': 4})
+	assert response.json() == {'product_id': 1, 'product_stock_shards': 4, 'available_quantity': 10}
+	response = await client.put('/products/admin/2/stock/shards', headers=admin_headers, json={'shards': 4})
+	assert response.status_code == ProductNotFoundException().status_code
+
+	response = await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': 1})
+	assert response.status_code == 200
+	assert await available(client) == 10
+	response = await client.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': 8})
+	assert response.status_code == InsufficientStockException().status_code
+	response = await client.patch('/orders/cart/update/1', headers=headers, json={'quantity': 7})
+	assert response.status_code == 200
+	# 7 units cannot come from one shard of 2 or 3, so checkout takes them across shards.
+	response = await client.post('/orders/checkout', headers=headers)
+	assert response.status_code == 200
+	assert await available(client) == 3
+	result = await async_session.execute(select(func.min(ProductStockShard.shard_quantity)))
+	assert result.scalar_one() == 0
+
+	assert await rebalance_stock_shards(async_session) == (1, 1, 1)
+	result = await async_session.execute(select(ProductStockShard.shard_quantity).order_by(ProductStockShard.shard_id))
+	assert result.scalars().all() == [1, 1, 1, 0]
+	response = await client.get('/products/admin/get/1', headers=admin_headers)
+	assert response.json()['product_stock_quantity'] == 3
+	response = await client.put('/products/admin/1/stock/shards', headers=admin_headers, json={'shards': 0})
+	assert response.json()['available_quantity'] == 3
+	assert await available(client) == 3
+
+
+
+@pytest.mark.asyncio
+async def test_rebalance_releases_shards_before_locking_products(async_test_engine, create_tables):
+	# set_stock_shards locks the product and then its shards, so the rebalancer must not wait
+	# on a locked product while it still holds that product's shards.
+	async with async_test_engine.begin() as conn:
+		await conn.execute(insert(Product), product)
+	session_factory = async_sessionmaker(bind=async_test_engine, class_=AsyncSession, expire_on_commit=False)
+	async with session_factory() as db:
+		await set_stock_shards(db, 1, 4)
+		await db.execute(update(ProductStockShard).filter(ProductStockShard.shard_id == 0).values(shard_quantity=0))
+		await db.commit()
+	async with session_factory() as db, async_test_engine.connect() as conn:
+		await conn.execute(select(Product.product_id).filter(Product.product_id == 1).with_for_update())
+		rebalance = asyncio.create_task(rebalance_stock_shards(db))
+		# The moved stock shows up while the product is still locked only if the shard
+		# changes were committed, and their locks released, before the product was waited on.
+		for _ in range(50):
+			await asyncio.sleep(0.1)
+			quantities = (await conn.execute(select(ProductStockShard.shard_quantity).order_by(ProductStockShard.shard_id))).scalars().all()
+			if quantities == [2, 2, 2, 1]:
+				break
+		await conn.commit()
+		assert await rebalance == (1, 1, 1)
+	assert quantities == [2, 2, 2, 1]
+	async with async_test_engine.connect() as conn:
+		assert (await conn.execute(select(Product.product_stock_quantity))).scalar_one() == 7
+
+
+
+@pytest.mark.asyncio
+async def test_checkout_workers_with_crossed_products(async_test_engine, create_tables):
+	# Consecutive jobs alternate between the two products, so two workers holding locks across
+	# jobs would each wait for the product the other one took.
+	users = 40
+	async with async_test_engine.begin() as conn:
+		await conn.execute(insert(Product), [{**product, 'product_stock_quantity': 1000} for _ in range(2)])
+		user_ids = (await conn.execute(insert(User).returning(User.id), [
+			{'email': f'buyer{i}@example.com', 'hashed_password': '-', 'role': 'user', 'balance': 100, 'bonus_points': 0} for i in range(users)
+			])).scalars().all()
+		order_ids = (await conn.execute(insert(Order).returning(Order.order_id), [
+			{'user_id': user_id, 'order_status': 'pending', 'order_amount': product['product_price']} for user_id in user_ids
+			])).scalars().all()
+		await conn.execute(insert(OrderItem), [
+			{'order_id': order_id, 'product_id': 1 + (i // 2 + i) % 2, 'product_quantity': 1, 'order_items_price_now': product['product_price']}
+			for i, order_id in enumerate(order_ids)
+			])
+		await conn.execute(insert(CheckoutJob), [{'token': f'job{user_id}', 'user_id': user_id} for user_id in user_ids])
+
+	session_factory = async_sessionmaker(bind=async_test_engine, class_=AsyncSession, expire_on_commit=False)
+	async def worker():
+		async with session_factory() as db:
+			while await process_batch(db, batch_size=5):
+				pass
+
+	await asyncio.gather(worker(), worker())
+	async with async_test_engine.connect() as conn:
+		result = await conn.execute(select(CheckoutJob.job_status, func.count()).group_by(CheckoutJob.job_status))
+		assert dict(result.all()) == {'completed': users}
+
+
+
+@pytest.mark.parametrize('shards', [0, 8])
+@pytest.mark.asyncio
+async def test_concurrent_checkouts_do_not_oversell(async_test_engine, create_tables, shards):
+	# Every checkout runs in its own committed session, so the row locks are real.
+	buyers, stock = 200, 120
+	async with async_test_engine.begin() as conn:
+		product_id = (await conn.execute(insert(Product).returning(Product.product_id), {**product, 'product_stock_quantity': stock})).scalar_one()
+		users = (await conn.execute(insert(User).returning(User.id, User.email), [
+			{'email': f'buyer{i}@example.com', 'hashed_password': '-', 'role': 'user', 'balance': 100, 'bonus_points': 0} for i in range(buyers)
+			])).all()
+		order_ids = (await conn.execute(insert(Order).returning(Order.order_id), [
+			{'user_id': user_id, 'order_status': 'pending', 'order_amount': product['product_price']} for user_id, _ in users
+			])).scalars().all()
+		await conn.execute(insert(OrderItem), [
+			{'order_id': order_id, 'product_id': product_id, 'product_quantity': 1, 'order_items_price_now': product['product_price']} for order_id in order_ids
+			])
+
+	session_factory = async_sessionmaker(bind=async_test_engine, class_=AsyncSession, expire_on_commit=False)
+	if shards:
+		async with session_factory() as db:
+			await set_stock_shards(db, product_id, shards)
+			await db.commit()
+	async def override_get_db():
+		async with session_factory() as db:
+			yield db
+
+	tokens = [await create_access_token({'sub': email}) for _, email in users]
+	app.dependency_overrides[get_db] = override_get_db
+	try:
+		async with AsyncClient(transport=ASGITransport(app=app), base_url='http://test', timeout=None) as ac:
+			responses = await asyncio.gather(*(ac.post('/orders/checkout', headers={'Authorization': f'Bearer {token}'}) for token in tokens))
+	finally:
+		app.dependency_overrides.clear()
+
+	statuses = [response.status_code for response in responses]
+	assert statuses.count(200) == stock
+	assert statuses.count(400) == buyers - stock
+	async with async_test_engine.connect() as conn:
+		assert (await conn.execute(select(available_quantity()))).scalar_one() == 0
+		completed = (await conn.execute(select(Order.order_id).filter(Order.order_status == 'completed'))).scalars().all()
+		assert len(completed) == stock
+
+
+
+@pytest.mark.asyncio
+async def test_cart_mutations_with_production_sessions(async_test_engine, create_tables):
+	# The app's sessions expire everything on commit, unlike the shared test session, so
+	# nothing may read a loaded object after its request commits.
+	async with async_test_engine.begin() as conn:
+		await conn.execute(insert(Product), [product, product])
+		await conn.execute(insert(User), {'email': 'buyer@example.com', 'hashed_password': '-', 'role': 'user', 'balance': 100, 'bonus_points': 0})
+	session_factory = async_sessionmaker(bind=async_test_engine, class_=AsyncSession, autoflush=False)
+	principal_cache.clear()
+	cart_cache.clear()
+	async def override_get_db():
+		async with session_factory() as db:
+			yield db
+
+	headers = {'Authorization': f"Bearer {await create_access_token({'sub': 'buyer@example.com'})}"}
+	app.dependency_overrides[get_db] = override_get_db
+	try:
+		async with AsyncClient(transport=ASGITransport(app=app), base_url='http://test') as ac:
+			response = await ac.post('/orders/cart/add', headers=headers, json={'product_id': 1, 'product_quantity': 2})
+			assert response.status_code == 200
+			response = await ac.post('/orders/cart/batch', headers=headers, json=[{'product_id': 2, 'quantity': 1}])
+			assert response.status_code == 200
+			order_items_id = response.json()['order_for_order_items'][0]['order_items_id']
+			response = await ac.patch(f'/orders/cart/update/{order_items_id}', headers=headers, json={'quantity': 3})
+			assert response.status_code == 200
+			response = await ac.delete(f'/orders/item/cart/delete/{order_items_id}', headers=headers)
+			assert response.status_code == 200
+			response = await ac.post('/orders/checkout', headers=headers)
+			assert response.status_code == 200
+			assert response.json()['order_amount'] == pytest.approx(product['product_price'])
+	finally:
+		app.dependency_overrides.clear()
+
+
+
+@pytest.mark.asyncio
+async def test_concurrent_first_adds_share_one_cart(async_test_engine, create_tables):
+	# Both adds of each user find no cart; the one whose insert loses the race must still add
+	# its line to the cart the other one created.
+	shoppers = 20
+	async with async_test_engine.begin() as conn:
+		await conn.execute(insert(Product), [{**product, 'product_stock_quantity': shoppers}] * 2)
+		await conn.execute(insert(User), [
+			{'email': f'shopper{i}@example.com', 'hashed_password': '-', 'role': 'user', 'balance': 0, 'bonus_points': 0} for i in range(shoppers)
+			])
+	session_factory = async_sessionmaker(bind=async_test_engine, class_=AsyncSession, expire_on_commit=False)
+	principal_cache.clear()
+	cart_cache.clear()
+	async def override_get_db():
+		async with session_factory() as db:
+			yield db
+
+	tokens = [await create_access_token({'sub': f'shopper{i}@example.com'}) for i in range(shoppers)]
+	app.dependency_overrides[get_db] = override_get_db
+	try:
+		async with AsyncClient(transport=ASGITransport(app=app), base_url='http://test', timeout=None) as ac:
+			responses = await asyncio.gather(*(
+				ac.post('/orders/cart/add', headers={'Authorization': f'Bearer {token}'}, json={'product_id': product_id, 'product_quantity': 1})
+				for token in tokens for product_id in (1, 2)
+				))
+	finally:
+		app.dependency_overrides.clear()
+
+	assert [response.status_code for response in responses] == [200] * 2 * shoppers
+	async with async_test_engine.connect() as conn:
+		assert (await conn.execute(select(func.count()).select_from(Order))).scalar_one() == shoppers
+		assert (await conn.execute(select(func.count()).select_from(OrderItem))).scalar_one() == 2 * shoppers
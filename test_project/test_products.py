@@ -2,6 +2,9 @@ import pytest
 import pytest_asyncio
 from httpx import AsyncClient
 from database import User, UserResponse, ProductResponse
+from cache import catalog_cache
+from sqlalchemy import event
+import json
 
 
 
@@ -61,6 +64,33 @@ async def test_get_all_products(client: AsyncClient, async_session, admin_header
 	assert product[0].product_description == 'It`s BANANA!'
 
 
+@pytest.mark.asyncio 
+async def test_get_all_products_keyset_pagination(client: AsyncClient, async_session, admin_headers):
+	for _ in range(3):
+		await create_product(client, async_session, admin_headers)
+	response = await client.get('/products/all', params={'limit': 2})
+	assert response.status_code == 200
+	assert [item['product_id'] for item in response.json()] == [1, 2]
+	assert response.headers['X-Next-Cursor'] == '2'
+	response = await client.get('/products/all', params={'limit': 2, 'after': response.headers['X-Next-Cursor']})
+	assert response.status_code == 200
+	assert [item['product_id'] for item in response.json()] == [3]
+	assert 'X-Next-Cursor' not in response.headers
+
+
+
+@pytest.mark.asyncio 
+async def test_get_all_products_stream(client: AsyncClient, async_session, admin_headers):
+	for _ in range(2):
+		await create_product(client, async_session, admin_headers)
+	response = await client.get('/products/all', params={'stream': True})
+	assert response.status_code == 200
+	assert response.headers['content-type'] == 'application/x-ndjson'
+	products = [ProductResponse.model_validate_json(line) for line in response.text.splitlines()]
+	assert [product.product_id for product in products] == [1, 2]
+	assert products[0].product_name == 'Banana'
+
+
 @pytest.mark.asyncio
 async def test_admin_get_product(client: AsyncClient, async_session, admin_headers):
 	response = await create_product(client, async_session, admin_headers)
@@ -110,9 +140,231 @@ async def test_admin_refresh_product(client: AsyncClient, async_session, admin_h
 
 
 
+@pytest.mark.asyncio
+async def test_get_all_products_cache_invalidated_on_update(client: AsyncClient, async_session, admin_headers):
+	await create_product(client, async_session, admin_headers)
+	response = await client.get('/products/all')
+	assert response.json()[0]['product_name'] == 'Banana'
+	response = await client.patch('/products/admin/refresh/1', headers=admin_headers, json={'product_name': 'Apple'})
+	assert response.status_code == 200
+	response = await client.get('/products/all')
+	assert response.json()[0]['product_name'] == 'Apple'
+	response = await client.get('/products/admin/get/1', headers=admin_headers)
+	assert response.json()['product_name'] == 'Apple'
+	response = await client.get('/admin/cache/stats', headers=admin_headers)
+	assert response.status_code == 200
+	assert response.json()['catalog']['misses'] == 3
+
+
+
+@pytest.mark.asyncio
+async def test_search_products(client: AsyncClient, async_session, admin_headers):
+	await create_product(client, async_session, admin_headers)
+	await client.post('/products/admin/create', headers=admin_headers, json=product2)
+	await client.post('/products/admin/create', headers=admin_headers, json={**product2, 'product_price': 0.5, 'product_stock_quantity': 0})
+	response = await client.get('/products/search', params={'product_color': 'Green'})
+	assert response.status_code == 200
+	assert [item['product_id'] for item in response.json()] == [2, 3]
+	response = await client.get('/products/search', params={'product_color': 'Green', 'in_stock': True})
+	assert [item['product_id'] for item in response.json()] == [2]
+	response = await client.get('/products/search', params={'min_price': 0.2, 'max_price': 1})
+	assert [item['product_id'] for item in response.json()] == [3]
+
+
+
+@pytest.mark.asyncio
+async def test_search_products_sorted_by_price_pagination(client: AsyncClient, async_session, admin_headers):
+	await create_product(client, async_session, admin_headers)
+	await client.post('/products/admin/create', headers=admin_headers, json=product2)
+	await client.post('/products/admin/create', headers=admin_headers, json={**product2, 'product_price': 0.5})
+	response = await client.get('/products/search', params={'sort_by': 'price', 'descending': True, 'limit': 2})
+	assert [item['product_id'] for item in response.json()] == [1, 3]
+	params = {
+	'sort_by': 'price',
+	'descending': True,
+	'limit': 2,
+	'after_id': response.headers['X-Next-Cursor'],
+	'after_price': response.headers['X-Next-Cursor-Price'],
+	}
+	response = await client.get('/products/search', params=params)
+	assert [item['product_id'] for item in response.json()] == [2]
+	response = await client.get('/products/search', params={'sort_by': 'price', 'after_id': 1})
+	assert response.status_code == 400
+
+
+
+@pytest.mark.asyncio
+async def test_full_text_search_products(client: AsyncClient, async_session, admin_headers):
+	await create_product(client, async_session, admin_headers)
+	await client.post('/products/admin/create', headers=admin_headers, json=product2)
+	await client.post('/products/admin/create', headers=admin_headers, json={**product2, 'product_name': 'Green banana', 'product_description': 'Unripe'})
+	response = await client.get('/products/search/text', params={'q': 'banana'})
+	assert response.status_code == 200
+	assert [item['product_id'] for item in response.json()] == [1, 3, 2]
+	response = await client.get('/products/search/text', params={'q': 'banana', 'limit': 1, 'offset': 1})
+	assert [item['product_id'] for item in response.json()] == [3]
+	await client.patch('/products/admin/refresh/2', headers=admin_headers, json={'product_description': 'Crisp and sweet'})
+	response = await client.get('/products/search/text', params={'q': 'banana -green'})
+	assert [item['product_id'] for item in response.json()] == [1]
+
+
+
+@pytest.mark.asyncio
+async def test_admin_import_products_csv(client: AsyncClient, async_session, admin_headers):
+	body = (
+		'product_name,product_price,product_size,product_color,product_stock_quantity,product_description\n'
+		'Banana,1.2,10,Yielow,10,"It`s BANANA!"\n'
+		'Apple,not a price,1,Green,100,Apple\n'
+		'Kiwi,0.5,2,Brown,20,"Hairy,\nand green inside"\n'
+		)
+	headers = {**admin_headers, 'Content-Type': 'text/csv'}
+	response = await client.post('/products/admin/import', headers=headers, content=body)
+	assert response.status_code == 200
+	report = response.json()
+	assert report['imported'] == 2
+	assert report['failed'] == 1
+	assert report['errors'][0]['row'] == 3
+	assert report['errors'][0]['errors'][0].startswith('product_price')
+	response = await client.get('/products/all')
+	products = [ProductResponse(**item) for item in response.json()]
+	assert [product.product_name for product in products] == ['Banana', 'Kiwi']
+	assert products[1].product_description == 'Hairy,\nand green inside'
+
+
+
+@pytest.mark.asyncio
+async def test_admin_import_products_ndjson(client: AsyncClient, async_session, admin_headers):
+	body = '\n'.join([json.dumps(product), '{broken', json.dumps({**product2, 'product_size': 'XL'}), json.dumps(product2)])
+	headers = {**admin_headers, 'Content-Type': 'application/x-ndjson'}
+	response = await client.post('/products/admin/import', headers=headers, content=body)
+	assert response.status_code == 200
+	report = response.json()
+	assert report['imported'] == 2
+	assert report['failed'] == 2
+	assert [error['row'] for error in report['errors']] == [2, 3]
+
+
+
+@pytest.mark.asyncio
+async def test_admin_import_products_rows_count_blank_lines(client: AsyncClient, async_session, admin_headers):
+	body = '\n'.join([json.dumps(product), '', '   ', json.dumps({**product2, 'product_size': 'XL'})])
+	headers = {**admin_headers, 'Content-Type': 'application/x-ndjson'}
+	response = await client.post('/products/admin/import', headers=headers, content=body)
+	assert response.status_code == 200
+	assert [error['row'] for error in response.json()['errors']] == [4]
+
+
+
+@pytest.mark.asyncio
+async def test_admin_import_products_rejects_unreadable_body(client: AsyncClient, async_session, admin_headers):
+	headers = {**admin_headers, 'Content-Type': 'text/csv'}
+	response = await client.post('/products/admin/import', headers=headers, content=b'product_name\n\xff\xfe\n')
+	assert response.status_code == 400
+	response = await client.post('/products/admin/import', headers=headers, content=b'product_name\n' + b'B' * 200000 + b'\n')
+	assert response.status_code == 400
+	response = await client.get('/products/all')
+	assert response.json() == []
+
+
+
+@pytest.mark.asyncio
+async def test_admin_bulk_update_products(client: AsyncClient, async_session, admin_headers):
+	await create_product(client, async_session, admin_headers)
+	await client.post('/products/admin/create', headers=admin_headers, json=product2)
+	product_updates = [
+	{'product_id': 1, 'product_price': 2.5, 'product_stock_quantity': 3},
+	{'product_id': 2, 'product_price': 0.2},
+	{'product_id': 2, 'product_name': 'Pear'},
+	{'product_id': 3, 'product_price': 1},
+	{'product_id': 1},
+	]
+	response = await client.patch('/products/admin/bulk/refresh', headers=admin_headers, json=product_updates)
+	assert response.status_code == 200
+	assert response.json() == {'updated': 2, 'missing': 1, 'failed': 2, 'missing_ids': [3], 'failed_ids': [2, 1]}
+	response = await client.get('/products/all')
+	products = [ProductResponse(**item) for item in response.json()]
+	assert (products[0].product_price, products[0].product_stock_quantity, products[0].product_name) == (2.5, 3, 'Banana')
+	assert (products[1].product_price, products[1].product_stock_quantity, products[1].product_name) == (0.2, 100, 'Apple')
+
+
+
+@pytest.mark.asyncio
+async def test_admin_bulk_update_products_failed_group(client: AsyncClient, async_session, admin_headers):
+	await create_product(client, async_session, admin_headers)
+	await client.post('/products/admin/create', headers=admin_headers, json=product2)
+	product_updates = [
+	{'product_id': 1, 'product_stock_quantity': 2 ** 40},
+	{'product_id': 2, 'product_price': 0.2},
+	]
+	response = await client.patch('/products/admin/bulk/refresh', headers=admin_headers, json=product_updates)
+	assert response.status_code == 200
+	assert response.json()['updated'] == 1
+	assert response.json()['failed_ids'] == [1]
+	response = await client.get('/products/all')
+	assert [item['product_stock_quantity'] for item in response.json()] == [10, 100]
 
 
 
+@pytest.mark.asyncio
+async def test_get_all_products_conditional_get(client: AsyncClient, async_session, async_test_engine, admin_headers):
+	await create_product(client, async_session, admin_headers)
+	response = await client.get('/products/all')
+	etag = response.headers['ETag']
+	assert response.headers['Cache-Control'] == 'public, max-age=0, must-revalidate'
+	statements = []
+	def record_statement(conn, cursor, statement, *args):
+		statements.append(statement)
+	event.listen(async_test_engine.sync_engine, 'before_cursor_execute', record_statement)
+	try:
+		response = await client.get('/products/all', headers={'If-None-Match': etag})
+	finally:
+		event.remove(async_test_engine.sync_engine, 'before_cursor_execute', record_statement)
+	assert response.status_code == 304
+	assert statements == []
+	assert response.headers['ETag'] == etag
+	assert response.content == b''
+	response = await client.get('/products/all', params={'limit': 1}, headers={'If-None-Match': etag})
+	assert response.status_code == 200
+	# A worker with a cold cache derives the same validator for the same content.
+	catalog_cache.clear()
+	response = await client.get('/products/all', headers={'If-None-Match': etag})
+	assert response.status_code == 304
+	await client.patch('/products/admin/refresh/1', headers=admin_headers, json={'product_price': 2})
+	response = await client.get('/products/all', headers={'If-None-Match': etag})
+	assert response.status_code == 200
+	assert response.headers['ETag'] != etag
+	assert response.json()[0]['product_price'] == 2
 
 
 
+@pytest.mark.asyncio
+async def test_get_product_facets(client: AsyncClient, async_session, admin_headers):
+	await create_product(client, async_session, admin_headers)
+	await client.post('/products/admin/create', headers=admin_headers, json=product2)
+	await client.post('/products/admin/create', headers=admin_headers, json={**product2, 'product_price': 15})
+	await client.patch('/products/admin/refresh/1', headers=admin_headers, json={'product_color': 'Green'})
+	await client.delete('/products/admin/delete/2', headers=admin_headers)
+	response = await client.get('/products/facets')
+	assert response.status_code == 200
+	assert response.json() == {
+	'colors': [{'value': 'Green', 'count': 2}],
+	'sizes': [{'value': 1, 'count': 1}, {'value': 10, 'count': 1}],
+	'price_buckets': [{'min_price': 0, 'max_price': 10, 'count': 1}, {'min_price': 10, 'max_price': 20, 'count': 1}],
+	}
+
+
+
+
+@pytest.mark.asyncio
+async def test_get_product_facets_after_bulk_update(client: AsyncClient, async_session, admin_headers):
+	await create_product(client, async_session, admin_headers)
+	await client.post('/products/admin/create', headers=admin_headers, json=product2)
+	product_updates = [
+	{'product_id': 1, 'product_price': 25},
+	{'product_id': 2, 'product_price': 0.5},
+	]
+	await client.patch('/products/admin/bulk/refresh', headers=admin_headers, json=product_updates)
+	await client.patch('/products/admin/bulk/refresh', headers=admin_headers, json=[{'product_id': 1, 'product_stock_quantity': 3}])
+	response = await client.get('/products/facets')
+	assert response.json()['price_buckets'] == [{'min_price': 0, 'max_price': 10, 'count': 1}, {'min_price': 20, 'max_price': 30, 'count': 1}]
+	assert response.json()['colors'] == [{'value': 'Green', 'count': 1}, {'value': 'Yielow', 'count': 1}]
@@ -1,10 +1,13 @@
 import pytest_asyncio
 import pytest
 
-from security import get_password_hash, verify_password, create_access_token
+from security import get_password_hash, verify_password, create_access_token, PasswordHasher
+from exceptions import PasswordHashingBusyException
 from datetime import timedelta, datetime, UTC
 from jose import jwt, JWTError
 import os 
+import time
+import asyncio
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -31,6 +34,30 @@ async def test_verify_password():
 	assert await verify_password(wrong_password, hashed_password) is False
 
 
+
+@pytest.mark.asyncio
+async def test_password_hasher_limits_queue():
+	hasher = PasswordHasher(workers=1, max_queue=1)
+	ticks = 0
+
+	async def ticker():
+		nonlocal ticks
+		while True:
+			ticks += 1
+			await asyncio.sleep(0.01)
+
+	task = asyncio.create_task(ticker())
+	results = await asyncio.gather(*(hasher.run(time.sleep, 0.1) for _ in range(3)), return_exceptions=True)
+	task.cancel()
+	assert sum(isinstance(result, PasswordHashingBusyException) for result in results) == 1
+	# The event loop kept running while the pool was busy.
+	assert ticks >= 10
+	stats = hasher.stats()
+	assert (stats['completed'], stats['rejected'], stats['in_flight']) == (2, 1, 0)
+	assert stats['hash_time_p50_ms'] >= 100
+	assert stats['queue_wait_p99_ms'] >= 100
+
+
 @pytest.mark.asyncio
 async def test_create_access_token():
 	data = {'sub': 'test@examle.com'}
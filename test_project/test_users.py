@@ -1,9 +1,12 @@
 import pytest_asyncio
 import pytest
 from httpx import AsyncClient
-from sqlalchemy import select
-from database import User
-from exceptions import UserAlreadyExistsException, NegativeDepositException, UserNotFoundException, InvalidCredentialsException, IncorrectPasswordException, IncorrectPasswordRepedException
+from sqlalchemy import select, update
+from database import User, IdempotencyKey
+from idempotency import prune_expired_keys
+from cache import principal_cache
+from datetime import datetime
+from exceptions import UserAlreadyExistsException, NegativeDepositException, UserNotFoundException, InvalidCredentialsException, IncorrectPasswordException, IncorrectPasswordRepedException, IdempotencyKeyMismatchException
 
 registration_user = {
 	'email': 'test@example.com',
@@ -173,3 +176,50 @@ async def test_deposit(client: AsyncClient, async_session, amount, expected):
 
 
 
+@pytest.mark.asyncio
+async def test_deposit_idempotency_key(client: AsyncClient, async_session):
+	await registr(client)
+	headers = {**await current_user_token(client), 'Idempotency-Key': 'deposit-1'}
+	response = await client.patch('/users/add/balance', headers=headers, json={'amount': 100})
+	assert response.status_code == 200
+	assert 'Idempotent-Replayed' not in response.headers
+	response = await client.patch('/users/add/balance', headers=headers, json={'amount': 100})
+	assert response.status_code == 200
+	assert response.headers['Idempotent-Replayed'] == 'true'
+	assert response.json()['new_balance'] == 100
+	response = await client.patch('/users/add/balance', headers=headers, json={'amount': 50})
+	assert response.status_code == IdempotencyKeyMismatchException().status_code
+	response = await client.get('/users/me', headers=headers)
+	assert response.json()['balance'] == 100
+
+	await async_session.execute(update(IdempotencyKey).values(expires_at=datetime(2000, 1, 1)))
+	assert await prune_expired_keys(async_session) == 1
+	response = await client.patch('/users/add/balance', headers=headers, json={'amount': 100})
+	assert response.json()['new_balance'] == 200
+
+
+
+@pytest.mark.asyncio
+async def test_principal_cache(client: AsyncClient, async_session, admin_headers):
+	user_id = await registr(client)
+	headers = await current_user_token(client)
+	await client.get('/users/me', headers=headers)
+	hits = principal_cache.stats()['hits']
+	response = await client.get('/users/me', headers=headers)
+	assert response.json()['balance'] == 0
+	assert principal_cache.stats()['hits'] == hits + 1
+	assert principal_cache.stats()['memory_bytes'] > 0
+
+	await client.patch(f'/admin/update/balance/{user_id}', headers=admin_headers, json={'new_balance': 50})
+	response = await client.get('/users/me', headers=headers)
+	assert response.json()['balance'] == 50
+	response = await client.patch('/users/add/balance', headers=headers, json={'amount': 10})
+	assert response.json()['new_balance'] == 60
+	response = await client.patch('/users/add/balance', headers=headers, json={'amount': 10})
+	assert response.json()['new_balance'] == 70
+	response = await client.get('/users/me', headers=headers)
+	assert response.json()['balance'] == 70
+
+	await client.patch('/users/change/email', headers=headers, json={'new_email': 'renamed@example.com'})
+	response = await client.get('/users/me', headers=headers)
+	assert response.status_code == 404